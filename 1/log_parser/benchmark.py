@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Throughput benchmarks for the log parser.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import log_analyzer
+import loggen
+
+
+SAMPLE_LINE = ('1.196.116.32 -  - [29/Jun/2017:03:52:22 +0300] "GET /api/v2/banner/24852159 HTTP/1.1" '
+               '200 976 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+               '"1498697540-2190034393-4709-9930664" "dc7161be3" 1.390')
+
+
+def legacy_process_line(line: str)->tuple:
+    """Line parser as it was before the precompiled ui_short regex, kept for comparison."""
+
+    try:
+        request_time = float(re.search(r'\d{1,}\.{1}\d{0,}$', line)[0])
+        request_url = re.search(r'(?<=[GET|POST]\s)(.+?)(?=\s)', line)[0]
+    except Exception:
+        request_time = request_url = None
+
+    return request_time, request_url
+
+
+def lines_per_second(func, lines: list)->float:
+    """Running func over every line and returning throughput."""
+
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    elapsed = time.perf_counter() - start
+
+    return len(lines) / elapsed if elapsed else float('inf')
+
+
+def bench_parsers(lines: list)->dict:
+    """Comparing line parsers on the same input, result is in lines/sec."""
+
+    return {
+        'legacy': lines_per_second(legacy_process_line, lines),
+        'strict': lines_per_second(lambda x: log_analyzer.parse_line(x, True), lines),
+        'lenient': lines_per_second(lambda x: log_analyzer.parse_line(x, False), lines),
+    }
+
+
+def legacy_read(filepath: str):
+    """Line reading as it was before the binary pipeline: gzip.open and decode of every line."""
+
+    with gzip.open(filepath, 'r') if filepath.endswith('.gz') else open(filepath, 'rb') as f:
+        for line in f:
+            yield legacy_process_line(line.decode('utf-8'))
+
+
+def megabytes_per_second(func, filepath: str, size: int)->float:
+    """Consuming everything func yields for filepath, size is the uncompressed size of data."""
+
+    start = time.perf_counter()
+    for _ in func(filepath):
+        pass
+    elapsed = time.perf_counter() - start
+
+    return size / 1024 / 1024 / elapsed if elapsed else float('inf')
+
+
+def bench_readers(lines: list)->dict:
+    """Comparing readers on plain and gzip copies of the same log, result is in MB/s."""
+
+    data = '\n'.join(lines).encode('utf-8') + b'\n'
+    res = dict()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, content in [('plain', data), ('gzip', gzip.compress(data))]:
+            filepath = os.path.join(tmp, 'nginx-access-ui.log-20170630' + ('.gz' if name == 'gzip' else ''))
+            with open(filepath, 'wb') as f:
+                f.write(content)
+
+            res[name + ' legacy'] = megabytes_per_second(legacy_read, filepath, len(data))
+            res[name + ' binary'] = megabytes_per_second(
+                lambda x: log_analyzer.parse_lines(log_analyzer.split_lines(log_analyzer.read_blocks(x)), [0]),
+                filepath, len(data))
+            if name == 'plain':
+                res[name + ' mmap'] = megabytes_per_second(
+                    lambda x: log_analyzer.scan_mapped(x, [0]), filepath, len(data))
+
+    return res
+
+
+def timed(func, repeat: int = 1)->dict:
+    """Best wall time of repeat runs of func, with CPU time and peak RSS of that run."""
+
+    best = None
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        func()
+        run = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+        if best is None or run['wall'] < best['wall']:
+            best = run
+    best.update(log_analyzer.peak_rss())
+
+    return best
+
+
+def bench_suite(sizes: list, compress: list, repeat: int = 1, **generator)->list:
+    """
+    Timing process_log_file, logs_handler and main on generated logs of every size and compression,
+    every result has lines, bytes and throughput of the input.
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    res = []
+
+    for size in sizes:
+        for gz in compress:
+            with tempfile.TemporaryDirectory() as tmp:
+                log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630' + ('.gz' if gz else ''))
+                written = loggen.LogGenerator(**generator).write(log_file, size, gz)
+                config = {'REPORT_SIZE': 1000, 'LOG_DIR': tmp, 'REPORT_DIR': os.path.join(tmp, 'reports'),
+                          'MIN_LINES': 0.5, 'HTML_TPL': os.path.join(here, 'report.html')}
+                os.makedirs(config['REPORT_DIR'])
+
+                def run_main():
+                    for name in os.listdir(config['REPORT_DIR']):
+                        os.remove(os.path.join(config['REPORT_DIR'], name))
+                    log_analyzer.main(config)
+
+                targets = [
+                    ('process_log_file', lambda: sum(1 for _ in log_analyzer.process_log_file(log_file, [0]))),
+                    ('logs_handler', lambda: log_analyzer.logs_handler(config, log_file)),
+                    ('main', run_main),
+                ]
+                for name, func in targets:
+                    run = timed(func, repeat)
+                    run.update({
+                        'target': name,
+                        'size': size,
+                        'gzip': gz,
+                        'file_bytes': os.path.getsize(log_file),
+                        'lines': written['lines'],
+                        'bytes': written['bytes'],
+                        'lines_per_sec': round(written['lines'] / run['wall']),
+                        'mb_per_sec': round(written['bytes'] / 1024 / 1024 / run['wall'], 3),
+                    })
+                    res.append(run)
+
+    return res
+
+
+def environment()->dict:
+    """Where results were measured: python, platform and git revision of the tree."""
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip()
+    except OSError:
+        revision = None
+
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'revision': revision or None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(before: list, after: list)->list:
+    """Speedup of after against before for every (target, size, gzip) measured in both."""
+
+    key = lambda x: (x['target'], x['size'], x['gzip'])
+    old = {key(x): x for x in before}
+
+    return [(key(x), old[key(x)]['wall'] / x['wall']) for x in after if key(x) in old and x['wall']]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Log parser benchmarks',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--lines', type=int, default=200000, help='Number of lines to parse.')
+    parser.add_argument('--suite', action='store_true',
+                        help='Time process_log_file, logs_handler and main on generated logs instead.')
+    parser.add_argument('--sizes', default='10M,100M', help='Comma separated sizes of generated logs.')
+    parser.add_argument('--compress', choices=['plain', 'gzip', 'both'], default='both', help='Logs to generate.')
+    parser.add_argument('--urls', type=int, default=10000, help='Distinct URLs in generated logs.')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of URL popularity.')
+    parser.add_argument('--latency', choices=loggen.LATENCIES, default='lognormal',
+                        help='request_time distribution.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of generator.')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of every target, the best one is kept.')
+    parser.add_argument('--output', default='benchmark.json', help='Where suite results are written.')
+    parser.add_argument('--compare', default=None, help='Results of an earlier suite run to compare with.')
+    args = parser.parse_args()
+
+    if not args.suite:
+        for name, speed in bench_parsers([SAMPLE_LINE] * args.lines).items():
+            print('{:<16} {:>12.0f} lines/sec'.format(name, speed))
+
+        for name, speed in bench_readers([SAMPLE_LINE] * args.lines).items():
+            print('{:<16} {:>12.1f} MB/s'.format(name, speed))
+        sys.exit(0)
+
+    logging.basicConfig(level=logging.WARNING)
+    compress = {'plain': [False], 'gzip': [True], 'both': [False, True]}[args.compress]
+    results = bench_suite([loggen.parse_size(x) for x in args.sizes.split(',')], compress, args.repeat,
+                          urls=args.urls, zipf=args.zipf, latency=args.latency, seed=args.seed)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'generator': vars(args), 'results': results}, f, indent=2)
+
+    for x in results:
+        print('{target:<18} {size:>12} {gzip!s:<6} {wall:>9.3f} s {lines_per_sec:>10} lines/sec '
+              '{mb_per_sec:>9.1f} MB/s'.format(**x))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            before = json.load(f)['results']
+        for (target, size, gz), speedup in compare(before, results):
+            print('{:<18} {:>12} {!s:<6} x{:.2f}'.format(target, size, gz, speedup))
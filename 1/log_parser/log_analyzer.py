@@ -8,19 +8,153 @@
 #                     '$request_time';
 
 import argparse
+import cProfile
+import ctypes
+import select
 import sys
 import logging
 import string
 import os
-import gzip
+import zlib
 import json
+import mmap
+import pickle
 import re
+import heapq
+import multiprocessing
+import queue
+import random
+import shutil
+import time
+import weakref
+from array import array
+from collections import namedtuple
 from functools import reduce
-from contextlib import contextmanager
+from itertools import islice
+from contextlib import contextmanager, nullcontext
 from statistics import median
 from string import Template
 from datetime import datetime
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from sketches import KLLSketch, LogHistogram, SpaceSaving, HyperLogLog, hash64
+
+try:
+    import numpy as np
+except ImportError:  # optional, needed only by the numpy engine
+    np = None
+
+try:
+    import indexed_gzip
+except ImportError:  # optional, needed only for random access to gzip logs
+    indexed_gzip = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is not reported there
+    resource = None
+
+
+def str_to_bool(value: str)->bool:
+    '''Parsing boolean config value. '''
+
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+# optional settings: absent from the default config, may be set in the config file
+OPTIONAL_CONFIG = {
+    "STRICT_PARSING": str_to_bool,
+    "WORKERS": int,  # processes for parsing: byte ranges of plain logs, decompressed batches of gzip logs
+    "AGGREGATION": str,  # 'exact', 'packed', 'sketch', 'histogram' or 'topk'
+    "ENGINE": str,  # 'python' or 'numpy' (vectorized exact aggregation)
+    "SKETCH_ACCURACY": float,  # rank error of quantiles in 'sketch' aggregation
+    "HISTOGRAM_PRECISION": float,  # relative error of values in 'histogram' aggregation
+    "TOPK_SIZE": int,  # URLs tracked in 'topk' aggregation
+    "QUANTILES": lambda x: [float(q) for q in x.split(',') if q.strip()],  # extra report columns
+    "INCREMENTAL": str_to_bool,  # resume from checkpoint and refresh existing report (with bounded aggregations)
+    "CHECKPOINT_DIR": str,  # where checkpoints are kept, REPORT_DIR by default
+    "BACKFILL_JOBS": int,  # log files processed at once in backfill mode
+    "SAMPLING": str,  # 'full', 'every' or 'reservoir'
+    "SAMPLING_STEP": int,  # N of 1-in-N 'every' sampling
+    "RESERVOIR_SIZE": int,  # lines in 'reservoir' sample
+    "MAX_LINES": int,  # budget of lines read, 0 - no limit
+    "MAX_SECONDS": float,  # budget of parsing time, 0 - no limit
+    "NORMALIZE_URLS": lambda x: [r.strip() for r in x.split(',') if r.strip()],  # names of URL_RULES or 'all'
+    "URL_RULES_FILE": str,  # extra rules, a line is '<regex> <replacement>'
+    "URL_CACHE_SIZE": int,  # distinct raw URLs remembered by parser
+    "MMAP": str_to_bool,  # scan uncompressed logs through mmap, on by default
+    "SAVE_AGGREGATES": str_to_bool,  # write report-YYYY.MM.DD.agg next to the report
+    "ROLLUP_DAYS": int,  # build one report of the last N days from saved aggregates
+    "TIMESERIES": str_to_bool,  # requests and request_time per minute of $time_local in the report
+    "TIMESERIES_URLS": int,  # heaviest URLs which get their own series
+    "PROFILE": str_to_bool,  # log stage timings and save them to report-YYYY.MM.DD.profile.json
+    "CPROFILE": str_to_bool,  # also dump cProfile stats to report-YYYY.MM.DD.prof
+    "FOLLOW": str_to_bool,  # keep running, tail the newest log and refresh its report (histogram by default)
+    "FOLLOW_INTERVAL": float,  # seconds between report refreshes in follow mode
+    "FOLLOW_POLL": float,  # seconds between checks of log file when inotify is not available
+    "MANIFEST_FILE": str,  # JSON index of LOG_DIR, makes discovery cost O(new files)
+    "GZIP_INDEX": str_to_bool,  # random access to gzip logs through a cached index (needs indexed_gzip)
+    "GZIP_INDEX_SPACING": int,  # MB of uncompressed data between index points
+    "PARSE_ERRORS_SAMPLE": int,  # unrecognized lines kept for the summary: first N and a reservoir of N
+    "MIN_LINES_CHECK": int,  # lines after which MIN_LINES is checked on every unrecognized line
+    "MEMORY_BUDGET": float,  # MB of aggregates kept in memory, the rest is spilled to disk, 0 - no limit
+    "SPILL_PARTITIONS": int,  # hash partitions of spilled aggregates, one is in memory at a time when merged
+    "SPILL_DIR": str,  # where spilled aggregates are kept, system temporary directory by default
+    "URL_PREFIXES": lambda x: [p.strip() for p in x.split(',') if p.strip()],  # only URLs with these prefixes
+    "URL_EXCLUDE_PREFIXES": lambda x: [p.strip() for p in x.split(',') if p.strip()],  # URLs left out
+    "URL_REGEX": str,  # only URLs which the regex finds
+    "URL_EXCLUDE_REGEX": str,  # URLs which the regex finds are left out
+    "METHODS": lambda x: [m.strip().upper() for m in x.split(',') if m.strip()],  # e.g. GET,POST
+    "STATUS": str,  # status codes and ranges, e.g. 200-299,404
+    "TIME_WINDOW": str,  # time of day of $time_local, e.g. 09:00-18:00, the end is excluded
+    "CARDINALITY": str_to_bool,  # HyperLogLog estimates of distinct clients per URL and distinct URLs in the report
+    "CARDINALITY_PRECISION": int,  # 2 ** N registers of a per-URL sketch, 10 - 3.3% error, the log's sketches get N + 4
+    "CARDINALITY_URLS": int,  # heaviest URLs which get their own sketch, 2 * REPORT_SIZE by default
+}
+
+
+LogRecord = namedtuple('LogRecord', ['remote_addr', 'remote_user', 'http_x_real_ip', 'time_local',
+                                     'method', 'url', 'protocol', 'status', 'body_bytes_sent',
+                                     'http_referer', 'http_user_agent', 'http_x_forwarded_for',
+                                     'http_x_request_id', 'http_x_rb_user', 'request_time'])
+
+# the whole ui_short line in one pass
+LINE_PATTERN = (r'(\S+)\s+(\S+)\s+(\S+)\s+\[([^\]]*)\]\s+'
+                r'"([A-Z]+) (\S+)(?: ([^"]*))?"\s+(\d{3})\s+(\d+|-)\s+'
+                r'"([^"]*)"\s+"([^"]*)"\s+"([^"]*)"\s+"([^"]*)"\s+"([^"]*)"\s+'
+                r'(\d+\.\d*)\s*$')
+
+# fallback for lines which doesn't fit ui_short completely: only request and request_time
+LENIENT_LINE_PATTERN = r'"([A-Z]+) (\S+)[^"]*".*\s(\d+\.\d*)\s*$'
+
+LINE_RE = re.compile(LINE_PATTERN)
+LENIENT_LINE_RE = re.compile(LENIENT_LINE_PATTERN)
+
+# the same patterns for undecoded lines
+LINE_RE_B = re.compile(LINE_PATTERN.encode())
+LENIENT_LINE_RE_B = re.compile(LENIENT_LINE_PATTERN.encode())
+
+# ui_short for a whole mapped file, no part of it may cross the end of line:
+# otherwise a search from every line start of a run of broken lines scans up to the end of file
+MAPPED_LINE_PATTERN = (LINE_PATTERN[:-len(r'\s*$')].replace(r'\s', r'[ \t]')
+                       .replace(r'[^\]]', r'[^\]\n]').replace(r'[^"]', r'[^"\n]'))
+MAPPED_LINE_RE_B = re.compile(b'^' + MAPPED_LINE_PATTERN.encode() + br'[ \t\r]*$', re.M)
+
+# request and request_time of every line of a block in one findall, the same fields as lenient matching gives
+CHUNK_LINE_RE_B = re.compile(br'"[A-Z]+ (\S+)[^"\n]*"[^\n]*[ \t](\d+\.\d*)[ \t\r]*$', re.M)
+
+# request of ui_short line, only for telling why a line is not recognized
+REQUEST_RE_B = re.compile(br'"[A-Z]+ \S+')
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# built-in URL normalization rules, applied in this order
+URL_RULES = [
+    ('query', r'\?.*', ''),
+    ('uuid', r'/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)', '/{uuid}'),
+    ('hex', r'/(?=[0-9a-f]*[a-f])(?=[0-9a-f]*\d)[0-9a-f]{8,}(?=/|$)', '/{hex}'),
+    ('id', r'/\d+(?=/|$)', '/{id}'),
+]
 
 
 def load_config(cfg_file: str)->dict:
@@ -37,9 +171,11 @@ def load_config(cfg_file: str)->dict:
     if os.path.isfile(cfg_file):
         with open(cfg_file, 'r') as f:
             for cfg in f.readlines():
-                cfg = list(map(lambda x: x.strip(), cfg.split(':')))
+                cfg = list(map(lambda x: x.strip(), cfg.split(':', 1)))
                 if cfg[0] in config.keys():
                     config[cfg[0]] = cfg[1]
+                elif cfg[0] in OPTIONAL_CONFIG:
+                    config[cfg[0]] = OPTIONAL_CONFIG[cfg[0]](cfg[1])
                 else:
                     raise ValueError("Configuration file can't be parsed")
     else:
@@ -48,127 +184,2731 @@ def load_config(cfg_file: str)->dict:
     return config
 
 
-def date_to_int(name: str) -> int:
-    '''Getting date from file name and convert it to int'''
-    
+def date_to_int(name: str) -> int:
+    '''Getting date from file name and convert it to int'''
+    
+    try:
+        filedate = re.search(r'\d{8}', name)[0]
+        
+        res = int(filedate)
+        
+    except Exception as e:        
+        logging.error(repr(e))
+        raise
+
+    return res
+
+
+def date_to_str_with_delimiters(name: str)->str:
+    '''Getting date from file name and converts it to a string formated "YYYY.MM.DD" '''
+    
+    try:
+        filedate = datetime.strptime(re.search(r'\d{8}', name)[0], '%Y%m%d')        
+        res = datetime.strftime(filedate, '%Y.%m.%d')
+        
+    except Exception as e:        
+        logging.error(repr(e))
+        raise
+
+    return res
+
+ 
+LOG_NAME_RE = re.compile(r'nginx-access-ui.log-(\d{8})\D*')
+
+
+class LogManifest(object):
+    '''
+    Persistent JSON index of log files in LOG_DIR: their dates, sizes, mtimes and whether report exists.
+    A directory is scanned again only when its mtime changes, and only names not seen before are
+    matched and stat'ed, so discovery of an unchanged LOG_DIR costs two stats. Sizes and mtimes of
+    files seen before are stat'ed again when they are consulted: pending files and the newest one.
+    Manifest should be kept out of LOG_DIR: every new process rescans the directory it is saved to.
+    '''
+
+    RACY_NS = 2 * 10 ** 9  # mtime that recent may not include changes made in the same clock tick
+
+    def __init__(self, path: str, log_dir: str, report_dir: str):
+        self.path = path
+        self.log_dir = os.path.abspath(log_dir)
+        self.report_dir = os.path.abspath(report_dir)
+        self.data = None
+
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+            except ValueError as e:
+                logging.error("Manifest %s can't be read: %s" % (path, repr(e)))
+
+        if not self.data or self.data.get('log_dir') != self.log_dir or self.data.get('report_dir') != self.report_dir:
+            self.data = {'log_dir': self.log_dir, 'report_dir': self.report_dir,
+                         'log_dir_mtime': None, 'report_dir_mtime': None, 'files': {}}
+
+    def mtime(self, st: os.stat_result):
+        '''Directory mtime to remember, None if it is too recent to be trusted. '''
+
+        return None if time.time_ns() - st.st_mtime_ns < self.RACY_NS else st.st_mtime_ns
+
+    def refresh(self)->bool:
+        '''Bringing manifest up to date with directories, returns whether it changed. '''
+
+        changed = False
+        files = self.data['files']
+
+        st = os.stat(self.log_dir)
+        if st.st_mtime_ns != self.data['log_dir_mtime']:
+            names = set()
+            with os.scandir(self.log_dir) as entries:
+                for entry in entries:
+                    names.add(entry.name)
+                    if entry.name in files:
+                        continue
+                    m = LOG_NAME_RE.fullmatch(entry.name)
+                    if m:
+                        stat = entry.stat()
+                        files[entry.name] = {'date': int(m.group(1)), 'size': stat.st_size,
+                                             'mtime': stat.st_mtime_ns, 'report': None}
+            for name in [x for x in files if x not in names]:
+                del files[name]
+            self.data['log_dir_mtime'] = self.mtime(st)
+            self.data['report_dir_mtime'] = None
+            changed = True
+
+        try:
+            st = os.stat(self.report_dir)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_mtime_ns != self.data['report_dir_mtime']:
+            reports = set(os.listdir(self.report_dir)) if st is not None else set()
+            for val in files.values():
+                date = str(val['date'])
+                val['report'] = 'report-{}.{}.{}.html'.format(date[:4], date[4:6], date[6:]) in reports
+            self.data['report_dir_mtime'] = self.mtime(st) if st is not None else None
+            changed = True
+
+        if changed:
+            self.save()
+
+        return changed
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with NamedTemporaryFile('w', encoding='utf-8', dir=directory, delete=False) as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(f.name, self.path)
+
+        # saving manifest changes mtime of its own directory, this change is known in this process
+        for key, path in [('log_dir_mtime', self.log_dir), ('report_dir_mtime', self.report_dir)]:
+            if path == directory and self.data[key] is not None:
+                self.data[key] = self.mtime(os.stat(path))
+
+    def restat(self, names: list)->bool:
+        '''Updating sizes and mtimes of known log files, returns whether they changed. '''
+
+        changed = False
+        files = self.data['files']
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.log_dir, name))
+            except FileNotFoundError:
+                continue  # removed file is dropped by the next scan
+            val = files[name]
+            if (val['size'], val['mtime']) != (st.st_size, st.st_mtime_ns):
+                val['size'], val['mtime'] = st.st_size, st.st_mtime_ns
+                changed = True
+
+        if changed:
+            self.save()
+
+        return changed
+
+    def log_files(self)->list:
+        '''Names of log files, oldest first. '''
+
+        files = self.data['files']
+
+        return sorted(files, key=lambda x: files[x]['date'])
+
+    def pending(self)->list:
+        '''Names of log files without report, oldest first. '''
+
+        names = [x for x in self.log_files() if not self.data['files'][x]['report']]
+        self.restat(names)
+
+        return names
+
+
+MANIFESTS = dict()  # manifest file -> LogManifest, kept for long runs like follow mode
+
+
+def get_manifest(config: dict)->LogManifest:
+    '''Up to date manifest of LOG_DIR if MANIFEST_FILE is configured, otherwise None. '''
+
+    if not config.get('MANIFEST_FILE', None):
+        return None
+
+    path = os.path.abspath(config['MANIFEST_FILE'])
+    manifest = MANIFESTS.get(path, None)
+    if manifest is None or manifest.log_dir != os.path.abspath(config['LOG_DIR']) or \
+            manifest.report_dir != os.path.abspath(config['REPORT_DIR']):
+        manifest = MANIFESTS[path] = LogManifest(path, config['LOG_DIR'], config['REPORT_DIR'])
+    manifest.refresh()
+
+    return manifest
+
+
+def log_file_names(config: dict)->list:
+    '''Names of log files in log directory, oldest first. '''
+
+    if not os.path.isdir(config.get("LOG_DIR")):
+        logging.error("Log directory (%s) doesn't exist" % config.get("LOG_DIR"))
+        raise FileExistsError("Log directory (%s) doesn't exist" % config.get("LOG_DIR"))
+
+    manifest = get_manifest(config)
+    if manifest is not None:
+        names = manifest.log_files()
+        manifest.restat(names[-1:])  # the newest log may still be growing
+        return names
+
+    dated = []
+    with os.scandir(config.get("LOG_DIR")) as entries:
+        for entry in entries:
+            m = LOG_NAME_RE.fullmatch(entry.name)
+            if m:
+                dated.append((int(m.group(1)), entry.name))
+
+    return [name for _, name in sorted(dated)]
+
+
+def get_report_name(config: dict):
+    '''Return newest report file name. '''
+    
+    rfiles = log_file_names(config)
+    if not rfiles:
+        logging.error("There is no any log file in log directory (%s)" % config.get("LOG_DIR"))
+        return None 
+    
+    log_file = os.path.join(os.path.abspath(os.getcwd()), config.get("LOG_DIR"), rfiles[-1])
+    logging.info('Report file is %s' % log_file)
+    return log_file
+
+
+def get_log_files(config: dict)->list:
+    '''Return all log file names in log directory, oldest first. '''
+
+    return [os.path.join(os.path.abspath(os.getcwd()), config.get("LOG_DIR"), x) for x in log_file_names(config)]
+
+
+def parse_line(line: str, strict: bool = True):
+    """
+    Parsing ui_short line into LogRecord, returns None if line can't be recognized.
+    In lenient mode only method, url and request_time are required.
+    """
+
+    m = LINE_RE.match(line)
+    if m:
+        g = m.groups()
+        return LogRecord(g[0], g[1], g[2], g[3], g[4], g[5], g[6], int(g[7]),
+                         0 if g[8] == '-' else int(g[8]), g[9], g[10], g[11], g[12], g[13],
+                         float(g[14]))
+
+    if strict:
+        return None
+
+    m = LENIENT_LINE_RE.search(line)
+    if m:
+        return LogRecord(None, None, None, None, m.group(1), m.group(2), None, None, None,
+                         None, None, None, None, None, float(m.group(3)))
+
+    return None
+
+
+def process_line(line: str, strict: bool = False, errors: 'ParseErrors' = None)->tuple:
+    """
+    Finding requested fields in line
+    """
+
+    record = parse_line(line, strict)
+
+    if record is None:
+        if errors is not None:
+            errors.add(line.encode('utf-8', errors='replace'), strict)
+        return None, None
+
+    return record.request_time, record.url
+
+
+def gzip_index_name(filepath: str)->str:
+    '''Index file of gzip log, hidden, so it is never taken for a log file. '''
+
+    directory, name = os.path.split(filepath)
+
+    return os.path.join(directory, '.' + name + '.gzidx')
+
+
+def gzip_indexed(filepath: str, config: dict = None)->bool:
+    '''Whether gzip log file is read at uncompressed offsets through an index. '''
+
+    return bool((config or {}).get('GZIP_INDEX', False)) and indexed_gzip is not None and \
+        filepath.split('.')[-1].lower() == 'gz'
+
+
+def open_indexed_gzip(filepath: str, spacing: int = 4):
+    '''
+    Opening gzip file for random access. zran-style index keeps the deflate window every spacing MB
+    of uncompressed data, so decompression can start near any offset. The index is built on the first
+    open and cached next to the log file, it is rebuilt if the log file is newer.
+    '''
+
+    index = gzip_index_name(filepath)
+    f = indexed_gzip.IndexedGzipFile(filepath, spacing=spacing << 20, readbuf_size=BLOCK_SIZE)
+
+    try:
+        if os.path.isfile(index) and os.path.getmtime(index) >= os.path.getmtime(filepath):
+            try:
+                f.import_index(index)
+                return f
+            except Exception as e:
+                logging.error("Index %s can't be read: %s" % (index, repr(e)))
+                f.close()
+                f = indexed_gzip.IndexedGzipFile(filepath, spacing=spacing << 20, readbuf_size=BLOCK_SIZE)
+
+        logging.info('Building index of %s' % filepath)
+        f.build_full_index()
+        try:
+            with NamedTemporaryFile('wb', dir=os.path.dirname(index) or '.', delete=False) as tmp:
+                pass
+            f.export_index(tmp.name)
+            os.replace(tmp.name, index)
+        except OSError as e:
+            logging.error("Index of %s can't be saved: %s" % (filepath, repr(e)))
+    except Exception:
+        f.close()
+        raise
+
+    return f
+
+
+def open_log(filepath: str, config: dict = None):
+    '''Log file for reading at byte offsets: plain file, or gzip file with index (offsets are uncompressed). '''
+
+    if gzip_indexed(filepath, config):
+        return open_indexed_gzip(filepath, int(config.get('GZIP_INDEX_SPACING', 4) or 4))
+
+    return open(filepath, 'rb')
+
+
+def read_blocks(filepath: str, block_size: int = BLOCK_SIZE, offset: int = 0, position: dict = None,
+                whole_lines: bool = False, config: dict = None):
+    '''
+    Reading file in large binary blocks, gzip (also multi-member) is decompressed on the fly.
+    Reading starts at offset, which must be a line start or a gzip member start.
+    If position is given it is kept up to date: 'read' - bytes read from file, 'out' - bytes yielded,
+    'offset' - end of data it is safe to resume from (last complete line or gzip member).
+    With whole_lines trailing incomplete line of plain file is not yielded.
+    Gzip file with index (see gzip_indexed) is read as a plain one, offsets are uncompressed.
+    '''
+
+    if position is None:
+        position = dict()
+    position.update(offset=offset, read=0, out=0)
+
+    if filepath.split('.')[-1].lower() != 'gz' or gzip_indexed(filepath, config):
+        with open_log(filepath, config) as f:
+            f.seek(offset)
+            tail = b''
+            for block in iter(lambda: f.read(block_size), b''):
+                position['read'] += len(block)
+                if whole_lines:
+                    block = tail + block
+                    end = block.rfind(b'\n') + 1
+                    tail = block[end:]
+                    block = block[:end]
+                if block:
+                    position['offset'] += len(block)
+                    position['out'] += len(block)
+                    yield block
+        return
+
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        pending = False
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        for chunk in iter(lambda: f.read(block_size), b''):
+            position['read'] += len(chunk)
+            while chunk:
+                pending = True
+                block = decompressor.decompress(chunk)
+                if block:
+                    position['out'] += len(block)
+                    yield block
+                if decompressor.eof:
+                    chunk = decompressor.unused_data
+                    pending = False
+                    position['offset'] = offset + position['read'] - len(chunk)
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                else:
+                    chunk = b''
+
+        if pending:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def read_range_blocks(filepath: str, start: int, end: int, block_size: int = BLOCK_SIZE, config: dict = None):
+    '''Reading byte range [start, end) of uncompressed file (or gzip file with index) in large blocks. '''
+
+    with open_log(filepath, config) as f:
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            block = f.read(min(block_size, left))
+            if not block:
+                break
+            left -= len(block)
+            yield block
+
+
+def counted(items, count: list):
+    '''Yields items (blocks or lines), count[0] is kept at bytes of the items before the current one. '''
+
+    for item in items:
+        yield item
+        count[0] += len(item)
+
+
+def split_lines(blocks):
+    '''Splitting stream of binary blocks into lines without line endings. '''
+
+    tail = b''
+    for block in blocks:
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+
+    if tail:
+        yield tail
+
+
+class UrlNormalizer(object):
+    '''Collapsing ids, hashes and query strings of URL by compiled regex rules. '''
+
+    def __init__(self, rules: list):
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+
+    def __call__(self, url: str)->str:
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
+
+        return url
+
+
+FILTER_KEYS = ['URL_PREFIXES', 'URL_EXCLUDE_PREFIXES', 'URL_REGEX', 'URL_EXCLUDE_REGEX', 'METHODS', 'STATUS',
+               'TIME_WINDOW']
+
+CLOCK_RE = re.compile(r'^(\d\d):(\d\d)(?::(\d\d))?$')
+
+
+def parse_status_ranges(value: str)->frozenset:
+    '''Status codes of '200-299,404' as a set of 3-byte values. '''
+
+    codes = set()
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        try:
+            first, last = int(first), int(last or first)
+        except ValueError:
+            raise ValueError('Bad status range: {}'.format(item))
+        codes.update(b'%d' % code for code in range(max(first, 100), min(last, 999) + 1))
+
+    return frozenset(codes)
+
+
+def parse_time_window(value: str)->tuple:
+    '''(start, end) of 'HH:MM[:SS]-HH:MM[:SS]' as bytes comparable to HH:MM:SS of $time_local. '''
+
+    bounds = []
+    for item in value.split('-'):
+        m = CLOCK_RE.match(item.strip())
+        if not m:
+            raise ValueError('Bad time window: {}'.format(value))
+        bounds.append('{}:{}:{}'.format(m.group(1), m.group(2), m.group(3) or '00').encode())
+
+    if len(bounds) != 2:
+        raise ValueError('Bad time window: {}'.format(value))
+
+    return tuple(bounds)
+
+
+class LineFilter(object):
+    '''
+    Pre-check of undecoded lines against URL prefixes and regexes (include and exclude), methods,
+    status codes and time of day window. Only the fields which are checked are found, by find() and slicing,
+    before the line is matched. A line whose field can't be found is not rejected, it is left to the parser.
+    Prefixes and regexes apply to the raw URL, before normalization.
+    '''
+
+    def __init__(self, config: dict):
+        def prefixes(key):
+            values = config.get(key, None)
+            return tuple(x.encode('utf-8') for x in values) if values else None
+
+        def regex(key):
+            return re.compile(config[key].encode('utf-8')) if config.get(key, None) else None
+
+        self.prefixes = prefixes('URL_PREFIXES')
+        self.exclude_prefixes = prefixes('URL_EXCLUDE_PREFIXES')
+        self.url_re = regex('URL_REGEX')
+        self.exclude_re = regex('URL_EXCLUDE_REGEX')
+        self.methods = frozenset(x.encode('ascii') for x in config['METHODS']) if config.get('METHODS') else None
+        self.statuses = parse_status_ranges(config['STATUS']) if config.get('STATUS') else None
+        self.window = parse_time_window(config['TIME_WINDOW']) if config.get('TIME_WINDOW') else None
+
+        self.check_url = any(x is not None for x in [self.prefixes, self.exclude_prefixes, self.url_re,
+                                                     self.exclude_re])
+        self.check_request = self.check_url or self.methods is not None or self.statuses is not None
+
+    def out_of_window(self, clock: bytes)->bool:
+        start, end = self.window
+        if start <= end:
+            return not start <= clock < end
+
+        return end <= clock < start  # window over midnight
+
+    def url_rejected(self, url: bytes)->bool:
+        return (self.prefixes is not None and not url.startswith(self.prefixes)) or \
+            (self.exclude_prefixes is not None and url.startswith(self.exclude_prefixes)) or \
+            (self.url_re is not None and self.url_re.search(url) is None) or \
+            (self.exclude_re is not None and self.exclude_re.search(url) is not None)
+
+    def rejects(self, line: bytes)->bool:
+        '''Whether line is surely out of the filter. '''
+
+        if self.window is not None:
+            # [dd/Mon/yyyy:HH:MM:SS +zzzz]
+            start = line.find(b'[')
+            if start != -1 and line[start + 15:start + 16] == b':' and \
+                    self.out_of_window(line[start + 13:start + 21]):
+                return True
+
+        if not self.check_request:
+            return False
+
+        # "METHOD URL PROTOCOL" STATUS
+        request = line.find(b'"')
+        url_start = line.find(b' ', request + 1) + 1
+        request_end = line.find(b'"', url_start)
+        if request == -1 or not url_start or request_end == -1:
+            return False
+
+        if self.methods is not None and line[request + 1:url_start - 1] not in self.methods:
+            return True
+
+        if self.check_url:
+            url_end = line.find(b' ', url_start, request_end)
+            if self.url_rejected(line[url_start:request_end if url_end == -1 else url_end]):
+                return True
+
+        if self.statuses is not None:
+            status = line[request_end + 2:request_end + 5]
+            if status.isdigit() and status not in self.statuses:
+                return True
+
+        return False
+
+
+def make_filter(config: dict):
+    '''Creating line filter from config, returns None if every line is taken. '''
+
+    if not any(config.get(key, None) for key in FILTER_KEYS):
+        return None
+
+    return LineFilter(config)
+
+
+def make_normalizer(config: dict):
+    '''Creating URL normalizer from config, returns None if normalization is off. '''
+
+    names = config.get('NORMALIZE_URLS', None) or []
+    if 'all' in names:
+        names = [name for name, _, _ in URL_RULES]
+
+    unknown = set(names) - set(name for name, _, _ in URL_RULES)
+    if unknown:
+        raise ValueError('Unknown URL rules: {}'.format(', '.join(sorted(unknown))))
+
+    rules = [(pattern, replacement) for name, pattern, replacement in URL_RULES if name in names]
+
+    if config.get('URL_RULES_FILE', None):
+        with open(config['URL_RULES_FILE'], 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    pattern, _, replacement = line.strip().partition(' ')
+                    rules.append((pattern, replacement.strip()))
+
+    return UrlNormalizer(rules) if rules else None
+
+
+class Sampler(object):
+    '''
+    Full scan, optionally limited by MAX_LINES/MAX_SECONDS budget.
+    When budget is exhausted only a prefix of the log is read and coverage is its estimated share.
+    '''
+
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self.max_lines = int(config.get('MAX_LINES', 0) or 0)
+        self.max_seconds = float(config.get('MAX_SECONDS', 0) or 0)
+        self.budget = bool(self.max_lines or self.max_seconds)
+        self.deadline = None
+        self.exhausted = False
+        self.lines = 0  # lines read
+        self.parsed = 0  # lines given to the parser
+        self.bytes = 0  # bytes of lines read, counted only under budget
+        self.total = 0  # estimated bytes of the whole input, set when budget is exhausted
+
+    def start(self):
+        if self.max_seconds:
+            self.deadline = time.monotonic() + self.max_seconds
+
+    def stop(self, lineno: int)->bool:
+        '''Checking budget before reading line number lineno. '''
+
+        if self.max_lines and lineno > self.max_lines:
+            self.exhausted = True
+        elif self.deadline and not lineno & 1023 and time.monotonic() > self.deadline:
+            self.exhausted = True
+
+        return self.exhausted
+
+    def skip(self, lineno: int)->bool:
+        '''Whether line is left out of the sample before parsing. '''
+
+        return False
+
+    def hold(self, request_time: float, request_url: str, m)->bool:
+        '''Whether parsed line is kept by sampler to be released at the end. '''
+
+        return False
+
+    def release(self):
+        return iter(())
+
+    @property
+    def coverage(self)->float:
+        return min(1.0, self.bytes / self.total) if self.exhausted and self.total else 1.0
+
+    @property
+    def sample_fraction(self)->float:
+        '''Share of lines taken into aggregates from the lines read. '''
+
+        return 1.0
+
+    @property
+    def parse_fraction(self)->float:
+        '''Share of lines given to the parser from the lines read. '''
+
+        return self.parsed / self.lines if self.lines else 1.0
+
+    @property
+    def scale(self)->float:
+        '''Factor of counts and sums to estimate the whole log. '''
+
+        return 1 / (self.sample_fraction * self.coverage)
+
+    def merge(self, other: 'Sampler')->'Sampler':
+        self.exhausted = self.exhausted or other.exhausted
+        self.lines += other.lines
+        self.parsed += other.parsed
+        self.bytes += other.bytes
+        self.total += other.total or other.bytes
+
+        return self
+
+
+class EverySampler(Sampler):
+    '''Deterministic sample: every SAMPLING_STEP-th line. '''
+
+    def __init__(self, config: dict = None):
+        super().__init__(config)
+        self.step = int((config or {}).get('SAMPLING_STEP', 10) or 10)
+
+    def skip(self, lineno: int)->bool:
+        return lineno % self.step != 0
+
+    @property
+    def sample_fraction(self)->float:
+        return self.parsed / self.lines if self.lines else 1.0
+
+
+class ReservoirSampler(Sampler):
+    '''
+    Time-stratified reservoir sample of about RESERVOIR_SIZE lines spread over the whole log.
+    Every hour of $time_local has its own reservoir, at the end hours get shares of the sample
+    proportional to their traffic, so every sampled line has the same weight.
+    '''
+
+    def __init__(self, config: dict = None):
+        super().__init__(config)
+        self.size = int((config or {}).get('RESERVOIR_SIZE', 100000) or 100000)
+        self.strata = dict()  # hour -> [lines seen, reservoir]
+        self.selected = 0
+        self.valid = 0
+        self.random = random.Random(0)
+
+    def hold(self, request_time: float, request_url: str, m)->bool:
+        # strict match has $time_local in group 4, 'dd/Mon/yyyy:HH' is the stratum
+        stratum = m.group(4)[:14] if m.re is LINE_RE_B else None
+        val = self.strata.get(stratum, None)
+        if val is None:
+            val = self.strata[stratum] = [0, []]
+
+        val[0] += 1
+        if len(val[1]) < self.size:
+            val[1].append((request_time, request_url))
+        else:
+            i = self.random.randrange(val[0])
+            if i < self.size:
+                val[1][i] = (request_time, request_url)
+
+        return True
+
+    def allocate(self)->dict:
+        '''Number of sampled lines for every stratum, proportional to its lines count. '''
+
+        total = sum(val[0] for val in self.strata.values())
+        if total <= self.size:
+            return {stratum: val[0] for stratum, val in self.strata.items()}
+
+        return {stratum: min(len(val[1]), int(round(self.size * val[0] / total)))
+                for stratum, val in self.strata.items()}
+
+    def release(self):
+        self.valid = sum(val[0] for val in self.strata.values())
+        for stratum, count in self.allocate().items():
+            sample = self.strata[stratum][1]
+            if count < len(sample):
+                sample = self.random.sample(sample, count)
+            self.selected += len(sample)
+            yield from sample
+        self.strata = dict()
+
+    @property
+    def sample_fraction(self)->float:
+        return self.selected / self.valid if self.valid else 1.0
+
+    def merge(self, other: 'ReservoirSampler')->'ReservoirSampler':
+        super().merge(other)
+        self.selected += other.selected
+        self.valid += other.valid
+
+        return self
+
+
+SAMPLERS = {
+    'full': Sampler,
+    'every': EverySampler,
+    'reservoir': ReservoirSampler,
+}
+
+
+def make_sampler(config: dict):
+    '''Creating sampler of the configured kind. '''
+
+    kind = config.get('SAMPLING', 'full') or 'full'
+    if kind not in SAMPLERS:
+        raise ValueError('Unknown sampling mode: {}'.format(kind))
+
+    return SAMPLERS[kind](config)
+
+
+def parse_error_reason(line: bytes, strict: bool = False)->str:
+    '''Why line is not recognized, it is worked out only for lines which failed. '''
+
+    if not line.strip():
+        return 'empty'
+    if strict and LENIENT_LINE_RE_B.search(line):
+        return 'not_ui_short'
+    if not REQUEST_RE_B.search(line):
+        return 'no_request'
+
+    return 'no_request_time'
+
+
+class ParseErrors(object):
+    '''
+    Unrecognized lines: counts by reason and a bounded sample, the first PARSE_ERRORS_SAMPLE lines
+    and a reservoir of as many of the rest, so the summary is logged once instead of every line.
+    Parsing is aborted early only when the run is doomed: after MIN_LINES_CHECK lines, errors alone
+    leave less than MIN_LINES of the whole log even if all its other lines are recognized. Lines of the
+    whole log are estimated by progress, the share of it behind the lines counted so far, set by the reader;
+    without progress there is no early abort.
+    '''
+
+    max_line = 1000  # bytes of a sampled line
+
+    def __init__(self, config: dict = None, abort: bool = True):
+        config = config or {}
+        self.size = int(config.get('PARSE_ERRORS_SAMPLE', 5))
+        self.min_lines = float(config.get('MIN_LINES', 0.5) or 0) if abort else 0.0
+        self.check_after = int(config.get('MIN_LINES_CHECK', 10000))
+        self.count = 0
+        self.reasons = dict()
+        self.first = []
+        self.reservoir = []
+        self.seen = 0  # errors after the first ones
+        self.random = random.Random(0)
+        self.progress = None
+        self.others = (0, 0)  # errors and lines counted by other workers
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['progress'] = None  # callable of the reader is not passed between processes
+        state['others'] = (0, 0)
+
+        return state
+
+    def add(self, line: bytes, strict: bool = False, lines: int = 0):
+        '''Counting unrecognized line, lines is the number of lines given to the parser so far. '''
+
+        reason = parse_error_reason(line, strict)
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        self.count += 1
+        self.keep((reason, line[:self.max_line]))
+
+        if not self.min_lines or lines < self.check_after or self.progress is None:
+            return
+        share = self.progress()
+        count, lines = self.count + self.others[0], lines + self.others[1]
+        if share > 0 and count > lines / min(share, 1.0) * (1 - self.min_lines):
+            logging.error("Can't recognize {!s} of the first {!s} lines ({:.1%} of log), less than {!s} of log "
+                          "can be processed, parsing stopped. Please, consider changing MIN_LINES config's "
+                          "variable".format(count, lines, share, self.min_lines))
+            raise ValueError('Too many unrecognized lines: {!s} of {!s}'.format(count, lines))
+
+    def keep(self, sample: tuple):
+        if len(self.first) < self.size:
+            self.first.append(sample)
+            return
+
+        self.seen += 1
+        if len(self.reservoir) < self.size:
+            self.reservoir.append(sample)
+        else:
+            i = self.random.randrange(self.seen)
+            if i < self.size:
+                self.reservoir[i] = sample
+
+    def merge(self, other: 'ParseErrors')->'ParseErrors':
+        self.count += other.count
+        for reason, count in other.reasons.items():
+            self.reasons[reason] = self.reasons.get(reason, 0) + count
+
+        for sample in other.first:
+            self.keep(sample)
+
+        # reservoirs are merged slot by slot, proportionally to the lines they stand for
+        if other.seen:
+            total = self.seen + other.seen
+            a, b = list(self.reservoir), list(other.reservoir)
+            reservoir = []
+            while len(reservoir) < self.size and (a or b):
+                source = b if b and (not a or self.random.random() < other.seen / total) else a
+                reservoir.append(source.pop(self.random.randrange(len(source))))
+            self.reservoir = reservoir
+            self.seen = total
+
+        return self
+
+    def summary(self)->dict:
+        return {
+            'lines': self.count,
+            'reasons': dict(sorted(self.reasons.items(), key=lambda x: -x[1])),
+            'samples': [(reason, line.decode('utf-8', errors='replace').rstrip())
+                        for reason, line in self.first + self.reservoir],
+        }
+
+    def log(self, lines: int):
+        '''Logging summary of unrecognized lines of lines processed. '''
+
+        if not self.count:
+            return
+
+        summary = self.summary()
+        logging.error("Can't recognize %s of %s lines: %s" % (
+            self.count, lines, ', '.join('%s %s' % x for x in summary['reasons'].items())))
+        for reason, line in summary['samples']:
+            logging.error("Can't recognize line (%s): %s" % (reason, line))
+
+
+def peak_rss()->dict:
+    '''Peak resident set size in KB of the process and of its finished child processes. '''
+
+    if resource is None:
+        return {}
+
+    return {
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+class Profiler(object):
+    '''
+    Wall and CPU time of run stages with lines and bytes they handled.
+    Time of a stage entered inside another one is not counted in the outer stage.
+    '''
+
+    def __init__(self):
+        self.stages = dict()  # name -> {'wall', 'cpu', 'lines', 'bytes'}
+        self.stack = []  # [wall, cpu, nested wall, nested cpu] of entered stages
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def get(self, name: str)->dict:
+        stage = self.stages.get(name, None)
+        if stage is None:
+            stage = self.stages[name] = Profiler.empty()
+
+        return stage
+
+    @staticmethod
+    def empty()->dict:
+        return {'wall': 0.0, 'cpu': 0.0, 'lines': 0, 'bytes': 0}
+
+    @contextmanager
+    def stage(self, name: str):
+        frame = [time.perf_counter(), time.process_time(), 0.0, 0.0]
+        self.stack.append(frame)
+        try:
+            yield self.get(name)
+        finally:
+            self.stack.pop()
+            wall = time.perf_counter() - frame[0]
+            cpu = time.process_time() - frame[1]
+            stage = self.get(name)
+            stage['wall'] += wall - frame[2]
+            stage['cpu'] += cpu - frame[3]
+            if self.stack:
+                self.stack[-1][2] += wall
+                self.stack[-1][3] += cpu
+
+    def wrap(self, name: str, iterable):
+        '''Yields items of iterable, time of producing them goes to stage name. '''
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def summary(self)->dict:
+        stages = dict()
+        for name, stage in self.stages.items():
+            wall = stage['wall']
+            stages[name] = {
+                'wall': round(wall, 6),
+                'cpu': round(stage['cpu'], 6),
+                'lines': stage['lines'],
+                'bytes': stage['bytes'],
+                'lines_per_sec': round(stage['lines'] / wall) if wall and stage['lines'] else None,
+                'mb_per_sec': round(stage['bytes'] / 1024 / 1024 / wall, 3) if wall and stage['bytes'] else None,
+            }
+
+        summary = {
+            'wall': round(time.perf_counter() - self.wall, 6),
+            'cpu': round(time.process_time() - self.cpu, 6),
+            'stages': stages,
+        }
+        summary.update(peak_rss())
+
+        return summary
+
+
+def profile_stage(profiler: Profiler, name: str):
+    '''Stage of profiler or a no-op context when run is not profiled. '''
+
+    return nullcontext(Profiler.empty()) if profiler is None else profiler.stage(name)
+
+
+def parse_lines(lines, acc: list, strict: bool = False, sampler: Sampler = None, normalize=None,
+                cache_size: int = 1000000, collectors: list = None, errors: ParseErrors = None,
+                line_filter: LineFilter = None):
+    '''
+    Matching binary lines, yields (request_time, request_url).
+    URL is decoded and normalized only once per distinct raw value, up to cache_size values are remembered.
+    Every collector gets collect(m, request_time, request_url) for lines which match ui_short completely.
+    Unrecognized lines are counted by errors. Lines rejected by line_filter are not counted at all,
+    only their bytes are read under sampling budget.
+    '''
+
+    urls = dict()
+    line_match = LINE_RE_B.match
+    lenient_search = None if strict else LENIENT_LINE_RE_B.search
+    first = acc[0]
+
+    if sampler is not None:
+        sampler.start()
+
+    for line in lines:
+        if line_filter is not None and line_filter.rejects(line):
+            if sampler is not None and sampler.budget:
+                sampler.bytes += len(line) + 1
+            continue
+
+        acc[0] += 1
+
+        if sampler is not None:
+            lineno = acc[0] - first
+            if sampler.stop(lineno):
+                acc[0] -= 1
+                break
+            sampler.lines += 1
+            if sampler.budget:
+                sampler.bytes += len(line) + 1
+            if sampler.skip(lineno):
+                continue
+            sampler.parsed += 1
+
+        m = line_match(line)
+        if m:
+            raw_url, request_time = m.group(6, 15)
+        else:
+            m = lenient_search(line) if lenient_search else None
+            if not m:
+                if errors is not None:
+                    errors.add(line, strict, acc[0] if sampler is None else sampler.parsed)
+                continue
+            raw_url, request_time = m.group(2, 3)
+
+        request_time = float(request_time)
+        if not request_time:  # zero request_time lines have never been aggregated
+            continue
+
+        request_url = urls.get(raw_url, None)
+        if request_url is None:
+            if len(urls) >= cache_size:
+                urls.clear()
+            request_url = raw_url.decode('utf-8', errors='replace')
+            if normalize is not None:
+                request_url = normalize(request_url)
+            urls[raw_url] = request_url
+
+        if collectors and m.re is not LENIENT_LINE_RE_B:
+            for collector in collectors:
+                collector.collect(m, request_time, request_url)
+
+        if sampler is not None and sampler.hold(request_time, request_url, m):
+            continue
+
+        yield request_time, request_url
+
+    if sampler is not None:
+        yield from sampler.release()
+
+
+def scan_mapped(filepath: str, acc: list, strict: bool = False, normalize=None, cache_size: int = 1000000,
+                start: int = 0, end: int = None, collectors: list = None, errors: ParseErrors = None):
+    '''
+    Matching lines of uncompressed file [start, end) right in its memory map, yields (request_time, request_url).
+    Line objects are not created, only lines which don't match ui_short go through parse_lines.
+    '''
+
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if end <= start:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            urls = dict()
+            search = MAPPED_LINE_RE_B.search
+            prev = pos = start
+            chunk = [0]  # bytes of unmatched lines given to parse_lines from prev
+            if errors is not None:
+                errors.progress = lambda: (prev - start + chunk[0]) / size
+
+            while pos < end:
+                m = search(mm, pos, end)
+                if m is None:
+                    break
+
+                line_start, line_end = m.span()
+                if line_start > prev:
+                    chunk[0] = 0
+                    yield from parse_lines(counted(mm[prev:line_start - 1].split(b'\n'), chunk), acc, strict,
+                                           None, normalize, cache_size, collectors, errors)
+                    chunk[0] = 0
+                prev = pos = line_end + 1
+                acc[0] += 1
+
+                request_time = float(m.group(15))
+                if not request_time:  # zero request_time lines have never been aggregated
+                    continue
+
+                raw_url = m.group(6)
+                request_url = urls.get(raw_url, None)
+                if request_url is None:
+                    if len(urls) >= cache_size:
+                        urls.clear()
+                    request_url = raw_url.decode('utf-8', errors='replace')
+                    if normalize is not None:
+                        request_url = normalize(request_url)
+                    urls[raw_url] = request_url
+
+                if collectors:
+                    for collector in collectors:
+                        collector.collect(m, request_time, request_url)
+
+                yield request_time, request_url
+
+            if prev < end:
+                chunk[0] = 0
+                yield from parse_lines(counted(split_lines([mm[prev:end]]), chunk), acc, strict, None, normalize,
+                                       cache_size, collectors, errors)
+
+
+def can_scan_mapped(filepath: str, sampler: Sampler = None, line_filter: LineFilter = None)->bool:
+    '''
+    Whether log file can be read through scan_mapped: uncompressed, without sampling and filter
+    (filtered lines are rejected by the pre-check before the regex, which scan_mapped runs on every line).
+    '''
+
+    return filepath.split('.')[-1].lower() != 'gz' and line_filter is None and \
+        (sampler is None or (type(sampler) is Sampler and not sampler.budget))
+
+
+class RawUrlIds(dict):
+    '''Raw URL -> id of URL in aggregator, a URL is decoded and normalized only once per raw value. '''
+
+    def __init__(self, url_id, normalize=None):
+        super().__init__()
+        self.url_id = url_id
+        self.normalize = normalize
+
+    def __missing__(self, raw_url: bytes)->int:
+        request_url = raw_url.decode('utf-8', errors='replace')
+        if self.normalize is not None:
+            request_url = self.normalize(request_url)
+        url_id = self[raw_url] = self.url_id(request_url)
+
+        return url_id
+
+
+def parse_chunks(blocks, acc: list, ids: RawUrlIds, cache_size: int = 1000000, errors: ParseErrors = None):
+    '''
+    Matching blocks of whole lines at once for the numpy engine, yields (url ids, request times) arrays per block.
+    Parsing is lenient; a block where some line doesn't match goes through parse_lines line by line,
+    so unrecognized lines are counted as usual.
+    '''
+
+    findall = CHUNK_LINE_RE_B.findall
+    for batch in line_batches(blocks):
+        if len(ids) >= cache_size:
+            ids.clear()
+
+        lines = batch.count(b'\n') + (not batch.endswith(b'\n'))
+        pairs = findall(batch)
+        if len(pairs) == lines:
+            acc[0] += lines
+            raw_urls, times = zip(*pairs)
+            url_ids = np.fromiter(map(ids.__getitem__, raw_urls), np.int64, lines)
+            times = np.array(times).astype(np.float64)
+        else:
+            records = list(parse_lines(split_lines([batch]), acc, False, None, ids.normalize, cache_size, None, errors))
+            url_ids = np.fromiter((ids.url_id(request_url) for _, request_url in records), np.int64, len(records))
+            times = np.fromiter((request_time for request_time, _ in records), np.float64, len(records))
+
+        if not times.all():  # zero request_time lines have never been aggregated
+            url_ids, times = url_ids[times != 0], times[times != 0]
+        if len(times):
+            yield url_ids, times
+
+
+def can_parse_chunks(res, strict: bool = False, sampler: Sampler = None, collectors: list = None,
+                     line_filter: LineFilter = None)->bool:
+    '''
+    Whether lines can be parsed by blocks with parse_chunks: numpy engine, lenient parsing,
+    no per-line collectors, filter or sampling.
+    '''
+
+    return isinstance(res, NumpyAggregator) and not strict and not collectors and line_filter is None and \
+        (sampler is None or (type(sampler) is Sampler and not sampler.budget))
+
+
+def process_log_chunks(filepath: str, acc: list, ids: RawUrlIds, cache_size: int = 1000000,
+                       profiler: Profiler = None, errors: ParseErrors = None):
+    '''Gathering (url ids, request times) arrays from log file with parse_chunks. '''
+
+    try:
+        logging.info('open log file %s' % filepath)
+
+        position = dict()
+        blocks = read_blocks(filepath, position=position)
+        if errors is not None:
+            size = os.path.getsize(filepath)
+            errors.progress = lambda: max(0, position['read'] - BLOCK_SIZE) / size if size else 0.0
+        if profiler is not None:
+            blocks = profiler.wrap('read', blocks)
+        yield from parse_chunks(blocks, acc, ids, cache_size, errors)
+
+        if profiler is not None:
+            profiler.get('read')['bytes'] += position['out']
+            profiler.get('parse')['bytes'] += position['out']
+
+        logging.info('close log file')
+
+    except Exception as e:
+        logging.error(repr(e))
+        raise
+
+
+def process_log_file(filepath: str, acc: list, strict: bool = False, sampler: Sampler = None, normalize=None,
+                     cache_size: int = 1000000, use_mmap: bool = True, collectors: list = None,
+                     profiler: Profiler = None, errors: ParseErrors = None, line_filter: LineFilter = None):
+    '''Gathering data from log file, lines rejected by line_filter are skipped before they are matched. '''
+        
+    try:
+        logging.info('open log file %s' % filepath)
+
+        if use_mmap and can_scan_mapped(filepath, sampler, line_filter):
+            yield from scan_mapped(filepath, acc, strict, normalize, cache_size, collectors=collectors, errors=errors)
+            if profiler is not None:
+                profiler.get('parse')['bytes'] += os.path.getsize(filepath)
+            logging.info('close log file')
+            return
+
+        position = dict()
+        blocks = read_blocks(filepath, position=position)
+        if errors is not None:
+            # a block of the file read is still being parsed, so the share is at least one block behind
+            size = os.path.getsize(filepath)
+            errors.progress = lambda: max(0, position['read'] - BLOCK_SIZE) / size if size else 0.0
+        if profiler is not None:
+            blocks = profiler.wrap('read', blocks)
+        yield from parse_lines(split_lines(blocks), acc, strict, sampler, normalize, cache_size, collectors, errors,
+                               line_filter)
+
+        if profiler is not None:
+            profiler.get('read')['bytes'] += position['out']
+            profiler.get('parse')['bytes'] += position['out']
+
+        if sampler is not None and sampler.exhausted:
+            # uncompressed size of gzip is estimated by compression ratio of the part read
+            ratio = position['out'] / position['read'] if position['read'] else 1.0
+            sampler.total = int(os.path.getsize(filepath) * ratio)
+            logging.info('Sampling budget exhausted, %.1f%% of log file read' % (sampler.coverage * 100))
+
+        logging.info('close log file') 
+        
+    except Exception as e:
+        logging.error(repr(e))
+        raise         
+
+
+def split_file(filepath: str, parts: int, config: dict = None)->list:
+    '''Splitting file (or gzip file with index) into byte ranges aligned to line boundaries. '''
+
+    bounds = [0]
+
+    with open_log(filepath, config) as f:
+        size = f.seek(0, os.SEEK_END)
+        for i in range(1, parts):
+            pos = size * i // parts
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+
+    bounds.append(size)
+
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+class ListAggregator(object):
+    '''Exact per-URL aggregate: every request_time is kept. '''
+
+    url_bytes, value_bytes = 400, 32  # estimated memory of a URL and of a request_time
+
+    def __init__(self, config: dict = None):
+        self.res = dict()
+
+    def __len__(self):
+        return len(self.res)
+
+    def add(self, request_url: str, request_time: float):
+        res = self.res
+        if not res.get(request_url, None):
+            res[request_url] = dict()
+            res[request_url]['counter'] = 0
+            res[request_url]['times'] = []
+
+        res[request_url]['counter'] += 1
+        res[request_url]['times'].append(request_time)
+
+    def merge(self, other: 'ListAggregator')->'ListAggregator':
+        res = self.res
+        for request_url, val in other.res.items():
+            if not res.get(request_url, None):
+                res[request_url] = val
+            else:
+                res[request_url]['counter'] += val['counter']
+                res[request_url]['times'].extend(val['times'])
+
+        return self
+
+    def total_requests(self)->int:
+        return reduce(lambda a, x: a + x['counter'], self.res.values(), 0)
+
+    def total_time(self)->float:
+        return reduce(lambda a, x: a + sum(x['times']), self.res.values(), 0)
+
+    def time_sums(self):
+        return ((req, sum(val['times'])) for req, val in self.res.items())
+
+    def to_sketch(self, config: dict = None)->'SketchAggregator':
+        sketch = SketchAggregator(config)
+        for req, val in self.res.items():
+            for request_time in val['times']:
+                sketch.add(req, request_time)
+
+        return sketch
+
+    def stats(self, quantiles=(), urls=None):
+        '''
+        Yields (url, counter, time_sum, time_max, time_med, [values of quantiles], {extra columns})
+        for given urls or for all of them.
+        '''
+
+        for req in self.res if urls is None else urls:
+            val = self.res[req]
+            times = val['times']
+            if quantiles:
+                ordered = sorted(times)
+                qs = [ordered[min(int(q * len(ordered)), len(ordered) - 1)] for q in quantiles]
+            else:
+                qs = []
+            yield req, val['counter'], sum(times), max(times), median(times), qs, {}
+
+
+def select_kth(values: list, k: int)->float:
+    '''k-th smallest value (0-based) by quickselect, without sorting the whole list. '''
+
+    while len(values) > 32:
+        pivot = sorted((values[0], values[len(values) // 2], values[-1]))[1]
+        lows = [x for x in values if x < pivot]
+        if k < len(lows):
+            values = lows
+            continue
+        highs = [x for x in values if x > pivot]
+        pivots = len(values) - len(lows) - len(highs)
+        if k < len(lows) + pivots:
+            return pivot
+        k -= len(lows) + pivots
+        values = highs
+
+    return sorted(values)[k]
+
+
+def select_median(values)->float:
+    '''Median equal to statistics.median, found by selection. '''
+
+    values = list(values)
+    n = len(values)
+    if n % 2:
+        return select_kth(values, n // 2)
+
+    return (select_kth(values, n // 2 - 1) + select_kth(values, n // 2)) / 2
+
+
+def select_ranks(values: array, ranks: list)->list:
+    '''
+    Values of 0-based ranks (in the order of ranks) by quickselect of all ranks at once, without sorting.
+    Parts are packed into array('d'), 8 bytes a value, values itself is not copied.
+    '''
+
+    found = dict()
+    stack = [(values, sorted(set(ranks)), 0)]  # part, ranks in it, rank of its first value
+    while stack:
+        part, ks, offset = stack.pop()
+        if len(part) <= 32:
+            ordered = sorted(part)
+            for k in ks:
+                found[k] = ordered[k - offset]
+            continue
+
+        pivot = sorted((part[0], part[len(part) // 2], part[-1]))[1]
+        lows = array('d', (x for x in part if x < pivot))
+        pivots = part.count(pivot)
+        high = offset + len(lows) + pivots  # rank of the first value above pivot
+
+        low_ks = [k for k in ks if k < offset + len(lows)]
+        high_ks = [k for k in ks if k >= high]
+        for k in ks:
+            if offset + len(lows) <= k < high:
+                found[k] = pivot
+        if high_ks:
+            stack.append((array('d', (x for x in part if x > pivot)), high_ks, high))
+        if low_ks:
+            stack.append((lows, low_ks, offset))
+
+    return [found[k] for k in ranks]
+
+
+class PackedAggregator(object):
+    '''Exact per-URL aggregate with URLs interned to ids and times packed into array('d'). '''
+
+    url_bytes, value_bytes = 280, 8
+
+    def __init__(self, config: dict = None):
+        self.ids = dict()
+        self.urls = []
+        self.times = []
+
+    def __len__(self):
+        return len(self.urls)
+
+    def add(self, request_url: str, request_time: float):
+        url_id = self.ids.get(request_url, None)
+        if url_id is None:
+            url_id = self.ids[request_url] = len(self.urls)
+            self.urls.append(request_url)
+            self.times.append(array('d'))
+
+        self.times[url_id].append(request_time)
+
+    def merge(self, other: 'PackedAggregator')->'PackedAggregator':
+        for request_url, times in zip(other.urls, other.times):
+            url_id = self.ids.get(request_url, None)
+            if url_id is None:
+                self.ids[request_url] = len(self.urls)
+                self.urls.append(request_url)
+                self.times.append(times)
+            else:
+                self.times[url_id].extend(times)
+
+        return self
+
+    def total_requests(self)->int:
+        return sum(len(times) for times in self.times)
+
+    def total_time(self)->float:
+        return reduce(lambda a, x: a + sum(x), self.times, 0)
+
+    def time_sums(self):
+        return ((req, sum(times)) for req, times in zip(self.urls, self.times))
+
+    def to_sketch(self, config: dict = None)->'SketchAggregator':
+        sketch = SketchAggregator(config)
+        for req, times in zip(self.urls, self.times):
+            for request_time in times:
+                sketch.add(req, request_time)
+
+        return sketch
+
+    def stats(self, quantiles=(), urls=None):
+        '''
+        Yields (url, counter, time_sum, time_max, time_med, [values of quantiles], {extra columns})
+        for given urls or for all of them.
+        '''
+
+        for req in self.urls if urls is None else urls:
+            times = self.times[self.ids[req]]
+            count = len(times)
+            ranks = [(count - 1) // 2, count // 2] + [min(int(q * count), count - 1) for q in quantiles]
+            values = select_ranks(times, ranks)
+            yield req, count, sum(times), max(times), (values[0] + values[1]) / 2, values[2:], {}
+
+
+class NumpyAggregator(object):
+    '''
+    Exact per-URL aggregate of the numpy engine: (url_id, request_time) pairs are packed into chunks of
+    NumPy arrays, counts, sums and maximums of all URLs are computed at once by bincount and maximum.at,
+    medians and quantiles by partition of url segments of times argsorted by url_id.
+    Chunks usually come straight from parse_chunks via add_chunk, add is left for the per-line paths.
+    '''
+
+    CHUNK = 1 << 16
+    url_bytes, value_bytes = 200, 16
+
+    def __init__(self, config: dict = None):
+        self.ids = dict()
+        self.urls = []
+        self.id_chunks = []
+        self.time_chunks = []
+        self.pending_ids = array('q')
+        self.pending_times = array('d')
+
+    def __len__(self):
+        return len(self.urls)
+
+    def url_id(self, request_url: str)->int:
+        url_id = self.ids.get(request_url, None)
+        if url_id is None:
+            url_id = self.ids[request_url] = len(self.urls)
+            self.urls.append(request_url)
+
+        return url_id
+
+    def add(self, request_url: str, request_time: float):
+        self.pending_ids.append(self.url_id(request_url))
+        self.pending_times.append(request_time)
+        if len(self.pending_ids) >= self.CHUNK:
+            self.flush()
+
+    def add_chunk(self, ids, times):
+        '''Adding arrays of url ids and request times at once, e.g. from parse_chunks. '''
+
+        self.flush()
+        self.id_chunks.append(ids)
+        self.time_chunks.append(times)
+
+    def flush(self):
+        '''Moving pending pairs into a chunk. '''
+
+        if self.pending_ids:
+            self.id_chunks.append(np.frombuffer(self.pending_ids, dtype=np.int64))
+            self.time_chunks.append(np.frombuffer(self.pending_times, dtype=np.float64))
+            self.pending_ids = array('q')
+            self.pending_times = array('d')
+
+    def columns(self)->tuple:
+        '''All url ids and request times as two arrays. '''
+
+        self.flush()
+        if len(self.id_chunks) != 1:
+            self.id_chunks = [np.concatenate(self.id_chunks) if self.id_chunks else np.zeros(0, np.int64)]
+            self.time_chunks = [np.concatenate(self.time_chunks) if self.time_chunks else np.zeros(0)]
+
+        return self.id_chunks[0], self.time_chunks[0]
+
+    def merge(self, other: 'NumpyAggregator')->'NumpyAggregator':
+        self.flush()
+        other.flush()
+        mapping = np.array([self.url_id(request_url) for request_url in other.urls], dtype=np.int64)
+        for ids, times in zip(other.id_chunks, other.time_chunks):
+            self.id_chunks.append(mapping[ids])
+            self.time_chunks.append(times)
+
+        return self
+
+    def sums(self):
+        ids, times = self.columns()
+
+        return np.bincount(ids, weights=times, minlength=len(self.urls))
+
+    def total_requests(self)->int:
+        return len(self.columns()[0])
+
+    def total_time(self)->float:
+        return sum(self.sums().tolist())
+
+    def time_sums(self):
+        return zip(self.urls, self.sums().tolist())
+
+    def to_sketch(self, config: dict = None)->'SketchAggregator':
+        sketch = SketchAggregator(config)
+        ids, times = self.columns()
+        for url_id, request_time in zip(ids.tolist(), times.tolist()):
+            sketch.add(self.urls[url_id], request_time)
+
+        return sketch
+
+    def stats(self, quantiles=(), urls=None):
+        '''
+        Yields (url, counter, time_sum, time_max, time_med, [values of quantiles], {extra columns})
+        for given urls or for all of them.
+        '''
+
+        ids, times = self.columns()
+        n = len(self.urls)
+
+        counts = np.bincount(ids, minlength=n)
+        sums = np.bincount(ids, weights=times, minlength=n)
+        maxs = np.full(n, -np.inf)
+        np.maximum.at(maxs, ids, times)
+
+        # times grouped by url, every url is a segment starting at starts[url_id]
+        grouped = times[np.argsort(ids, kind='stable')]
+        starts = (np.cumsum(counts) - counts).tolist()
+
+        counts, sums, maxs = counts.tolist(), sums.tolist(), maxs.tolist()
+        for url_id in range(n) if urls is None else [self.ids[req] for req in urls]:
+            count = counts[url_id]
+            ranks = [(count - 1) // 2, count // 2] + [min(int(q * count), count - 1) for q in quantiles]
+            segment = np.partition(grouped[starts[url_id]:starts[url_id] + count], sorted(set(ranks)))
+            values = segment[ranks].tolist()
+            yield (self.urls[url_id], count, sums[url_id], maxs[url_id], (values[0] + values[1]) / 2, values[2:], {})
+
+
+class SketchAggregator(object):
+    '''Bounded-memory per-URL aggregate: count, sum, max and a KLL quantile sketch. '''
+
+    url_bytes, value_bytes = 500, 32  # values are bounded by the sketch size, so it is an upper estimate
+
+    def __init__(self, config: dict = None):
+        self.accuracy = float((config or {}).get('SKETCH_ACCURACY', 0.01))
+        self.res = dict()
+
+    def __len__(self):
+        return len(self.res)
+
+    def summary(self):
+        '''Empty per-URL distribution summary. '''
+
+        return KLLSketch(self.accuracy)
+
+    def add(self, request_url: str, request_time: float):
+        val = self.res.get(request_url, None)
+        if val is None:
+            val = self.res[request_url] = [0, 0.0, request_time, self.summary()]
+
+        val[0] += 1
+        val[1] += request_time
+        if request_time > val[2]:
+            val[2] = request_time
+        val[3].update(request_time)
+
+    def merge(self, other: 'SketchAggregator')->'SketchAggregator':
+        for request_url, part in other.res.items():
+            val = self.res.get(request_url, None)
+            if val is None:
+                self.res[request_url] = part
+            else:
+                val[0] += part[0]
+                val[1] += part[1]
+                val[2] = max(val[2], part[2])
+                val[3].merge(part[3])
+
+        return self
+
+    def total_requests(self)->int:
+        return sum(val[0] for val in self.res.values())
+
+    def total_time(self)->float:
+        return sum(val[1] for val in self.res.values())
+
+    def time_sums(self):
+        return ((req, val[1]) for req, val in self.res.items())
+
+    def to_sketch(self, config: dict = None)->'SketchAggregator':
+        return self
+
+    def stats(self, quantiles=(), urls=None):
+        '''
+        Yields (url, counter, time_sum, time_max, time_med, [values of quantiles], {extra columns})
+        for given urls or for all of them.
+        '''
+
+        for req in self.res if urls is None else urls:
+            counter, time_sum, time_max, sketch = self.res[req]
+            qs = sketch.quantiles([0.5] + list(quantiles))
+            yield req, counter, time_sum, time_max, qs[0], qs[1:], {}
+
+
+class HistogramAggregator(SketchAggregator):
+    '''
+    Bounded-memory per-URL aggregate: count, sum, max and a log-linear histogram
+    with HISTOGRAM_PRECISION relative error, reports p90/p95/p99 unless QUANTILES are set.
+    '''
+
+    default_quantiles = [0.9, 0.95, 0.99]
+
+    url_bytes, value_bytes = 560, 48
+
+    def __init__(self, config: dict = None):
+        super().__init__(config)
+        self.precision = float((config or {}).get('HISTOGRAM_PRECISION', 0.01))
+
+    def summary(self):
+        return LogHistogram(self.precision)
+
+
+class TopKAggregator(object):
+    '''
+    Bounded-memory aggregate of TOPK_SIZE URLs with the largest time_sum (Space-Saving).
+    time_sum of a URL is overestimated by at most time_sum_topk_err, count, max and quantiles
+    of a URL cover only the requests since it was last taken into the table, so its average is computed
+    from the time of these requests and count_perc is unknown when time_sum_topk_err isn't zero.
+    '''
+
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self.k = int(config.get('TOPK_SIZE', 0) or 10 * int(config.get('REPORT_SIZE', 1000)))
+        self.accuracy = float(config.get('SKETCH_ACCURACY', 0.01))
+        self.counters = SpaceSaving(self.k)
+        self.requests = 0
+        self.time = 0.0
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, request_url: str, request_time: float):
+        self.requests += 1
+        self.time += request_time
+
+        item = self.counters.update(request_url, request_time)
+        val = item[2]
+        if val is None:
+            val = item[2] = [0, request_time, KLLSketch(self.accuracy), 0.0]
+        val[0] += 1
+        if request_time > val[1]:
+            val[1] = request_time
+        val[2].update(request_time)
+        val[3] += request_time
+
+    @staticmethod
+    def merge_payload(val, part):
+        val[0] += part[0]
+        val[1] = max(val[1], part[1])
+        val[2].merge(part[2])
+        val[3] += part[3]
+
+        return val
+
+    def merge(self, other: 'TopKAggregator')->'TopKAggregator':
+        self.requests += other.requests
+        self.time += other.time
+        self.counters.merge(other.counters, self.merge_payload)
+
+        return self
+
+    def total_requests(self)->int:
+        return self.requests
+
+    def total_time(self)->float:
+        return self.time
+
+    def time_sums(self):
+        return ((req, item[0]) for req, item in self.counters.items.items())
+
+    def to_sketch(self, config: dict = None)->'SketchAggregator':
+        '''Sketch of the counted requests only, so count and sum of a URL agree. '''
+
+        sketch = SketchAggregator(config)
+        sketch.res = {req: [counter, time_counted, time_max, kll]
+                      for req, (_, _, (counter, time_max, kll, time_counted)) in self.counters.items.items()}
+
+        return sketch
+
+    def stats(self, quantiles=(), urls=None):
+        '''
+        Yields (url, counter, time_sum, time_max, time_med, [values of quantiles], {extra columns})
+        for given urls or for all of them.
+        '''
+
+        for req in self.counters.items if urls is None else urls:
+            time_sum, error, (counter, time_max, sketch, time_counted) = self.counters.items[req]
+            qs = sketch.quantiles([0.5] + list(quantiles))
+            yield req, counter, time_sum, time_max, qs[0], qs[1:], {'time_sum_topk_err': error,
+                                                                    'time_sum_counted': time_counted}
+
+
+def remove_spill_dirs(dirs: list):
+    for path in dirs:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class SpillAggregator(object):
+    '''
+    Memory-bounded aggregate: URLs are hash-partitioned into SPILL_PARTITIONS aggregates of the configured kind.
+    When their estimated memory reaches MEMORY_BUDGET, every partition is appended to its file and freed.
+    Partitions are merged one at a time when the report is built, so peak memory is about the budget
+    or the largest partition, whichever is bigger.
+    Spilled files belong to one object, a pickled copy takes them over (e.g. a worker's aggregate).
+    '''
+
+    CHECK_EVERY = 8192  # adds between memory estimates
+
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self.config = dict(config, MEMORY_BUDGET=0)  # config of partitions
+        self.budget = float(config.get('MEMORY_BUDGET', 0) or 0) * (1 << 20)
+        self.partitions = int(config.get('SPILL_PARTITIONS', 64) or 64)
+        self.spill_root = config.get('SPILL_DIR', None)
+        self.parts = [make_aggregator(self.config) for _ in range(self.partitions)]
+        self.files = [[] for _ in range(self.partitions)]  # spilled files of every partition
+        self.dirs = []  # spill directories owned by this object
+        self.directory = None
+        self.requests = 0
+        self.time = 0.0
+        self.values = 0  # request times in memory
+        self.spilled_urls = 0
+        self.finalizer = weakref.finalize(self, remove_spill_dirs, self.dirs)
+
+        part = self.parts[0]
+        self.url_bytes, self.value_bytes = part.url_bytes, part.value_bytes
+        if hasattr(part, 'default_quantiles'):
+            self.default_quantiles = part.default_quantiles
+
+    def __getstate__(self):
+        self.finalizer.detach()
+        state = dict(self.__dict__)
+        del state['finalizer']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.finalizer = weakref.finalize(self, remove_spill_dirs, self.dirs)
+
+    def __len__(self):
+        '''URLs in memory and spilled, a URL spilled several times is counted every time. '''
+
+        return sum(len(part) for part in self.parts) + self.spilled_urls
+
+    def partition(self, request_url: str)->int:
+        # crc32 is the same in every process, unlike hash() of str
+        return zlib.crc32(request_url.encode('utf-8', errors='replace')) % self.partitions
+
+    def memory(self)->int:
+        '''Estimated bytes of partitions in memory. '''
+
+        return sum(len(part) for part in self.parts) * self.url_bytes + self.values * self.value_bytes
+
+    def add(self, request_url: str, request_time: float):
+        self.parts[self.partition(request_url)].add(request_url, request_time)
+        self.requests += 1
+        self.time += request_time
+        self.values += 1
+        if not self.values % self.CHECK_EVERY and self.memory() >= self.budget:
+            self.spill()
+
+    def merge(self, other: 'SpillAggregator')->'SpillAggregator':
+        for part, other_part in zip(self.parts, other.parts):
+            part.merge(other_part)
+        for files, other_files in zip(self.files, other.files):
+            files.extend(other_files)
+
+        # spilled files of other are removed with this object
+        self.dirs.extend(other.dirs)
+        del other.dirs[:]
+
+        self.requests += other.requests
+        self.time += other.time
+        self.values += other.values
+        self.spilled_urls += other.spilled_urls
+        if self.memory() >= self.budget:
+            self.spill()
+
+        return self
+
+    def spill_dir(self)->str:
+        if self.directory is None:
+            self.directory = mkdtemp(prefix='log_analyzer-spill-', dir=self.spill_root)
+            self.dirs.append(self.directory)
+
+        return self.directory
+
+    def spill(self):
+        '''Appending every partition in memory to its file. '''
+
+        memory = self.memory()
+        directory = self.spill_dir()
+        for i, part in enumerate(self.parts):
+            if not len(part):
+                continue
+            path = os.path.join(directory, 'part-%04d.pkl' % i)
+            with open(path, 'ab') as f:
+                pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if path not in self.files[i]:
+                self.files[i].append(path)
+            self.spilled_urls += len(part)
+            self.parts[i] = make_aggregator(self.config)
+
+        self.values = 0
+        logging.info('Memory budget reached, %.1f MB of aggregates spilled to %s' % (memory / (1 << 20), directory))
+
+    def load(self, i: int):
+        '''Partition i with all its spilled parts merged, the result is written back as a single part. '''
+
+        if not self.files[i]:
+            return self.parts[i]
+
+        merged = None
+        for path in self.files[i]:
+            with open(path, 'rb') as f:
+                while True:
+                    try:
+                        part = pickle.load(f)
+                    except EOFError:
+                        break
+                    merged = part if merged is None else merged.merge(part)
+        merged.merge(self.parts[i])
+        self.parts[i] = make_aggregator(self.config)
+
+        path = os.path.join(self.spill_dir(), 'part-%04d.pkl' % i)
+        with NamedTemporaryFile('wb', dir=self.spill_dir(), delete=False) as f:
+            pickle.dump(merged, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+        for old in self.files[i]:
+            if old != path:
+                os.remove(old)
+        self.files[i] = [path]
+
+        memory = len(merged) * self.url_bytes + merged.total_requests() * self.value_bytes
+        if memory > self.budget:
+            logging.info('Partition %s takes %.1f MB, more than memory budget, consider more SPILL_PARTITIONS' % (
+                i, memory / (1 << 20)))
+
+        return merged
+
+    def loaded(self, indexes=None):
+        '''Yields merged partitions one at a time, memory is spilled first when there are spilled parts. '''
+
+        if self.values and any(self.files):
+            self.spill()
+
+        for i in range(self.partitions) if indexes is None else indexes:
+            yield self.load(i)
+
+    def total_requests(self)->int:
+        return self.requests
+
+    def total_time(self)->float:
+        return self.time
+
+    def time_sums(self):
+        for part in self.loaded():
+            yield from part.time_sums()
+
+    def to_sketch(self, config: dict = None)->'SketchAggregator':
+        '''Sketch of the partitions' own kind, e.g. histograms stay histograms. '''
+
+        sketch = None
+        for part in self.loaded():
+            part = part.to_sketch(config)
+            if sketch is None:
+                sketch = type(part)(config)  # partition itself may be returned, it is not merged into
+            sketch.merge(part)
+
+        return sketch
+
+    def stats(self, quantiles=(), urls=None):
+        '''
+        Yields (url, counter, time_sum, time_max, time_med, [values of quantiles], {extra columns})
+        for given urls or for all of them, partition by partition.
+        '''
+
+        if urls is None:
+            for part in self.loaded():
+                yield from part.stats(quantiles)
+            return
+
+        by_partition = dict()
+        for req in urls:
+            by_partition.setdefault(self.partition(req), []).append(req)
+        for i, part in zip(sorted(by_partition), self.loaded(sorted(by_partition))):
+            yield from part.stats(quantiles, by_partition[i])
+
+
+AGGREGATORS = {
+    'exact': ListAggregator,
+    'packed': PackedAggregator,
+    'sketch': SketchAggregator,
+    'histogram': HistogramAggregator,
+    'topk': TopKAggregator,
+}
+
+
+def make_aggregator(config: dict):
+    '''Creating empty aggregator of the configured kind. '''
+
+    kind = config.get('AGGREGATION', 'exact') or 'exact'
+    if kind not in AGGREGATORS:
+        raise ValueError('Unknown aggregation mode: {}'.format(kind))
+
+    # topk is bounded anyway, checkpoint of incremental run keeps the whole aggregate
+    if config.get('MEMORY_BUDGET', 0) and kind != 'topk' and not config.get('INCREMENTAL', False):
+        return SpillAggregator(config)
+
+    engine = config.get('ENGINE', 'python') or 'python'
+    if engine == 'numpy':
+        if kind != 'exact':
+            raise ValueError('Engine numpy supports only exact aggregation')
+        if np is None:
+            raise ImportError('Engine numpy needs NumPy to be installed')
+        return NumpyAggregator(config)
+    elif engine != 'python':
+        raise ValueError('Unknown engine: {}'.format(engine))
+
+    return AGGREGATORS[kind](config)
+
+
+MINUTES = 24 * 60
+
+
+def minute_series(typecode: str)->array:
+    '''Zeroed array with a slot for every minute of day. '''
+
+    return array(typecode, bytes(8 * MINUTES))
+
+
+def add_series(a: array, b: array)->array:
+    for i, value in enumerate(b):
+        if value:
+            a[i] += value
+
+    return a
+
+
+class TimeSeries(object):
+    '''
+    Requests and request_time sums per minute of $time_local, for the whole log and for its
+    heaviest URLs (tracked by Space-Saving, a URL's series starts when it gets into the top).
+    Timestamp is parsed only once per distinct second.
+    '''
+
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self.size = int(config.get('TIMESERIES_URLS', 10) or 10)
+        self.counts = minute_series('q')
+        self.sums = minute_series('d')
+        self.urls = SpaceSaving(4 * self.size)  # url -> [counts, sums] payload
+        self.minutes = dict()  # raw $time_local -> minute of day
+        self.skipped = 0
+
+    def minute(self, stamp: bytes)->int:
+        minute = self.minutes.get(stamp, None)
+        if minute is None:
+            if len(self.minutes) >= 4096:
+                self.minutes.clear()
+            try:
+                tm = datetime.strptime(stamp.decode('ascii'), '%d/%b/%Y:%H:%M:%S %z')
+                minute = tm.hour * 60 + tm.minute
+            except ValueError:
+                minute = -1
+            self.minutes[stamp] = minute
+
+        return minute
+
+    def collect(self, m, request_time: float, request_url: str):
+        minute = self.minute(m.group(4))
+        if minute < 0:
+            self.skipped += 1
+            return
+
+        self.counts[minute] += 1
+        self.sums[minute] += request_time
+
+        item = self.urls.update(request_url, request_time)
+        if item[2] is None:
+            item[2] = [minute_series('q'), minute_series('d')]
+        item[2][0][minute] += 1
+        item[2][1][minute] += request_time
+
+    def merge(self, other: 'TimeSeries')->'TimeSeries':
+        add_series(self.counts, other.counts)
+        add_series(self.sums, other.sums)
+        self.urls.merge(other.urls, lambda a, b: [add_series(a[0], b[0]), add_series(a[1], b[1])])
+        self.skipped += other.skipped
+
+        return self
+
+    def report(self, scale: float = 1.0)->dict:
+        '''
+        Minutes with requests as 'HH:MM' labels with scaled counts and average times,
+        and hourly average times of the heaviest URLs.
+        '''
+
+        minutes = [i for i in range(MINUTES) if self.counts[i]]
+        urls = []
+        for url, time_sum, _, (counts, sums) in self.urls.top(self.size):
+            hours = []
+            for hour in range(0, MINUTES, 60):
+                count = sum(counts[hour:hour + 60])
+                hours.append(round(sum(sums[hour:hour + 60]) / count, 3) if count else None)
+            urls.append({'url': url, 'time_sum': round(time_sum * scale, 3), 'time_avg': hours})
+
+        return {
+            'minutes': ['%02d:%02d' % divmod(i, 60) for i in minutes],
+            'count': [int(round(self.counts[i] * scale)) for i in minutes],
+            'time_avg': [round(self.sums[i] / self.counts[i], 3) for i in minutes],
+            'urls': urls,
+        }
+
+
+class Cardinality(object):
+    '''
+    HyperLogLog estimates of distinct URLs and distinct clients ($remote_addr) of the whole log, and of
+    distinct clients of its heaviest URLs (tracked by Space-Saving, a URL's sketch starts when it gets into the top).
+    Hashes of recent clients and URLs are remembered, so a repeated value is not hashed again.
+    Sampled runs see only sampled lines, distinct counts are not scaled.
+    '''
+
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self.precision = int(config.get('CARDINALITY_PRECISION', 10) or 10)
+        self.size = int(config.get('CARDINALITY_URLS', 0) or 2 * int(config.get('REPORT_SIZE', 1000) or 1000))
+        self.urls = HyperLogLog(min(18, self.precision + 4))
+        self.clients = HyperLogLog(min(18, self.precision + 4))
+        self.top = SpaceSaving(self.size)  # url -> [time_sum, error, HyperLogLog of clients]
+        self.hashes = dict()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['hashes'] = dict()
+
+        return state
+
+    def hash(self, value)->int:
+        h = self.hashes.get(value, None)
+        if h is None:
+            if len(self.hashes) >= 65536:
+                self.hashes.clear()
+            h = self.hashes[value] = hash64(value.encode('utf-8', errors='replace') if isinstance(value, str)
+                                            else value)
+
+        return h
+
+    def collect(self, m, request_time: float, request_url: str):
+        client = self.hash(m.group(1))
+        self.clients.add_hash(client)
+        self.urls.add_hash(self.hash(request_url))
+
+        item = self.top.update(request_url, request_time)
+        if item[2] is None:
+            item[2] = HyperLogLog(self.precision)
+        item[2].add_hash(client)
+
+    def merge(self, other: 'Cardinality')->'Cardinality':
+        self.urls.merge(other.urls)
+        self.clients.merge(other.clients)
+        self.top.merge(other.top, lambda a, b: a.merge(b) if a is not None and b is not None else a or b)
+
+        return self
+
+    def annotate(self, rows: list)->list:
+        '''Adding distinct clients and their 95% error to report rows, they are empty for URLs without sketch. '''
+
+        for line in rows:
+            item = self.top.items.get(line['request'], None)
+            sketch = item[2] if item is not None else None
+            if sketch is None:
+                line['clients'] = line['clients_err'] = None
+                continue
+            estimate = sketch.count()
+            line['clients'] = int(round(estimate))
+            line['clients_err'] = int(round(1.96 * sketch.relative_error * estimate))
+
+        return rows
+
+    def report(self)->dict:
+        '''Distinct URLs and clients of the whole log with 95% relative error in percents. '''
+
+        return {
+            'urls': int(round(self.urls.count())),
+            'clients': int(round(self.clients.count())),
+            'total_error_perc': round(196 * self.urls.relative_error, 2),
+            'url_error_perc': round(196 * HyperLogLog(self.precision).relative_error, 2),
+        }
+
+    def columns(self)->tuple:
+        '''Header and binary columns for saved aggregate. '''
+
+        top = self.top.top(self.size)
+        offsets = array('Q', [0])
+        urls, registers = [], []
+        weights, errors = array('d'), array('d')
+        for req, value, error, sketch in top:
+            raw = req.encode('utf-8')
+            urls.append(raw)
+            offsets.append(offsets[-1] + len(raw))
+            weights.append(value)
+            errors.append(error)
+            registers.append(bytes(sketch.registers))
+
+        header = {'precision': self.precision, 'size': self.size, 'floor': self.top.floor}
+        columns = [('hll_urls', bytes(self.urls.registers)), ('hll_clients', bytes(self.clients.registers)),
+                   ('hll_top_offsets', offsets), ('hll_top_urls', b''.join(urls)), ('hll_top_weights', weights),
+                   ('hll_top_errors', errors), ('hll_top_registers', b''.join(registers))]
+
+        return header, columns
+
+    @classmethod
+    def from_columns(cls, header: dict, columns: dict)->'Cardinality':
+        cardinality = cls({'CARDINALITY_PRECISION': header['precision'], 'CARDINALITY_URLS': header['size']})
+        cardinality.urls = HyperLogLog.from_registers(columns['hll_urls'])
+        cardinality.clients = HyperLogLog.from_registers(columns['hll_clients'])
+        cardinality.top.floor = header['floor']
+
+        offsets, raw = columns['hll_top_offsets'], columns['hll_top_urls']
+        m = 1 << header['precision']
+        for i, (value, error) in enumerate(zip(columns['hll_top_weights'], columns['hll_top_errors'])):
+            req = raw[offsets[i]:offsets[i + 1]].decode('utf-8')
+            sketch = HyperLogLog.from_registers(columns['hll_top_registers'][i * m:(i + 1) * m])
+            cardinality.top.items[req] = [value, error, sketch]
+
+        return cardinality
+
+
+def make_collectors(config: dict)->dict:
+    '''Per-line collectors enabled in config, by name. '''
+
+    collectors = dict()
+    if config.get('TIMESERIES', False):
+        collectors['timeseries'] = TimeSeries(config)
+    if config.get('CARDINALITY', False):
+        collectors['cardinality'] = Cardinality(config)
+
+    return collectors
+
+
+def merge_collectors(collectors: dict, other: dict)->dict:
+    for name, collector in other.items():
+        collectors[name].merge(collector)
+
+    return collectors
+
+
+def process_range(task: tuple)->tuple:
+    '''Worker: parsing lines of byte range [start, end) into partial aggregate. '''
+
+    filepath, start, end, size, strict, config = task
+    res = make_aggregator(config)
+    sampler = make_sampler(config)
+    collectors = make_collectors(config)
+    errors = ParseErrors(config)
+    acc = [0]
+
+    normalize = make_normalizer(config)
+    line_filter = make_filter(config)
+    cache_size = config.get('URL_CACHE_SIZE', 1000000)
+
+    if can_parse_chunks(res, strict, sampler, collectors, line_filter):
+        # errors of the range are weighed against lines of the whole file
+        done = [0]
+        errors.progress = lambda: done[0] / size
+        blocks = counted(read_range_blocks(filepath, start, end, config=config), done)
+        consume_chunks(res, parse_chunks(blocks, acc, RawUrlIds(res.url_id, normalize), cache_size, errors), acc)
+        records = ()
+    elif config.get('MMAP', True) and can_scan_mapped(filepath, sampler, line_filter):
+        records = scan_mapped(filepath, acc, strict, normalize, cache_size, start, end, list(collectors.values()),
+                              errors)
+    else:
+        done = [0]
+        errors.progress = lambda: done[0] / size
+        blocks = counted(read_range_blocks(filepath, start, end, config=config), done)
+        records = parse_lines(split_lines(blocks), acc, strict, sampler, normalize, cache_size,
+                              list(collectors.values()), errors, line_filter)
+
+    for request_time, request_url in records:
+        res.add(request_url, request_time)
+
+    if sampler.exhausted:
+        sampler.total = end - start
+
+    return res, acc[0], sampler, collectors, errors
+
+
+def parallel_logs_handler(config: dict, log_file, workers: int, sampler: Sampler = None,
+                          collectors: dict = None, profiler: Profiler = None, errors: ParseErrors = None):
+    '''Parsing uncompressed log file in several processes. '''
+
+    logging.info('Start proccess report file in %s workers.' % workers)
+
+    strict = config.get('STRICT_PARSING', False)
+    ranges = split_file(log_file, workers, config)
+
+    # budgets and reservoir are shared between workers
+    worker_config = dict(config)
+    for key in ['MAX_LINES', 'RESERVOIR_SIZE']:
+        if config.get(key, None):
+            worker_config[key] = max(1, int(config[key]) // len(ranges))
+    if config.get('MEMORY_BUDGET', 0):
+        worker_config['MEMORY_BUDGET'] = float(config['MEMORY_BUDGET']) / len(ranges)
+    tasks = [(log_file, start, end, ranges[-1][1], strict, worker_config) for start, end in ranges]
+
+    res = make_aggregator(config)
+    acc = [0]
+
+    # wall time of workers is 'parse', CPU time of workers is not seen by profiler of this process
+    with profile_stage(profiler, 'parse') as stage, multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        for part, lines, part_sampler, part_collectors, part_errors in pool.imap_unordered(process_range, tasks):
+            with profile_stage(profiler, 'merge'):
+                res.merge(part)
+                acc[0] += lines
+                if sampler is not None:
+                    sampler.merge(part_sampler)
+                if collectors is not None:
+                    merge_collectors(collectors, part_collectors)
+                if errors is not None:
+                    errors.merge(part_errors)
+        stage['lines'] = acc[0]
+        stage['bytes'] = os.path.getsize(log_file)
+
+    return res, acc
+
+
+def line_batches(blocks):
+    '''Regrouping binary blocks into batches of whole lines, a line is never split between batches. '''
+
+    tail = b''
+    for block in blocks:
+        end = block.rfind(b'\n') + 1
+        if not end:
+            tail += block
+            continue
+        yield tail + block[:end]
+        tail = block[end:]
+
+    if tail:
+        yield tail
+
+
+def pipeline_worker(tasks, results, strict: bool, config: dict, failed=None, shared=None):
+    '''
+    Worker: parsing (line batch, estimated uncompressed bytes of log) tasks until None, then putting
+    partial aggregate to results. A failed worker sets failed event, so the reader stops feeding,
+    and always puts its result. Shared array keeps errors, lines and bytes of batches parsed by all workers,
+    so the early MIN_LINES abort sees the whole log, not a single worker's part of it.
+    '''
+
+    if shared is None:
+        shared = multiprocessing.Array('q', 3)
+
+    error = None
     try:
-        filedate = re.search(r'\d{8}', name)[0]
-        
-        res = int(filedate)
-        
-    except Exception as e:        
+        res = make_aggregator(config)
+        collectors = make_collectors(config)
+        errors = ParseErrors(config)
+        normalize = make_normalizer(config)
+        line_filter = make_filter(config)
+        cache_size = config.get('URL_CACHE_SIZE', 1000000)
+        acc = [0]
+        done, total = [0], [0.0]  # bytes of batches parsed by all workers, estimated bytes of log
+        errors.progress = lambda: done[0] / total[0] if total[0] else 0.0
+        ids = RawUrlIds(res.url_id, normalize) if can_parse_chunks(res, strict, None, collectors, line_filter) \
+            else None
+    except Exception as e:
         logging.error(repr(e))
-        raise
+        error = repr(e)
+        if failed is not None:
+            failed.set()
 
-    return res
+    own = [0, 0]  # errors and lines of this worker already in shared
+    for batch, total_bytes in iter(tasks.get, None):
+        if error is not None:
+            continue  # the queue is still drained, so the reader is never blocked
+        try:
+            with shared.get_lock():
+                others_errors, others_lines, done[0] = shared[0] - own[0], shared[1] - own[1], shared[2]
+            errors.others = (others_errors, others_lines)
+            total[0] = total_bytes
+            if ids is not None:
+                consume_chunks(res, parse_chunks([batch], acc, ids, cache_size, errors), acc)
+            else:
+                consume(res, parse_lines(split_lines([batch]), acc, strict, None, normalize, cache_size,
+                                         list(collectors.values()), errors, line_filter), acc)
+        except Exception as e:
+            logging.error(repr(e))
+            error = repr(e)
+            if failed is not None:
+                failed.set()
+        with shared.get_lock():
+            shared[0] += errors.count - own[0]
+            shared[1] += acc[0] - own[1]
+            shared[2] += len(batch)
+        own = [errors.count, acc[0]]
 
+    results.put((None, 0, None, None, error) if error else (res, acc[0], collectors, errors, None))
+
+
+def put_task(tasks, item, processes: list, failed, timeout: float = 1.0)->bool:
+    '''Putting item to bounded tasks queue while every worker is alive and none has failed. '''
+
+    while True:
+        try:
+            tasks.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            if failed.is_set() or not all(process.is_alive() for process in processes):
+                return False
+
+
+def pipelined_logs_handler(config: dict, log_file, workers: int, collectors: dict = None,
+                           profiler: Profiler = None, errors: ParseErrors = None, timeout: float = 1.0):
+    '''
+    Parsing gzip log file in several processes: this process decompresses it and hands batches of lines
+    over a bounded queue to parser processes, their partial aggregates are merged at the end.
+    '''
+
+    logging.info('Start proccess report file in %s parser workers.' % workers)
+
+    strict = config.get('STRICT_PARSING', False)
+    worker_config = dict(config)
+    if config.get('MEMORY_BUDGET', 0):
+        worker_config['MEMORY_BUDGET'] = float(config['MEMORY_BUDGET']) / workers
+
+    # a bad setting must fail here, not in every worker
+    make_aggregator(worker_config)
+    make_collectors(worker_config)
+    ParseErrors(worker_config)
+    make_normalizer(worker_config)
+    make_filter(worker_config)
+
+    tasks = multiprocessing.Queue(2 * workers)  # at most 2 * workers blocks wait for parsers
+    results = multiprocessing.Queue()
+    failed = multiprocessing.Event()
+    shared = multiprocessing.Array('q', 3)
+    processes = [multiprocessing.Process(target=pipeline_worker,
+                                         args=(tasks, results, strict, worker_config, failed, shared), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    res = make_aggregator(config)
+    acc = [0]
+    failures = []
+    position = dict()
 
-def date_to_str_with_delimiters(name: str)->str:
-    '''Getting date from file name and converts it to a string formated "YYYY.MM.DD" '''
-    
     try:
-        filedate = datetime.strptime(re.search(r'\d{8}', name)[0], '%Y%m%d')        
-        res = datetime.strftime(filedate, '%Y.%m.%d')
-        
-    except Exception as e:        
-        logging.error(repr(e))
-        raise
+        blocks = read_blocks(log_file, position=position)
+        if profiler is not None:
+            blocks = profiler.wrap('read', blocks)
+        size = os.path.getsize(log_file)
+        out = 0  # uncompressed bytes of batches put
+        for batch in line_batches(blocks):
+            # uncompressed size of log by the compression ratio of the part before the current block
+            read = max(0, position['read'] - BLOCK_SIZE)
+            total_bytes = out * size / read if read else 0.0
+            if failed.is_set() or not put_task(tasks, (batch, total_bytes), processes, failed, timeout):
+                break  # the rest of file is not decompressed for nothing
+            out += len(batch)
+    finally:
+        for _ in processes:
+            put_task(tasks, None, processes, failed, timeout)
+        with profile_stage(profiler, 'merge'):
+            received = 0
+            while received < len(processes):
+                try:
+                    part, lines, part_collectors, part_errors, error = results.get(timeout=timeout)
+                except queue.Empty:
+                    dead = [process.exitcode for process in processes if process.exitcode not in (None, 0)]
+                    if dead:
+                        failures.append('worker exited with code {}'.format(dead[0]))
+                        break
+                    continue
+                received += 1
+                if error:
+                    failures.append(error)
+                    continue
+                res.merge(part)
+                acc[0] += lines
+                if collectors is not None:
+                    merge_collectors(collectors, part_collectors)
+                if errors is not None:
+                    errors.merge(part_errors)
+        if failures:
+            tasks.cancel_join_thread()  # batches nobody reads must not block exit of this process
+        for process in processes:
+            if failures and process.is_alive():
+                process.terminate()
+            process.join()
 
-    return res
+    if failures:
+        raise RuntimeError('Parser workers failed: {}'.format('; '.join(failures)))
 
- 
-def get_report_name(config: dict):
-    '''Return newest report file name. '''
-    
-    if os.path.isdir(config.get("LOG_DIR")):
-        rfiles = os.listdir(config.get("LOG_DIR"))
-        
-        log_file = reduce(lambda acc, x: 
-                           acc if date_to_int(acc) > date_to_int(x) else x
-                           ,[x for x in rfiles if re.fullmatch(r'nginx-access-ui.log-\d{8}\D*', x)]
-                           , 'nginx-access-ui.log-00000000')
-        
-        if log_file == 'nginx-access-ui.log-00000000':
-            logging.error("There is no any log file in log directory (%s)" % config.get("LOG_DIR"))
-            return None 
-    else:
-        logging.error("Log directory (%s) doesn't exist" % config.get("LOG_DIR"))
-        raise FileExistsError("Log directory (%s) doesn't exist" % config.get("LOG_DIR"))
-    
-    log_file = os.path.join(os.path.abspath(os.getcwd()), config.get("LOG_DIR"), log_file)
-    logging.info('Report file is %s' % log_file)
-    return log_file
+    if profiler is not None:
+        profiler.get('read')['bytes'] += position['out']
+        profiler.get('parse')['lines'] += acc[0]
 
+    return res, acc
 
-def process_line(line: str)->tuple:
-    """
-    Finding requested fields in line
-    """  
-   
-    try:            
-        request_time = float(re.search(r'\d{1,}\.{1}\d{0,}$', line)[0])
-        request_url = re.search(r'(?<=[GET|POST]\s)(.+?)(?=\s)', line)[0]       
-                                 
-    except Exception as e:
-        logging.error("Can't recognize line: %s"%line)
-        logging.error(repr(e))
-        request_time = request_url = None
-        
-    return request_time, request_url
 
+def checkpoint_name(config: dict, log_file: str)->str:
+    '''Checkpoint file name for log file. '''
+
+    checkpoint_dir = config.get('CHECKPOINT_DIR', None) or config['REPORT_DIR']
+
+    return os.path.join(checkpoint_dir, '.' + os.path.basename(log_file) + '.checkpoint')
+
+
+def load_checkpoint(config: dict, log_file: str):
+    '''Loading checkpoint of log file, returns None if it is absent or doesn't fit the file anymore. '''
+
+    name = checkpoint_name(config, log_file)
+    if not os.path.isfile(name):
+        return None
 
-def process_log_file(filepath: str, acc: list):
-    '''Gathering data from log file. '''
-        
     try:
-        with gzip.open(filepath, 'r') \
-        if filepath.split('.')[-1].lower() == 'gz' \
-        else open(filepath, 'r') as f:
-                    
-            logging.info('open log file %s' % filepath)
-                    
-            for line in f:
-                request_time, request_url = process_line(line.decode('utf-8'))
-                acc[0] += 1
-                if acc[0] == 200000: break
-                if request_time and request_url:                
-                    yield request_time, request_url
-        logging.info('close log file') 
-        
+        with open(name, 'rb') as f:
+            state = pickle.load(f)
     except Exception as e:
-        logging.error(repr(e))
-        raise         
+        logging.error("Checkpoint %s can't be read: %s" % (name, repr(e)))
+        return None
+
+    stat = os.stat(log_file)
+    # offset in gzip file with index is uncompressed, it is checked by the reader
+    truncated = not state.get('gzip_index', False) and stat.st_size < state['offset']
+    if state['identity'] != (stat.st_dev, stat.st_ino) or truncated:
+        logging.info('Log file %s was replaced, checkpoint is ignored' % log_file)
+        return None
+
+    if state['aggregation'] != (config.get('AGGREGATION', 'exact') or 'exact'):
+        logging.info('Aggregation mode changed, checkpoint is ignored')
+        return None
+
+    if state.get('normalize_urls', None) != config.get('NORMALIZE_URLS', None):
+        logging.info('URL normalization changed, checkpoint is ignored')
+        return None
+
+    if state.get('filter', {}) != {key: config[key] for key in FILTER_KEYS if config.get(key, None)}:
+        logging.info('Line filter changed, checkpoint is ignored')
+        return None
+
+    if state.get('gzip_index', False) != gzip_indexed(log_file, config):
+        logging.info('Offsets of gzip index changed, checkpoint is ignored')
+        return None
+
+    if sorted(state.get('collectors', {})) != sorted(make_collectors(config)):
+        logging.info('Collectors changed, checkpoint is ignored')
+        return None
+
+    return state
+
+
+def save_checkpoint(config: dict, log_file: str, state: dict):
+    '''Saving checkpoint of log file atomically. '''
+
+    name = checkpoint_name(config, log_file)
+    os.makedirs(os.path.dirname(name) or '.', exist_ok=True)
+
+    with NamedTemporaryFile('wb', dir=os.path.dirname(name) or '.', delete=False) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, name)
+
+
+def incremental_logs_handler(config: dict, log_file, collectors: dict = None, profiler: Profiler = None,
+                             errors: ParseErrors = None):
+    '''Parsing only data appended to log file since the last checkpoint. '''
+
+    state = load_checkpoint(config, log_file)
+    if state is None:
+        stat = os.stat(log_file)
+        state = {
+            'identity': (stat.st_dev, stat.st_ino),
+            'aggregation': config.get('AGGREGATION', 'exact') or 'exact',
+            'normalize_urls': config.get('NORMALIZE_URLS', None),
+            'filter': {key: config[key] for key in FILTER_KEYS if config.get(key, None)},
+            'offset': 0,
+            'lines': 0,
+            'res': make_aggregator(config),
+            'collectors': make_collectors(config),
+            'gzip_index': gzip_indexed(log_file, config),  # offset is uncompressed
+        }
+    state.setdefault('errors', ParseErrors(config))
+
+    if state['aggregation'] in ('exact', 'packed'):
+        logging.warning('Aggregation %s keeps every request_time, so every incremental run loads and saves all '
+                        'of them again: its cost grows with the whole log, not with appended lines. '
+                        'Consider AGGREGATION sketch or histogram.' % state['aggregation'])
+
+    logging.info('Start proccess report file from offset %s.' % state['offset'])
+
+    res = state['res']
+    acc = [state['lines']]
+    position = {'offset': state['offset']}
+    blocks = read_blocks(log_file, offset=state['offset'], position=position, whole_lines=True, config=config)
+    if profiler is not None:
+        blocks = profiler.wrap('read', blocks)
+
+    records = parse_lines(split_lines(blocks), acc, config.get('STRICT_PARSING', False), None,
+                          make_normalizer(config), config.get('URL_CACHE_SIZE', 1000000),
+                          list(state['collectors'].values()), state['errors'], make_filter(config))
+    consume(res, records, acc, profiler)
 
+    logging.info('Processed %s new lines.' % (acc[0] - state['lines']))
 
-def logs_handler(config: dict, log_file):
+    state['offset'] = position['offset']
+    state['lines'] = acc[0]
+    save_checkpoint(config, log_file, state)
+
+    if collectors is not None:
+        collectors.update(state['collectors'])
+    if errors is not None:
+        errors.merge(state['errors'])
+
+    return res, acc
+
+
+def consume_chunks(res: 'NumpyAggregator', chunks, acc: list, profiler: Profiler = None):
+    '''Adding (url ids, request times) arrays to aggregator, parsing and aggregation are profiled apart. '''
+
+    if profiler is None:
+        for ids, times in chunks:
+            res.add_chunk(ids, times)
+        return
+
+    first = acc[0]
+    chunks = iter(chunks)
+    while True:
+        with profiler.stage('parse'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with profiler.stage('aggregate') as stage:
+            res.add_chunk(*chunk)
+            stage['lines'] += len(chunk[1])
+
+    profiler.get('parse')['lines'] += acc[0] - first
+
+
+def consume(res, records, acc: list, profiler: Profiler = None, batch_size: int = 65536):
+    '''
+    Adding (request_time, request_url) records to aggregator.
+    Profiled run takes records by batches, so parsing and aggregation are timed separately.
+    '''
+
+    if profiler is None:
+        for request_time, request_url in records:
+            res.add(request_url, request_time)
+        return
+
+    first = acc[0]
+    records = iter(records)
+    while True:
+        with profiler.stage('parse'):
+            batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        with profiler.stage('aggregate') as stage:
+            for request_time, request_url in batch:
+                res.add(request_url, request_time)
+            stage['lines'] += len(batch)
+
+    profiler.get('parse')['lines'] += acc[0] - first
+
+
+def logs_handler(config: dict, log_file, sampler: Sampler = None, collectors: dict = None,
+                 profiler: Profiler = None, errors: ParseErrors = None):
     '''Logs proccessing function'''
-        
+
+    if config.get('INCREMENTAL', False):
+        return incremental_logs_handler(config, log_file, collectors, profiler, errors)
+
+    if config.get('GZIP_INDEX', False) and indexed_gzip is None:
+        logging.info('indexed_gzip is not installed, gzip log is read without index.')
+
+    workers = int(config.get('WORKERS', 1) or 1)
+    if workers > 1:
+        if log_file.split('.')[-1].lower() != 'gz' or gzip_indexed(log_file, config):
+            return parallel_logs_handler(config, log_file, workers, sampler, collectors, profiler, errors)
+        if sampler is None or (type(sampler) is Sampler and not sampler.budget):
+            return pipelined_logs_handler(config, log_file, workers, collectors, profiler, errors)
+        logging.info('Sampled compressed log file is processed in one worker.')
+
     logging.info('Start proccess report file.')
    
-    res = dict()
+    res = make_aggregator(config)
     acc = [0]
-        
-    for request_time, request_url in process_log_file(log_file, acc):
-        if not res.get(request_url, None):
-            res[request_url] = dict()
-            res[request_url]['counter'] = 0
-            res[request_url]['times'] = []
-            
-        res[request_url]['counter'] += 1
-        res[request_url]['times'].append(request_time)             
+
+    strict = config.get('STRICT_PARSING', False)
+    line_filter = make_filter(config)
+    if can_parse_chunks(res, strict, sampler, collectors, line_filter):
+        ids = RawUrlIds(res.url_id, make_normalizer(config))
+        chunks = process_log_chunks(log_file, acc, ids, config.get('URL_CACHE_SIZE', 1000000), profiler, errors)
+        consume_chunks(res, chunks, acc, profiler)
+        return res, acc
+
+    records = process_log_file(log_file, acc, strict, sampler, make_normalizer(config),
+                               config.get('URL_CACHE_SIZE', 1000000), config.get('MMAP', True),
+                               list((collectors or {}).values()), profiler, errors, line_filter)
+    consume(res, records, acc, profiler)
     
     return res, acc
 
-def save_to_report(config: dict, file_name: str, data: dict):
+def quantile_column(q: float)->str:
+    '''Report column name for quantile q, e.g. 0.99 -> time_p99. '''
+
+    return 'time_p{:g}'.format(q * 100)
+
+
+def prepare_report_data(config: dict, res, sampler: Sampler = None)->list:
+    '''
+    Building report rows from aggregator.
+    Counts and sums of sampled run are scaled to the whole log, counter_err and time_sum_err
+    are 95% confidence half-widths of the scaled values (time_sum_err assumes times close to average).
+    A run stopped by MAX_LINES/MAX_SECONDS budget read only a prefix of the log, which is not a random
+    sample: its rows are marked prefix_extrapolated and their bounds hold only if the prefix is typical.
+    time_sum_counted of aggregator is the time of counted requests when time_sum is only an estimate,
+    time_avg is computed from it; count_perc is left empty when counter covers only a part of requests.
+    '''
+
+    quantiles = config.get('QUANTILES', None) or getattr(res, 'default_quantiles', [])
+    scale = sampler.scale if sampler is not None else 1.0
+    coverage = sampler.coverage if sampler is not None else 1.0
+    fraction = sampler.sample_fraction * coverage if sampler is not None else 1.0  # share of log in aggregates
+    total_requests = res.total_requests()
+    total_time = res.total_time() * scale
+
+    # only rows which get into the report are computed
+    urls = None
+    report_size = int(config.get('REPORT_SIZE', 0) or 0)
+    if report_size:
+        urls = [req for req, _ in heapq.nlargest(report_size, res.time_sums(),
+                                                 key=lambda x: round(x[1] * scale, 3))]
+
+    data_to_save = []
+    for req, counter, time_sum, time_max, time_med, qs, extra in res.stats(quantiles, urls):
+        time_counted = extra.pop('time_sum_counted', None)
+        line = dict()
+        line['request'] = req
+        line['counter'] = int(round(counter * scale))
+        line['count_perc'] = round((counter / total_requests) * 100, 3)
+        if extra.get('time_sum_topk_err', 0):
+            line['count_perc'] = None
+        line['time_sum'] = round(time_sum * scale, 3)
+        line['time_perc'] = round((line['time_sum'] / total_time) * 100, 3)
+        if time_counted is None:
+            line['time_avg'] = round(line['time_sum'] / line['counter'], 3)
+        else:
+            line['time_avg'] = round(time_counted / counter, 3)
+        line['time_max'] = round(time_max, 3)
+        line['time_med'] = round(time_med, 3)
+        for q, value in zip(quantiles, qs):
+            line[quantile_column(q)] = round(value, 3)
+        for key, value in extra.items():
+            line[key] = round(value * scale, 3) if key.startswith('time_sum') else value
+        if fraction < 1:
+            err = 1.96 * scale * (counter * (1 - fraction)) ** 0.5
+            line['counter_err'] = int(round(err))
+            line['time_sum_err'] = round(err * time_sum / counter, 3)
+        if coverage < 1:
+            line['prefix_extrapolated'] = True
+
+        data_to_save.append(line)
+
+    return data_to_save
+
+
+def save_to_report(config: dict, file_name: str, data: dict, overwrite: bool = False, timeseries: dict = None,
+                   profiler: Profiler = None, cardinality: dict = None):
     """Saving report to 'html' file."""
     
-    res = sorted(data, key = lambda x: x['time_sum'], reverse=True)[:config['REPORT_SIZE']]      
+    with profile_stage(profiler, 'sort') as stage:
+        rows = heapq.nlargest(int(config['REPORT_SIZE']), data, key = lambda x: x['time_sum'])
+        stage['lines'] += len(data)
     
     try:
-        with open(config.get('HTML_TPL', 'report.html'), mode='r', encoding='utf-8') as f:
+        with open(config.get('HTML_TPL', 'report.html'), mode='r', encoding='utf-8') as f, \
+                profile_stage(profiler, 'render') as stage:
             html = f.read()
             template = Template(html)
-            res = template.safe_substitute(table_json=json.dumps(res))
+            res = template.safe_substitute(table_json=json.dumps(rows), timeseries_json=json.dumps(timeseries),
+                                           cardinality_json=json.dumps(cardinality))
+            stage['lines'] += len(rows)
+            stage['bytes'] += len(res)
                             
     except FileNotFoundError:
         logging.error('There is no template html file.')
@@ -176,16 +2916,34 @@ def save_to_report(config: dict, file_name: str, data: dict):
 
         
     try:
-        with NamedTemporaryFile('w', encoding='utf-8', dir=os.path.split(file_name)[0]) as f:        
-            f.write(res)
-            logging.info('Report saved to a temporary file.')
-            os.link(f.name, file_name)
-            logging.info('Report saved to a permanent file.')
+        f = NamedTemporaryFile('w', encoding='utf-8', dir=os.path.split(file_name)[0], delete=False)
     except FileNotFoundError:
         logging.error('Can not open file: {} for writing.'.format(file_name))
         raise
 
-def check_report_file(config, log_file):
+    try:
+        with f, profile_stage(profiler, 'write') as stage:
+            f.write(res)
+            stage['bytes'] += len(res)
+        logging.info('Report saved to a temporary file.')
+        if overwrite:
+            os.replace(f.name, file_name)
+        else:
+            os.link(f.name, file_name)  # an existing report is never replaced
+        logging.info('Report saved to a permanent file.')
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+
+def report_file_name(config: dict, log_file: str)->str:
+    '''Report file name for log file. '''
+
+    outgoing_report_name = 'report-' + date_to_str_with_delimiters(log_file) + '.html'
+
+    return os.path.join(os.path.abspath(os.getcwd()), config['REPORT_DIR'], outgoing_report_name)
+
+
+def check_report_file(config, log_file, overwrite: bool = False):
     '''Checking whether report file already exists. '''
     
     if not log_file:
@@ -194,16 +2952,503 @@ def check_report_file(config, log_file):
     
     logging.info('Check if report already exists')
     
-    outgoing_report_name = 'report-' + date_to_str_with_delimiters(log_file) + '.html'
-    outgoing_report_name = os.path.join(os.path.abspath(os.getcwd()), config['REPORT_DIR'], outgoing_report_name)
+    outgoing_report_name = report_file_name(config, log_file)
     
-    if os.path.isfile(outgoing_report_name):
+    if os.path.isfile(outgoing_report_name) and overwrite:
+        logging.info("Report %s will be refreshed" % outgoing_report_name)
+    elif os.path.isfile(outgoing_report_name):
         logging.error("Report's already done and file is: %s Close program" % outgoing_report_name)
         return    
     
     return outgoing_report_name
     
     
+AGGREGATE_MAGIC = b'LOGAGG01'
+
+
+def aggregate_file_name(report_file: str)->str:
+    '''Aggregate file name for report file. '''
+
+    return os.path.splitext(report_file)[0] + '.agg'
+
+
+def save_aggregate(file_name: str, res: SketchAggregator, meta: dict, scale: float = 1.0,
+                   collectors: dict = None):
+    '''
+    Saving per-URL aggregate to a columnar binary file: magic, header length, JSON header and columns
+    of the URL dictionary, counts, sums, maxes and flattened KLL sketches or histograms,
+    followed by HyperLogLog registers of cardinality collector if there is one.
+    Counts and sums are scaled.
+    '''
+
+    histograms = isinstance(res, HistogramAggregator)
+    urls = array('Q', [0])
+    url_bytes = []
+    counts, sums, maxes = array('q'), array('d'), array('d')
+    # KLL: levels per URL, items per level, items; histogram: buckets per URL, bucket indexes, bucket counts
+    levels, sizes, values = array('I'), array('I'), array('d')
+    buckets, indexes, bucket_counts = array('I'), array('i'), array('q')
+
+    for req, (counter, time_sum, time_max, summary) in res.res.items():
+        raw = req.encode('utf-8')
+        url_bytes.append(raw)
+        urls.append(urls[-1] + len(raw))
+        counts.append(int(round(counter * scale)))
+        sums.append(time_sum * scale)
+        maxes.append(time_max)
+        if histograms:
+            buckets.append(len(summary.counts))
+            indexes.extend(summary.counts.keys())
+            bucket_counts.extend(summary.counts.values())
+        else:
+            levels.append(len(summary.levels()))
+            for items in summary.levels():
+                sizes.append(len(items))
+                values.extend(items)
+
+    columns = [('url_offsets', urls), ('urls', b''.join(url_bytes)), ('counts', counts), ('sums', sums),
+               ('maxes', maxes)]
+    if histograms:
+        columns += [('hist_buckets', buckets), ('hist_indexes', indexes), ('hist_counts', bucket_counts)]
+    else:
+        columns += [('sketch_levels', levels), ('sketch_sizes', sizes), ('sketch_values', values)]
+
+    if collectors and 'cardinality' in collectors:
+        meta = dict(meta)
+        meta['cardinality'], cardinality_columns = collectors['cardinality'].columns()
+        columns += cardinality_columns
+
+    header = dict(meta, summary='histogram' if histograms else 'kll', accuracy=res.accuracy,
+                  precision=getattr(res, 'precision', None),
+                  columns=[(name, None, len(data)) if isinstance(data, bytes) else
+                           (name, data.typecode, len(data) * data.itemsize) for name, data in columns])
+    header = json.dumps(header).encode('utf-8')
+
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+    with NamedTemporaryFile('wb', dir=os.path.dirname(file_name) or '.', delete=False) as f:
+        f.write(AGGREGATE_MAGIC)
+        f.write(len(header).to_bytes(4, 'little'))
+        f.write(header)
+        for _, data in columns:
+            f.write(data if isinstance(data, bytes) else data.tobytes())
+    os.replace(f.name, file_name)
+
+
+def load_aggregate(file_name: str, collectors: dict = None)->tuple:
+    '''
+    Loading aggregate saved by save_aggregate, returns (SketchAggregator or HistogramAggregator, meta).
+    Saved cardinality collector is put into collectors.
+    '''
+
+    with open(file_name, 'rb') as f:
+        if f.read(len(AGGREGATE_MAGIC)) != AGGREGATE_MAGIC:
+            raise ValueError('{} is not an aggregate file'.format(file_name))
+        meta = json.loads(f.read(int.from_bytes(f.read(4), 'little')).decode('utf-8'))
+
+        columns = dict()
+        for name, typecode, length in meta['columns']:
+            data = f.read(length)
+            if typecode:
+                columns[name] = array(typecode)
+                columns[name].frombytes(data)
+            else:
+                columns[name] = data
+
+    histograms = meta.get('summary', 'kll') == 'histogram'
+    config = {'SKETCH_ACCURACY': meta['accuracy'], 'HISTOGRAM_PRECISION': meta.get('precision', None)}
+    res = HistogramAggregator(config) if histograms else SketchAggregator(config)
+    offsets, raw = columns['url_offsets'], columns['urls']
+    pos = level_pos = 0
+
+    for i, counter in enumerate(columns['counts']):
+        if histograms:
+            summary = res.summary()
+            for j in range(pos, pos + columns['hist_buckets'][i]):
+                summary.counts[columns['hist_indexes'][j]] = columns['hist_counts'][j]
+            summary.count = sum(summary.counts.values())
+            pos += columns['hist_buckets'][i]
+        else:
+            levels = []
+            for _ in range(columns['sketch_levels'][i]):
+                size = columns['sketch_sizes'][level_pos]
+                levels.append(columns['sketch_values'][pos:pos + size])
+                pos += size
+                level_pos += 1
+            summary = KLLSketch.from_levels(levels, counter, meta['accuracy'])
+        req = raw[offsets[i]:offsets[i + 1]].decode('utf-8')
+        res.res[req] = [counter, columns['sums'][i], columns['maxes'][i], summary]
+
+    if collectors is not None and 'cardinality' in meta:
+        collectors['cardinality'] = Cardinality.from_columns(meta['cardinality'], columns)
+
+    return res, meta
+
+
+def rollup(config: dict, days: int)->str:
+    '''Building one report from saved aggregates of the last days, raw logs are not read. '''
+
+    report_dir = os.path.join(os.path.abspath(os.getcwd()), config['REPORT_DIR'])
+    found = sorted(x for x in os.listdir(report_dir) if re.fullmatch(r'report-\d{4}\.\d{2}\.\d{2}\.agg', x))
+    if not found:
+        logging.error('There are no aggregate files in %s' % report_dir)
+        return None
+
+    last = datetime.strptime(found[-1][7:17], '%Y.%m.%d')
+    names = [x for x in found if (last - datetime.strptime(x[7:17], '%Y.%m.%d')).days < days]
+
+    collectors = dict()
+    res, meta = load_aggregate(os.path.join(report_dir, names[0]), collectors)
+    for name in names[1:]:
+        part_collectors = dict()
+        part, part_meta = load_aggregate(os.path.join(report_dir, name), part_collectors)
+        if part_meta.get('summary', 'kll') != meta.get('summary', 'kll'):
+            raise ValueError('Aggregates {} and {} have different kinds of summaries'.format(names[0], name))
+        res.merge(part)
+        if 'cardinality' in collectors and 'cardinality' not in part_collectors:
+            logging.info('Aggregate %s has no cardinality sketches, distinct counts are left out' % name)
+            del collectors['cardinality']
+        elif 'cardinality' in collectors:
+            collectors['cardinality'].merge(part_collectors['cardinality'])
+    logging.info('Rollup of %s aggregates: %s URLs' % (len(names), len(res)))
+
+    report_file = os.path.join(report_dir, 'report-{}-{}.html'.format(names[0][7:17], names[-1][7:17]))
+    data = prepare_report_data(config, res)
+    cardinality = None
+    if 'cardinality' in collectors:
+        collectors['cardinality'].annotate(data)
+        cardinality = collectors['cardinality'].report()
+    save_to_report(config, report_file, data, overwrite=True, cardinality=cardinality)
+
+    return report_file
+
+
+def profile_file_name(report_file: str, extension: str)->str:
+    '''Profile file name next to the report, e.g. report-2017.06.30.profile.json. '''
+
+    return os.path.splitext(report_file)[0] + extension
+
+
+def build_report(config: dict, log_file: str, report_file: str):
+    '''Parsing log file and saving its report. '''
+
+    profiler = None
+    if config.get('PROFILE', False) or config.get('CPROFILE', False):
+        profiler = Profiler()
+
+    profile = None
+    if config.get('CPROFILE', False):
+        profile = cProfile.Profile()
+        profile.enable()
+
+    sampler = make_sampler(config)
+    collectors = make_collectors(config)
+    errors = ParseErrors(config)
+    res, acc = logs_handler(config, log_file, sampler, collectors, profiler, errors)
+    acc = acc[0]
+    errors.log(acc)
+    
+    logging.info('Log file processed. Start preparing information...')
+    if sampler.scale != 1:
+        logging.info('Sampled %.2f%% of lines, %.2f%% of log file read, counts and sums are scaled by %.3f' % (
+            sampler.sample_fraction * 100, sampler.coverage * 100, sampler.scale))
+                  
+    total_requests = res.total_requests() / sampler.sample_fraction
+    
+    if (total_requests / acc) <  config.get('MIN_LINES', 0.5):
+        logging.error("Processed less then {!s} lines of log report (now processed "
+        "{!s} lines of total {!s} lines, program stopped, please, consider changing "
+        "MIN_LINES config's variable (assign persentage of total lines to be processed".format(
+        config.get('MIN_LINES', 0.5), total_requests, acc))
+        raise ValueError
+    
+    with profile_stage(profiler, 'stats') as stage:
+        data_to_save = prepare_report_data(config, res, sampler)
+        stage['lines'] += len(data_to_save)
+        
+    logging.info('Information prepared. Start saving to report...')
+    
+    timeseries = None
+    if 'timeseries' in collectors:
+        # collectors see every parsed line, only lines skipped before parsing are scaled
+        timeseries = collectors['timeseries'].report(1 / (sampler.parse_fraction * sampler.coverage))
+
+    cardinality = None
+    if 'cardinality' in collectors:
+        collectors['cardinality'].annotate(data_to_save)
+        cardinality = collectors['cardinality'].report()
+
+    save_to_report(config, report_file, data_to_save, config.get('INCREMENTAL', False), timeseries, profiler,
+                   cardinality)
+
+    if config.get('SAVE_AGGREGATES', False):
+        with profile_stage(profiler, 'save_aggregates'):
+            save_aggregate(aggregate_file_name(report_file), res.to_sketch(config),
+                           {'log_file': os.path.basename(log_file), 'lines': acc}, sampler.scale, collectors)
+
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(profile_file_name(report_file, '.prof'))
+
+    if profiler is not None:
+        summary = profiler.summary()
+        summary['log_file'] = os.path.basename(log_file)
+        summary['lines'] = acc
+        summary['parse_errors'] = errors.reasons
+        logging.info('Profile: %s' % json.dumps(summary, sort_keys=True))
+        with open(profile_file_name(report_file, '.profile.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+def backfill_task(task: tuple)->tuple:
+    '''Worker: building one missing report, returns (log_file, seconds, error). '''
+
+    config, log_file, report_file = task
+    start = time.perf_counter()
+
+    try:
+        build_report(config, log_file, report_file)
+        error = None
+    except Exception as e:
+        logging.error('Report for %s failed: %s' % (log_file, repr(e)))
+        error = repr(e)
+
+    return log_file, time.perf_counter() - start, error
+
+
+def backfill(config: dict)->list:
+    '''Building reports for every log file which has no report yet, several files at once. '''
+
+    manifest = get_manifest(config)
+    if manifest is not None and not config.get('INCREMENTAL', False):
+        log_dir = os.path.join(os.path.abspath(os.getcwd()), config['LOG_DIR'])
+        log_files = [os.path.join(log_dir, x) for x in manifest.pending()]
+    else:
+        log_files = get_log_files(config)
+
+    tasks = dict()
+    for log_file in log_files:
+        report_file = report_file_name(config, log_file)
+        if config.get('INCREMENTAL', False) or not os.path.isfile(report_file):
+            tasks[report_file] = log_file  # the last of the same day logs wins
+
+    jobs = int(config.get('BACKFILL_JOBS', 0) or os.cpu_count() or 1)
+    logging.info('Backfill: %s reports to build in %s jobs' % (len(tasks), jobs))
+
+    # pool workers can't start their own pools
+    worker_config = dict(config, WORKERS=1)
+    tasks = [(worker_config, log_file, report_file) for report_file, log_file in sorted(tasks.items())]
+
+    res = []
+    if tasks:
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            for log_file, elapsed, error in pool.imap_unordered(backfill_task, tasks):
+                logging.info('Backfill: %s done in %.2f sec%s' % (
+                    log_file, elapsed, ' with error ' + error if error else ''))
+                res.append((log_file, elapsed, error))
+
+    failed = [x for x in res if x[2]]
+    if failed:
+        raise RuntimeError('Backfill: {} of {} reports failed'.format(len(failed), len(res)))
+
+    return res
+
+
+class DirectoryWatcher(object):
+    '''
+    Waiting for changes in directory through inotify where it is available (Linux),
+    otherwise wait() just sleeps and the caller polls.
+    '''
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self, directory: str):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return
+            mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                os.close(fd)
+                return
+            self.fd = fd
+        except (OSError, AttributeError):
+            logging.info('inotify is not available, log directory is polled')
+
+    def wait(self, timeout: float):
+        '''Returning after a change in directory or after timeout. '''
+
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class LogTail(object):
+    '''
+    Aggregates of a growing log file. Every update() parses only data appended since the previous one,
+    up to the last complete line (or complete gzip member), so work is proportional to the new lines.
+    render() goes over the whole aggregate: only with bounded (sketch, histogram, topk) aggregation
+    its cost doesn't grow with the lines read, see follow.
+    '''
+
+    def __init__(self, config: dict, log_file: str):
+        self.config = config
+        self.log_file = log_file
+        stat = os.stat(log_file)
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.size = -1
+        self.offset = 0
+        self.acc = [0]
+        self.res = make_aggregator(config)
+        self.collectors = make_collectors(config)
+        self.errors = ParseErrors(config, abort=False)  # a live log is never given up
+        self.reported = 0  # unrecognized lines already logged
+        self.normalize = make_normalizer(config)
+        self.line_filter = make_filter(config)
+        self.changed = False
+
+    def replaced(self)->bool:
+        '''Whether log file was replaced or truncated since it has been opened. '''
+
+        try:
+            stat = os.stat(self.log_file)
+        except FileNotFoundError:
+            return True
+
+        return (stat.st_dev, stat.st_ino) != self.identity or stat.st_size < self.offset
+
+    def update(self)->int:
+        '''Aggregating data appended since the last update, returns the number of new lines. '''
+
+        size = os.path.getsize(self.log_file)
+        if size == self.size:
+            return 0
+        self.size = size
+
+        # new data goes into fresh aggregates, so an incomplete gzip member leaves nothing behind
+        part = make_aggregator(self.config)
+        collectors = make_collectors(self.config)
+        errors = ParseErrors(self.config, abort=False)
+        acc = [self.acc[0]]
+        position = dict()
+        blocks = read_blocks(self.log_file, offset=self.offset, position=position, whole_lines=True)
+        records = parse_lines(split_lines(blocks), acc, self.config.get('STRICT_PARSING', False), None,
+                              self.normalize, self.config.get('URL_CACHE_SIZE', 1000000), list(collectors.values()),
+                              errors, self.line_filter)
+        try:
+            consume(part, records, acc)
+        except EOFError:
+            logging.info('Last gzip member of %s is not complete yet' % self.log_file)
+            return 0
+
+        self.res.merge(part)
+        merge_collectors(self.collectors, collectors)
+        self.errors.merge(errors)
+        lines = acc[0] - self.acc[0]
+        self.acc = acc
+        self.offset = position['offset']
+        self.changed = self.changed or lines > 0
+
+        return lines
+
+    def render(self):
+        '''Refreshing report of log file from the current aggregates. '''
+
+        if not len(self.res):
+            return
+
+        report_file = report_file_name(self.config, self.log_file)
+        timeseries = self.collectors['timeseries'].report() if 'timeseries' in self.collectors else None
+        data = prepare_report_data(self.config, self.res)
+        cardinality = None
+        if 'cardinality' in self.collectors:
+            cardinality = self.collectors['cardinality'].report()
+            self.collectors['cardinality'].annotate(data)
+        save_to_report(self.config, report_file, data, True, timeseries, cardinality=cardinality)
+        logging.info('Report %s refreshed, %s lines processed' % (report_file, self.acc[0]))
+        if self.errors.count > self.reported:
+            self.errors.log(self.acc[0])
+            self.reported = self.errors.count
+        self.changed = False
+
+
+def follow(config: dict, stop=None):
+    '''
+    Following the newest log in LOG_DIR: appended lines are aggregated as they come,
+    the report is refreshed at most every FOLLOW_INTERVAL seconds and only if there are new lines.
+    When a newer dated log appears the current one is read to the end, its report is refreshed
+    and the new log is followed. stop() is checked before every step.
+    Aggregation is histogram unless AGGREGATION is set: a refresh of exact aggregates copies
+    every request_time of the report URLs, so its cost would grow with the lines read.
+    '''
+
+    aggregation = config.get('AGGREGATION', None)
+    if not aggregation:
+        config = dict(config, AGGREGATION='histogram')
+    elif aggregation in ('exact', 'packed'):
+        logging.warning('Aggregation %s keeps every request_time, every report refresh in follow mode goes over '
+                        'all of them. Consider AGGREGATION histogram or sketch.' % aggregation)
+
+    interval = float(config.get('FOLLOW_INTERVAL', 60))
+    poll = float(config.get('FOLLOW_POLL', 1) or 1)
+    watcher = DirectoryWatcher(config['LOG_DIR'])
+    tail = None
+    rendered = None
+
+    logging.info('Following log directory %s' % config['LOG_DIR'])
+
+    try:
+        while stop is None or not stop():
+            log_files = get_log_files(config)
+            log_file = log_files[-1] if log_files else None
+
+            if tail is not None and (tail.log_file != log_file or tail.replaced()):
+                if not tail.replaced():
+                    tail.update()
+                if tail.changed:
+                    tail.render()
+                logging.info('Log file %s is rotated, following %s' % (tail.log_file, log_file))
+                tail = None
+
+            if tail is None and log_file is not None:
+                tail = LogTail(config, log_file)
+                rendered = None
+
+            if tail is not None:
+                tail.update()
+                if tail.changed and (rendered is None or time.monotonic() - rendered >= interval):
+                    tail.render()
+                    rendered = time.monotonic()
+
+            if watcher.fd is None:
+                watcher.wait(poll)
+            elif tail is not None and tail.changed:
+                watcher.wait(max(0.0, interval - (time.monotonic() - rendered)))
+            else:
+                watcher.wait(max(poll, interval))
+    finally:
+        watcher.close()
+        if tail is not None and tail.changed:
+            tail.render()
+
+
 def main(config: dict):
     """ Main handler function"""
         
@@ -218,44 +3463,28 @@ def main(config: dict):
     logging.info('Start proccessing...')
     
     try:
+        if config.get('ROLLUP_DAYS', 0):
+            rollup(config, int(config['ROLLUP_DAYS']))
+            logging.info('Task completed.')
+            return
+
+        if config.get('BACKFILL', False):
+            backfill(config)
+            logging.info('Task completed.')
+            return
+
+        if config.get('FOLLOW', False):
+            follow(config)
+            logging.info('Task completed.')
+            return
+
         log_file = get_report_name(config)
-        report_file = check_report_file(config, log_file)
+        report_file = check_report_file(config, log_file, config.get('INCREMENTAL', False))
                 
         if not report_file:
             return
         
-        res, acc = logs_handler(config, log_file)
-        acc = acc[0]
-        
-        logging.info('Log file processed. Start preparing information...')
-                      
-        total_requests = reduce(lambda a, x: a + x['counter'], res.values(), 0)
-        total_time = reduce(lambda a, x: a + sum(x['times']), res.values(), 0)
-        
-        if (total_requests / acc) <  config.get('MIN_LINES', 0.5):
-            logging.error("Processed less then {!s} lines of log report (now processed "
-            "{!s} lines of total {!s} lines, program stopped, please, consider changing "
-            "MIN_LINES config's variable (assign persentage of total lines to be processed"
-            ).format(total_requests, acc, config.get('MIN_LINES', 0.5))
-            raise ValueError
-        
-        data_to_save = []
-        for req, val in res.items():
-            line = dict()
-            line['request'] = req
-            line['counter'] = val['counter']
-            line['count_perc'] = round((val['counter'] / total_requests) * 100, 3)
-            line['time_sum'] = round(sum(val['times']), 3)
-            line['time_perc'] = round((line['time_sum'] / total_time) * 100, 3)
-            line['time_avg'] = round(line['time_sum'] / len(val['times']), 3)
-            line['time_max'] = round(max(val['times']), 3)
-            line['time_med'] = round(median(val['times']), 3)
-            
-            data_to_save.append(line)
-            
-        logging.info('Information prepared. Start saving to report...')
-        
-        save_to_report(config, report_file, data_to_save)
+        build_report(config, log_file, report_file)
         
         logging.info('Task completed.')
         
@@ -268,10 +3497,100 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Parsing log files',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--config', nargs='?', default='./config.cfg', help='Path to a config file.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes for parsing log file.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Parse only lines appended since the previous run and refresh the report.')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Build reports for all log files which have no report yet.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of log files processed at once in backfill mode.')
+    parser.add_argument('--sampling', choices=sorted(SAMPLERS), default=None,
+                        help='Full scan, every N-th line or time-stratified reservoir sample.')
+    parser.add_argument('--sampling-step', type=int, default=None, help='N for every N-th line sampling.')
+    parser.add_argument('--reservoir-size', type=int, default=None, help='Lines in reservoir sample.')
+    parser.add_argument('--max-lines', type=int, default=None, help='Stop after reading this many lines.')
+    parser.add_argument('--max-seconds', type=float, default=None, help='Stop after parsing this long.')
+    parser.add_argument('--normalize-urls', default=None,
+                        help='Comma separated URL rules ({}) or all.'.format(', '.join(x[0] for x in URL_RULES)))
+    parser.add_argument('--save-aggregates', action='store_true',
+                        help='Write binary per-URL aggregate next to every report.')
+    parser.add_argument('--rollup', type=int, default=None, metavar='DAYS',
+                        help='Build report of the last DAYS days from saved aggregates.')
+    parser.add_argument('--aggregation', choices=sorted(AGGREGATORS), default=None,
+                        help='Per-URL aggregation: exact lists or bounded-memory sketches.')
+    parser.add_argument('--manifest', default=None, metavar='FILE',
+                        help='Keep JSON index of LOG_DIR in FILE, so only new log files are looked at.')
+    parser.add_argument('--follow', action='store_true',
+                        help='Keep running: tail the newest log and refresh its report.')
+    parser.add_argument('--follow-interval', type=float, default=None,
+                        help='Seconds between report refreshes in follow mode.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Log time of every stage and save it to report-YYYY.MM.DD.profile.json.')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='Also dump cProfile stats to report-YYYY.MM.DD.prof.')
+    parser.add_argument('--url-prefix', action='append', default=None, metavar='PREFIX',
+                        help='Only requests to URLs with this prefix, may be repeated.')
+    parser.add_argument('--methods', default=None, help='Only these methods, e.g. GET,POST.')
+    parser.add_argument('--status', default=None, help='Only these status codes, e.g. 200-299,404.')
+    parser.add_argument('--time-window', default=None, metavar='HH:MM-HH:MM',
+                        help='Only requests in this time of day.')
+    parser.add_argument('--memory-budget', type=float, default=None, metavar='MB',
+                        help='Spill aggregates to disk when they take more memory.')
+    parser.add_argument('--engine', choices=['python', 'numpy'], default=None,
+                        help='Exact aggregation in pure Python or vectorized with NumPy.')
+    parser.add_argument('--timeseries', action='store_true',
+                        help='Add requests and request_time per minute to the report.')
+    parser.add_argument('--cardinality', action='store_true',
+                        help='Add estimated distinct clients per URL and distinct URLs to the report.')
     args = parser.parse_args()
     
     try:
         config = load_config(args.config)        
+        if args.workers:
+            config['WORKERS'] = args.workers
+        if args.incremental:
+            config['INCREMENTAL'] = True
+        if args.backfill:
+            config['BACKFILL'] = True
+        if args.jobs:
+            config['BACKFILL_JOBS'] = args.jobs
+        for key in ['sampling', 'sampling_step', 'reservoir_size', 'max_lines', 'max_seconds']:
+            if getattr(args, key) is not None:
+                config[key.upper()] = getattr(args, key)
+        if args.normalize_urls:
+            config['NORMALIZE_URLS'] = OPTIONAL_CONFIG['NORMALIZE_URLS'](args.normalize_urls)
+        if args.save_aggregates:
+            config['SAVE_AGGREGATES'] = True
+        if args.rollup:
+            config['ROLLUP_DAYS'] = args.rollup
+        if args.aggregation:
+            config['AGGREGATION'] = args.aggregation
+        if args.timeseries:
+            config['TIMESERIES'] = True
+        if args.cardinality:
+            config['CARDINALITY'] = True
+        if args.engine:
+            config['ENGINE'] = args.engine
+        if args.memory_budget:
+            config['MEMORY_BUDGET'] = args.memory_budget
+        if args.url_prefix:
+            config['URL_PREFIXES'] = args.url_prefix
+        if args.methods:
+            config['METHODS'] = OPTIONAL_CONFIG['METHODS'](args.methods)
+        for key in ['status', 'time_window']:
+            if getattr(args, key):
+                config[key.upper()] = getattr(args, key)
+        if args.profile:
+            config['PROFILE'] = True
+        if args.follow:
+            config['FOLLOW'] = True
+        if args.manifest:
+            config['MANIFEST_FILE'] = args.manifest
+        if args.follow_interval is not None:
+            config['FOLLOW_INTERVAL'] = args.follow_interval
+        if args.cprofile:
+            config['CPROFILE'] = True
         main(config)
     except Exception as e:
         print(repr(e))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Reproducible generator of synthetic nginx ui_short logs.
+"""
+
+import argparse
+import bisect
+import gzip
+import itertools
+import random
+from datetime import datetime, timedelta
+
+
+URL_TEMPLATES = [
+    '/api/v2/banner/{id}',
+    '/api/v2/banner/{id}/statistic/?date_from=2017-06-{day:02d}&date_to=2017-06-30',
+    '/api/v2/group/{id}/banners',
+    '/api/v2/slot/{id}/groups',
+    '/api/1/photo/{id}/',
+    '/api/v2/internal/html5/phantomjs/queue/?wait=1m',
+    '/export/appinstall_raw/2017-06-{day:02d}/',
+    '/accounts/login/?next=/campaigns/{id}/',
+]
+
+USER_AGENTS = [
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'python-requests/2.13.0',
+    'Slotovod',
+    '-',
+]
+
+LINE = '{ip} -  - [{time}] "{method} {url} HTTP/1.1" {status} {size} "-" "{agent}" "-" "{request_id}" "{user}" {rt:.3f}\n'
+
+LATENCIES = ['lognormal', 'exponential', 'uniform']
+
+MEAN_LINE_SIZE = 215  # close to the real ui_short lines, used to spread timestamps over the day
+
+
+def parse_size(value: str)->int:
+    '''Size with optional K/M/G suffix, e.g. 512M. '''
+
+    value = value.strip().upper()
+    for suffix, factor in [('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30)]:
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+
+    return int(value)
+
+
+class LogGenerator(object):
+    '''
+    Lines of a day of ui_short log. URL popularity is Zipf with exponent zipf over urls distinct URLs,
+    request_time follows the latency distribution, scaled by a per-URL factor, so some URLs are slow.
+    A bad_lines share of lines is garbage which the parser has to skip.
+    '''
+
+    def __init__(self, urls: int = 10000, zipf: float = 1.1, latency: str = 'lognormal', mean: float = 0.3,
+                 bad_lines: float = 0.0, date: str = '20170630', seed: int = 0):
+        if latency not in LATENCIES:
+            raise ValueError('Unknown latency distribution: {}'.format(latency))
+        if urls < 1:
+            raise ValueError('At least one URL is needed')
+
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.mean = mean
+        self.bad_lines = bad_lines
+        self.day = datetime.strptime(date, '%Y%m%d')
+
+        self.urls = [self.make_url(i) for i in range(urls)]
+        self.factors = [self.random.lognormvariate(0, 0.5) for _ in range(urls)]
+        self.cum_weights = list(itertools.accumulate(1 / (rank ** zipf) for rank in range(1, urls + 1)))
+
+    def make_url(self, i: int)->str:
+        template = URL_TEMPLATES[i % len(URL_TEMPLATES)]
+
+        return template.format(id=self.random.randrange(10 ** 7), day=1 + i % 30)
+
+    def request_time(self, url_id: int)->float:
+        if self.latency == 'lognormal':
+            value = self.random.lognormvariate(0, 1) * self.mean / 1.6487  # mean of lognormal(0, 1) is e ** 0.5
+        elif self.latency == 'exponential':
+            value = self.random.expovariate(1 / self.mean)
+        else:
+            value = self.random.uniform(0, 2 * self.mean)
+
+        return max(0.001, value * self.factors[url_id])
+
+    def lines(self, count: int):
+        '''Yields count lines, timestamps are spread evenly over the day. '''
+
+        rnd = self.random
+        stamp = stamp_second = None
+        total = self.cum_weights[-1]
+
+        for i in range(count):
+            if self.bad_lines and rnd.random() < self.bad_lines:
+                yield 'garbage line {} without request\n'.format(rnd.randrange(10 ** 9))
+                continue
+
+            second = int(i * 86400 / count)
+            if second != stamp_second:
+                stamp_second = second
+                stamp = (self.day + timedelta(seconds=second)).strftime('%d/%b/%Y:%H:%M:%S +0300')
+
+            url_id = bisect.bisect(self.cum_weights, rnd.random() * total)
+            yield LINE.format(
+                ip='{}.{}.{}.{}'.format(rnd.randrange(1, 224), rnd.randrange(256), rnd.randrange(256),
+                                        rnd.randrange(256)),
+                time=stamp,
+                method='GET' if rnd.random() < 0.9 else 'POST',
+                url=self.urls[url_id],
+                status=200 if rnd.random() < 0.97 else 404,
+                size=rnd.randrange(100, 100000),
+                agent=USER_AGENTS[rnd.randrange(len(USER_AGENTS))],
+                request_id='{}-{}-4709-{}'.format(1498770000 + second, rnd.randrange(10 ** 10),
+                                                  rnd.randrange(10 ** 7)),
+                user='{:09x}'.format(rnd.randrange(16 ** 9)) if rnd.random() < 0.8 else '-',
+                rt=self.request_time(url_id))
+
+    def write(self, path: str, size: int, compress: bool = False, batch: int = 10000)->dict:
+        '''Writing about size bytes of log (uncompressed), returns lines and bytes written. '''
+
+        count = max(1, size // MEAN_LINE_SIZE)
+        lines = written = 0
+        opener = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) if compress else \
+            open(path, 'w', encoding='utf-8')
+
+        with opener as f:
+            source = self.lines(count)
+            while written < size:
+                chunk = ''.join(itertools.islice(source, batch))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+                lines += chunk.count('\n')
+
+        return {'lines': lines, 'bytes': written}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Synthetic ui_short log generator',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', help='Output file, e.g. log/nginx-access-ui.log-20170630.gz')
+    parser.add_argument('--size', default='100M', help='Uncompressed size, K/M/G suffixes are allowed.')
+    parser.add_argument('--urls', type=int, default=10000, help='Distinct URLs.')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of URL popularity.')
+    parser.add_argument('--latency', choices=LATENCIES, default='lognormal', help='request_time distribution.')
+    parser.add_argument('--mean', type=float, default=0.3, help='Mean request_time before per-URL factors.')
+    parser.add_argument('--bad-lines', type=float, default=0.0, help='Share of unparsable lines.')
+    parser.add_argument('--date', default='20170630', help='Day of the log, YYYYMMDD.')
+    parser.add_argument('--gzip', action='store_true', help='Compress the output.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, the same seed gives the same log.')
+    args = parser.parse_args()
+
+    generator = LogGenerator(args.urls, args.zipf, args.latency, args.mean, args.bad_lines, args.date, args.seed)
+    res = generator.write(args.path, parse_size(args.size), args.gzip)
+    print('{lines} lines, {bytes} bytes written'.format(**res))
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Mergeable streaming sketches used by the log analyzer aggregators.
+"""
+
+import hashlib
+import math
+import random
+
+
+class KLLSketch(object):
+    """
+    KLL quantile sketch (Karnin, Lang, Liberty).
+    Rank error of quantile() is about accuracy * count with high probability,
+    memory is O(1 / accuracy * log(count)) regardless of the stream length.
+    """
+
+    __slots__ = ('k', 'compactors', 'size', 'max_size', 'count')
+
+    def __init__(self, accuracy: float = 0.01):
+        self.k = max(8, int(math.ceil(1.65 / accuracy)))
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self.count = 0
+        self._grow()
+
+    def _capacity(self, height: int)->int:
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _compress(self):
+        for h, items in enumerate(self.compactors):
+            if len(items) >= self._capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self._grow()
+                items.sort()
+                self.compactors[h + 1].extend(items[random.getrandbits(1)::2])
+                self.compactors[h] = []
+                self.size = sum(len(c) for c in self.compactors)
+                return
+
+    def update(self, value: float):
+        self.compactors[0].append(value)
+        self.size += 1
+        self.count += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other: 'KLLSketch')->'KLLSketch':
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for h, items in enumerate(other.compactors):
+            self.compactors[h].extend(items)
+        self.count += other.count
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+
+        return self
+
+    def quantiles(self, qs)->list:
+        """Values at ranks q * count for every q in qs."""
+
+        weighted = sorted((value, 1 << h) for h, items in enumerate(self.compactors) for value in items)
+        if not weighted:
+            return [None for _ in qs]
+
+        total = sum(w for _, w in weighted)
+        res = [None] * len(qs)
+        pos = acc = 0
+        for i in sorted(range(len(qs)), key=lambda x: qs[x]):
+            rank = qs[i] * total
+            while pos < len(weighted) - 1 and acc + weighted[pos][1] <= rank:
+                acc += weighted[pos][1]
+                pos += 1
+            res[i] = weighted[pos][0]
+
+        return res
+
+    def quantile(self, q: float)->float:
+        return self.quantiles([q])[0]
+
+    def levels(self)->list:
+        """Compactor contents from level 0 up, for serialization."""
+
+        return self.compactors
+
+    @classmethod
+    def from_levels(cls, levels: list, count: int, accuracy: float = 0.01)->'KLLSketch':
+        sketch = cls(accuracy)
+        while len(sketch.compactors) < len(levels):
+            sketch._grow()
+        for h, items in enumerate(levels):
+            sketch.compactors[h] = list(items)
+        sketch.count = count
+        sketch.size = sum(len(c) for c in sketch.compactors)
+        while sketch.size >= sketch.max_size:
+            sketch._compress()
+
+        return sketch
+
+
+class SpaceSaving(object):
+    """
+    Weighted heavy hitters in O(k) memory: Space-Saving with batched eviction.
+    For every kept key value - error <= true weight <= value, error never exceeds floor,
+    and every key with true weight above floor is kept.
+    """
+
+    __slots__ = ('k', 'items', 'floor')
+
+    def __init__(self, k: int):
+        self.k = k
+        self.items = dict()  # key -> [value, error, payload]
+        self.floor = 0.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _prune(self):
+        if len(self.items) <= self.k:
+            return
+        ordered = sorted(self.items.items(), key=lambda x: x[1][0], reverse=True)
+        self.floor = max(self.floor, ordered[self.k][1][0])
+        self.items = dict(ordered[:self.k])
+
+    def update(self, key, weight: float, payload=None):
+        """Adding weight to key, returns its [value, error, payload] entry."""
+
+        item = self.items.get(key, None)
+        if item is None:
+            if len(self.items) >= 2 * self.k:
+                self._prune()
+            item = self.items[key] = [self.floor + weight, self.floor, payload]
+        else:
+            item[0] += weight
+
+        return item
+
+    def merge(self, other: 'SpaceSaving', merge_payload=None)->'SpaceSaving':
+        for key, item in self.items.items():
+            if key not in other.items:
+                item[0] += other.floor
+                item[1] += other.floor
+        for key, (value, error, payload) in other.items.items():
+            item = self.items.get(key, None)
+            if item is None:
+                self.items[key] = [value + self.floor, error + self.floor, payload]
+            else:
+                item[0] += value
+                item[1] += error
+                if merge_payload is not None:
+                    item[2] = merge_payload(item[2], payload)
+        self.floor += other.floor
+        self._prune()
+
+        return self
+
+    def top(self, n: int = None)->list:
+        """(key, value, error, payload) of n heaviest keys."""
+
+        ordered = sorted(self.items.items(), key=lambda x: x[1][0], reverse=True)
+
+        return [(key, value, error, payload) for key, (value, error, payload) in ordered[:n]]
+
+
+class LogHistogram(object):
+    """
+    HDR-style log-linear histogram: every power of two is split into equal sub-buckets,
+    so a value is known with relative error of at most precision. Histograms with the same
+    precision are merged by adding counts, quantiles cost O(buckets).
+    """
+
+    __slots__ = ('precision', 'sub', 'counts', 'count')
+
+    ZERO = -(1 << 31)  # bucket of non-positive values
+
+    def __init__(self, precision: float = 0.01):
+        self.precision = precision
+        self.sub = int(0.5 / precision) + 1
+        self.counts = dict()
+        self.count = 0
+
+    def index(self, value: float)->int:
+        if value <= 0:
+            return self.ZERO
+        mantissa, exponent = math.frexp(value)
+
+        return exponent * self.sub + int((2 * mantissa - 1) * self.sub)
+
+    def value(self, index: int)->float:
+        """Middle of bucket."""
+
+        if index == self.ZERO:
+            return 0.0
+        exponent, sub_bucket = divmod(index, self.sub)
+
+        return math.ldexp(0.5 * (1 + (sub_bucket + 0.5) / self.sub), exponent)
+
+    def update(self, value: float, count: int = 1):
+        index = self.index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other: 'LogHistogram')->'LogHistogram':
+        if other.sub != self.sub:
+            raise ValueError('Histograms of different precision can not be merged')
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+
+        return self
+
+    def quantiles(self, qs)->list:
+        """Values at ranks q * count for every q in qs."""
+
+        if not self.count:
+            return [None for _ in qs]
+
+        buckets = sorted(self.counts.items())
+        res = [None] * len(qs)
+        pos = acc = 0
+        for i in sorted(range(len(qs)), key=lambda x: qs[x]):
+            rank = qs[i] * self.count
+            while pos < len(buckets) - 1 and acc + buckets[pos][1] <= rank:
+                acc += buckets[pos][1]
+                pos += 1
+            res[i] = self.value(buckets[pos][0])
+
+        return res
+
+    def quantile(self, q: float)->float:
+        return self.quantiles([q])[0]
+
+
+def hash64(value: bytes)->int:
+    """64-bit hash which is the same in every process, unlike hash()."""
+
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog distinct count (Flajolet et al.) with linear counting for small cardinalities.
+    Relative standard error is 1.04 / sqrt(2 ** precision), memory is 2 ** precision bytes,
+    sketches of the same precision are merged by register-wise maximum.
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision: int = 12):
+        if not 4 <= precision <= 18:
+            raise ValueError('HyperLogLog precision must be in 4..18')
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: bytes):
+        self.add_hash(hash64(value))
+
+    def add_hash(self, h: int):
+        """Adding value by its hash64, so a hash can be shared by several sketches."""
+
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog')->'HyperLogLog':
+        if other.precision != self.precision:
+            raise ValueError('Sketches of different precision can not be merged')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+        return self
+
+    @property
+    def relative_error(self)->float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def count(self)->float:
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        # registers are counted by value, it is a few passes in C instead of a sum over m registers
+        total = sum(self.registers.count(r) * 2.0 ** -r for r in range(max(self.registers) + 1))
+        estimate = alpha * m * m / total
+
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            return m * math.log(m / zeros)
+
+        return estimate
+
+    @classmethod
+    def from_registers(cls, registers: bytes)->'HyperLogLog':
+        sketch = cls(len(registers).bit_length() - 1)
+        sketch.registers = bytearray(registers)
+
+        return sketch
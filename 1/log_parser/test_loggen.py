@@ -0,0 +1,58 @@
+"""
+    Testing the synthetic log generator.
+"""
+import unittest
+import tempfile
+import os
+import gzip
+
+import log_analyzer
+import loggen
+
+
+class TestLogGenerator(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(loggen.parse_size('512'), 512)
+        self.assertEqual(loggen.parse_size('2k'), 2048)
+        self.assertEqual(loggen.parse_size('1.5G'), 3 << 29)
+
+    def test_lines__reproducible_and_parsable(self):
+        lines = list(loggen.LogGenerator(urls=50, seed=1).lines(1000))
+
+        self.assertEqual(lines, list(loggen.LogGenerator(urls=50, seed=1).lines(1000)))
+        self.assertNotEqual(lines, list(loggen.LogGenerator(urls=50, seed=2).lines(1000)))
+        for line in lines:
+            self.assertIsNotNone(log_analyzer.parse_line(line, True))
+        self.assertIn('[30/Jun/2017:00:00:00 +0300]', lines[0])
+        self.assertIn('[30/Jun/2017:23:58:33 +0300]', lines[-1])
+
+    def test_lines__zipf_popularity(self):
+        generator = loggen.LogGenerator(urls=100, zipf=1.2, bad_lines=0.1)
+        counts = dict()
+        bad = 0
+        for line in generator.lines(20000):
+            record = log_analyzer.parse_line(line, True)
+            if record is None:
+                bad += 1
+            else:
+                counts[record.url] = counts.get(record.url, 0) + 1
+
+        self.assertAlmostEqual(bad / 20000, 0.1, delta=0.01)
+        self.assertEqual(max(counts, key=counts.get), generator.urls[0])
+        self.assertGreater(counts[generator.urls[0]], 2 ** 1.2 * 0.8 * counts[generator.urls[1]])
+
+    def test_write__gzip_size(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            res = loggen.LogGenerator(urls=10).write(path, 100000, compress=True)
+            with gzip.open(path, 'rb') as f:
+                data = f.read()
+
+        self.assertEqual(len(data), res['bytes'])
+        self.assertEqual(data.count(b'\n'), res['lines'])
+        self.assertAlmostEqual(res['bytes'], 100000, delta=2000)
+
+
+if __name__ == '__main__':
+        unittest.main()
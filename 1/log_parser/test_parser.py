@@ -4,10 +4,36 @@
 import unittest
 import tempfile
 import os
+import shutil
+import gzip
+import json
+import time
+import queue
+import threading
+from unittest import mock
+from statistics import median
+from array import array
 
 import log_analyzer
 
 
+LOG_LINE = '1.196.116.32 -  - [29/Jun/2017:03:52:22 +0300] "GET {} HTTP/1.1" 200 976 "-" "Lynx/2.8.8dev.9" "-" ' \
+           '"1498697540-2190034393-4709-9930664" "dc7161be3" {}\n'
+
+
+def write_log(f, count=1000):
+    """Writing count of ui_short lines to file object, returns requests per url."""
+
+    urls = dict()
+    for i in range(count):
+        url = '/api/v2/banner/{}'.format(i % 7)
+        f.write(LOG_LINE.format(url, '{:.3f}'.format(0.1 + i % 13)))
+        urls[url] = urls.get(url, 0) + 1
+    f.flush()
+
+    return urls
+
+
 class TestLogger(unittest.TestCase):
     
     def test_load_config_good(self):
@@ -166,6 +192,959 @@ class TestLogger(unittest.TestCase):
         request_time, request_url = log_analyzer.process_line(input_string)
         
         self.assertEqual((request_time, request_url), (None, None))        
-        
+
+    def test_parse_line__strict_all_fields(self):
+        input_string = '1.196.116.32 -  - [29/Jun/2017:03:52:22 +0300] "GET /api/v2/banner/24852159 HTTP/1.1" \
+        200 976 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" \
+        "1498697540-2190034393-4709-9930664" "dc7161be3" 1.390'
+
+        record = log_analyzer.parse_line(input_string, strict=True)
+
+        self.assertEqual(record.remote_addr, '1.196.116.32')
+        self.assertEqual(record.time_local, '29/Jun/2017:03:52:22 +0300')
+        self.assertEqual(record.method, 'GET')
+        self.assertEqual(record.url, '/api/v2/banner/24852159')
+        self.assertEqual(record.status, 200)
+        self.assertEqual(record.body_bytes_sent, 976)
+        self.assertEqual(record.http_x_rb_user, 'dc7161be3')
+        self.assertEqual(record.request_time, 1.39)
+
+    def test_parse_line__strict_vs_lenient(self):
+        input_string = '1.196.116.32 - [broken] "PUT /api/1/ HTTP/1.1" 200 0.5'
+
+        self.assertIsNone(log_analyzer.parse_line(input_string, strict=True))
+
+        record = log_analyzer.parse_line(input_string, strict=False)
+
+        self.assertEqual((record.method, record.url, record.request_time), ('PUT', '/api/1/', 0.5))
+        self.assertIsNone(record.status)
+
+    def test_split_file__aligned_ranges(self):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8') as f:
+            write_log(f, 100)
+            ranges = log_analyzer.split_file(f.name, 7)
+
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], os.path.getsize(f.name))
+            with open(f.name, 'rb') as g:
+                for start, end in ranges:
+                    g.seek(start - 1 if start else 0)
+                    self.assertTrue(start == 0 or g.read(1) == b'\n')
+
+    def test_logs_handler__parallel(self):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8') as f:
+            urls = write_log(f, 1000)
+
+            size = os.path.getsize(f.name)
+            single, lines, _, _, _ = log_analyzer.process_range((f.name, 0, size, size, False, {}))
+            res, acc = log_analyzer.logs_handler({'WORKERS': 4}, f.name)
+
+            self.assertEqual(acc[0], 1000)
+            self.assertEqual(lines, 1000)
+            self.assertEqual({k: v['counter'] for k, v in res.res.items()}, urls)
+            for url, val in res.res.items():
+                self.assertEqual(sorted(val['times']), sorted(single.res[url]['times']))
+
+    def test_process_log_file__plain_and_gzip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            packed = plain + '.gz'
+            with open(plain, 'w', encoding='utf-8') as f:
+                write_log(f, 300)
+            with open(plain, 'rb') as f:
+                data = f.read()
+            with open(packed, 'wb') as f:
+                # two gzip members, as after concatenating rotated files
+                f.write(gzip.compress(data[:len(data) // 2]) + gzip.compress(data[len(data) // 2:]))
+
+            plain_acc, packed_acc = [0], [0]
+            plain_res = list(log_analyzer.process_log_file(plain, plain_acc))
+            packed_res = list(log_analyzer.process_log_file(packed, packed_acc))
+
+            self.assertEqual(len(plain_res), 300)
+            self.assertEqual(plain_res, packed_res)
+            self.assertEqual(plain_acc, packed_acc)
+
+    def test_split_lines__across_blocks(self):
+        blocks = [b'ab', b'c\nd', b'\n\nef']
+
+        self.assertEqual(list(log_analyzer.split_lines(blocks)), [b'abc', b'd', b'', b'ef'])
+
+    def test_incremental_logs_handler__appended_lines(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {'REPORT_DIR': tmp, 'INCREMENTAL': True}
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            with open(log_file, 'w', encoding='utf-8') as f:
+                write_log(f, 100)
+                f.write(LOG_LINE.format('/partial', '1.0')[:30])
+
+            res, acc = log_analyzer.logs_handler(config, log_file)
+            self.assertEqual((res.total_requests(), acc[0]), (100, 100))
+
+            with open(log_file, 'a', encoding='utf-8') as f:
+                f.write(LOG_LINE.format('/partial', '1.0')[30:])
+                write_log(f, 50)
+
+            res, acc = log_analyzer.logs_handler(config, log_file)
+            self.assertEqual((res.total_requests(), acc[0]), (151, 151))
+            self.assertEqual(res.res['/partial']['counter'], 1)
+
+            res, acc = log_analyzer.logs_handler(config, log_file)
+            self.assertEqual((res.total_requests(), acc[0]), (151, 151))
+
+    def test_incremental_logs_handler__gzip_members(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {'REPORT_DIR': tmp, 'INCREMENTAL': True}
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            with open(log_file, 'wb') as f:
+                f.write(gzip.compress((LOG_LINE.format('/a', '1.0') * 10).encode()))
+
+            res, acc = log_analyzer.logs_handler(config, log_file)
+            self.assertEqual(acc[0], 10)
+
+            with open(log_file, 'ab') as f:
+                f.write(gzip.compress((LOG_LINE.format('/b', '1.0') * 5).encode()))
+
+            res, acc = log_analyzer.logs_handler(config, log_file)
+            self.assertEqual(acc[0], 15)
+            self.assertEqual((res.res['/a']['counter'], res.res['/b']['counter']), (10, 5))
+
+    def test_save_to_report__overwrite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            report = os.path.join(tmp, 'report-2017.06.30.html')
+            config = {'REPORT_SIZE': 10}
+            log_analyzer.save_to_report(config, report, [{'request': '/a', 'time_sum': 1}])
+
+            with self.assertRaises(FileExistsError):
+                log_analyzer.save_to_report(config, report, [{'request': '/b', 'time_sum': 1}])
+
+            # a file left by an earlier crash doesn't stop overwriting
+            with open(report + '.tmp', 'w') as f:
+                f.write('stale')
+            log_analyzer.save_to_report(config, report, [{'request': '/b', 'time_sum': 1}], overwrite=True)
+            with open(report, encoding='utf-8') as f:
+                self.assertIn('"/b"', f.read())
+            self.assertEqual(sorted(os.listdir(tmp)), ['report-2017.06.30.html', 'report-2017.06.30.html.tmp'])
+
+    def test_backfill__missing_reports_only(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            config = log_analyzer.load_config('./config.cfg')
+            config.update({'LOG_DIR': log_dir, 'REPORT_DIR': report_dir, 'BACKFILL_JOBS': 2})
+            for day in ['20170628', '20170629', '20170630']:
+                with open(os.path.join(log_dir, 'nginx-access-ui.log-' + day), 'w', encoding='utf-8') as f:
+                    write_log(f, 50)
+            with open(os.path.join(report_dir, 'report-2017.06.29.html'), 'w') as f:
+                f.write('done')
+
+            done = log_analyzer.backfill(config)
+
+            self.assertEqual(sorted(os.path.basename(x[0]) for x in done),
+                             ['nginx-access-ui.log-20170628', 'nginx-access-ui.log-20170630'])
+            self.assertTrue(all(x[2] is None for x in done))
+            self.assertEqual(sorted(os.listdir(report_dir)),
+                             ['report-2017.06.28.html', 'report-2017.06.29.html', 'report-2017.06.30.html'])
+            with open(os.path.join(report_dir, 'report-2017.06.29.html')) as f:
+                self.assertEqual(f.read(), 'done')
+
+    def sampled_report(self, config, count=1000, content=None):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8') as f:
+            if content:
+                f.write(content)
+                f.flush()
+            else:
+                write_log(f, count)
+
+            sampler = log_analyzer.make_sampler(config)
+            res, acc = log_analyzer.logs_handler(config, f.name, sampler)
+
+            return sampler, acc[0], log_analyzer.prepare_report_data(config, res, sampler)
+
+    def test_sampling__full_scan_by_default(self):
+        sampler, lines, rows = self.sampled_report({})
+
+        self.assertEqual((lines, sampler.scale), (1000, 1))
+        self.assertEqual(sum(x['counter'] for x in rows), 1000)
+        self.assertNotIn('counter_err', rows[0])
+        self.assertNotIn('prefix_extrapolated', rows[0])
+
+    def test_sampling__max_lines_budget_is_scaled(self):
+        sampler, lines, rows = self.sampled_report({'MAX_LINES': 250})
+
+        self.assertEqual(lines, 250)
+        self.assertTrue(sampler.exhausted)
+        self.assertAlmostEqual(sampler.coverage, 0.25, places=2)
+        self.assertAlmostEqual(sum(x['counter'] for x in rows), 1000, delta=10)
+        self.assertTrue(all(x['counter_err'] > 0 and x['prefix_extrapolated'] for x in rows))
+
+    def test_sampling__every_nth_line(self):
+        sampler, lines, rows = self.sampled_report({'SAMPLING': 'every', 'SAMPLING_STEP': 10})
+
+        self.assertEqual((lines, sampler.parsed), (1000, 100))
+        self.assertAlmostEqual(sampler.scale, 10)
+        self.assertEqual(sum(x['counter'] for x in rows), 1000)
+        self.assertTrue(all(x['counter_err'] > 0 for x in rows))
+
+    def test_sampling__time_stratified_reservoir(self):
+        content = ''.join(LOG_LINE.format('/api/{}'.format(i % 3), '1.0').replace(':03:', ':{:02d}:'.format(hour))
+                          for hour, count in [(1, 900), (2, 100)] for i in range(count))
+        config = {'SAMPLING': 'reservoir', 'RESERVOIR_SIZE': 100}
+
+        sampler, lines, rows = self.sampled_report(config, content=content)
+
+        self.assertEqual((sampler.valid, sampler.selected), (1000, 100))
+        self.assertAlmostEqual(sampler.scale, 10)
+        self.assertEqual(sum(x['counter'] for x in rows), 1000)
+        self.assertAlmostEqual(sum(x['time_sum'] for x in rows), 1000, places=3)
+
+    def test_make_normalizer__builtin_rules(self):
+        normalize = log_analyzer.make_normalizer({'NORMALIZE_URLS': ['all']})
+
+        self.assertEqual(normalize('/api/v2/banner/24852159'), '/api/v2/banner/{id}')
+        self.assertEqual(normalize('/api/v2/group/7/banners?limit=10'), '/api/v2/group/{id}/banners')
+        self.assertEqual(normalize('/export/1498697540-2190034393/'), '/export/1498697540-2190034393/')
+        self.assertEqual(normalize('/slot/dc7161be3/groups'), '/slot/{hex}/groups')
+        self.assertEqual(normalize('/u/0f8fad5b-d9cb-469f-a165-70867728950e'), '/u/{uuid}')
+        self.assertIsNone(log_analyzer.make_normalizer({}))
+
+        with self.assertRaises(ValueError):
+            log_analyzer.make_normalizer({'NORMALIZE_URLS': ['bad']})
+
+    def test_make_normalizer__rules_file(self):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8') as f:
+            f.write('# campaigns\n^/campaign/[^/]+ /campaign/{name}\n')
+            f.flush()
+
+            normalize = log_analyzer.make_normalizer({'NORMALIZE_URLS': ['id'], 'URL_RULES_FILE': f.name})
+
+            self.assertEqual(normalize('/campaign/spring/7'), '/campaign/{name}/{id}')
+
+    def test_logs_handler__normalized_urls(self):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8') as f:
+            write_log(f, 100)
+
+            res, acc = log_analyzer.logs_handler({'NORMALIZE_URLS': ['id']}, f.name)
+
+            self.assertEqual(list(res.res), ['/api/v2/banner/{id}'])
+            self.assertEqual(res.res['/api/v2/banner/{id}']['counter'], 100)
+
+    def test_prepare_report_data__report_size_rows_only(self):
+        res = log_analyzer.make_aggregator({})
+        for i in range(1000):
+            res.add('/api/{}'.format(i % 50), (i % 50) / 10 + 0.01)
+
+        rows = log_analyzer.prepare_report_data({'REPORT_SIZE': 10}, res)
+        all_rows = log_analyzer.prepare_report_data({}, res)
+
+        self.assertEqual(rows, sorted(all_rows, key=lambda x: x['time_sum'], reverse=True)[:10])
+
+    def test_prepare_report_data__topk(self):
+        config = {'AGGREGATION': 'topk', 'TOPK_SIZE': 20, 'REPORT_SIZE': 5}
+        exact, topk = log_analyzer.make_aggregator({}), log_analyzer.make_aggregator(config)
+        for i in range(20000):
+            url = '/heavy/{}'.format(i % 5) if i % 2 else '/light/{}'.format(i * 7919 % 3000)
+            exact.add(url, 1.0 + i % 5 if i % 2 else 0.5)
+            topk.add(url, 1.0 + i % 5 if i % 2 else 0.5)
+
+        expected = log_analyzer.prepare_report_data({'REPORT_SIZE': 5}, exact)
+        rows = log_analyzer.prepare_report_data(config, topk)
+
+        self.assertEqual([x['request'] for x in rows], [x['request'] for x in expected])
+        for row, exact_row in zip(rows, expected):
+            self.assertLessEqual(row['time_sum'] - row['time_sum_topk_err'], exact_row['time_sum'] + 0.001)
+            self.assertGreaterEqual(row['time_sum'] + 0.001, exact_row['time_sum'])
+            self.assertEqual(row['time_perc'] > 0, True)
+
+    def test_prepare_report_data__topk_average_of_counted_requests(self):
+        config = {'AGGREGATION': 'topk', 'TOPK_SIZE': 2}
+        topk = log_analyzer.make_aggregator(config)
+        for i in range(1000):
+            topk.add('/noise/{}'.format(i), 0.5)
+        for i in range(10):
+            topk.add('/late', 1.0)
+
+        rows = {x['request']: x for x in log_analyzer.prepare_report_data(config, topk)}
+
+        self.assertGreater(rows['/late']['time_sum_topk_err'], 0)
+        self.assertEqual(rows['/late']['time_avg'], 1.0)
+        self.assertIsNone(rows['/late']['count_perc'])
+        for row in rows.values():
+            self.assertLessEqual(row['time_avg'], row['time_max'])
+        self.assertEqual(topk.to_sketch(config).res['/late'][:3], [10, 10.0, 1.0])
+
+    def test_scan_mapped__same_as_blocks(self):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8', suffix = '.log') as f:
+            write_log(f, 100)
+            f.write('garbage\n\n1.1.1.1 - [broken] "PUT /lenient HTTP/1.1" 200 0.5\n')
+            f.write(LOG_LINE.format('/unbalanced', '"1.0').replace('"-"', '"-', 1))
+            f.write(LOG_LINE.format('/crlf', '2.0').replace('\n', '\r\n'))
+            write_log(f, 10)
+            f.write(LOG_LINE.format('/last', '3.0').rstrip('\n'))
+            f.flush()
+
+            for strict in [False, True]:
+                mapped_acc, blocks_acc = [0], [0]
+                mapped = list(log_analyzer.process_log_file(f.name, mapped_acc, strict))
+                blocks = list(log_analyzer.process_log_file(f.name, blocks_acc, strict, use_mmap=False))
+
+                self.assertEqual(mapped, blocks)
+                self.assertEqual(mapped_acc, blocks_acc)
+                self.assertEqual(mapped_acc[0], 116)
+                self.assertEqual((1.0, '/lenient') in mapped, False)
+                self.assertEqual((0.5, '/lenient') in mapped, not strict)
+                self.assertIn((3.0, '/last'), mapped)
+
+    def test_scan_mapped__range_and_empty(self):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8') as f:
+            self.assertEqual(list(log_analyzer.scan_mapped(f.name, [0])), [])
+
+            write_log(f, 100)
+            start, end = log_analyzer.split_file(f.name, 3)[1]
+            acc = [0]
+            mapped = list(log_analyzer.scan_mapped(f.name, acc, start=start, end=end))
+            blocks = list(log_analyzer.parse_lines(
+                log_analyzer.split_lines(log_analyzer.read_range_blocks(f.name, start, end)), [0]))
+
+            self.assertEqual(mapped, blocks)
+            self.assertEqual(acc[0], len(blocks))
+
+    def test_scan_mapped__long_run_of_broken_lines(self):
+        # none of these lines closes the date bracket, a match must not run over their ends
+        broken = LOG_LINE.format('/broken', '1.0').replace(']', '')
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8', suffix = '.log') as f:
+            write_log(f, 10)
+            f.write(broken * 20000)
+            write_log(f, 10)
+
+            started = time.monotonic()
+            mapped_acc, blocks_acc = [0], [0]
+            mapped = list(log_analyzer.process_log_file(f.name, mapped_acc))
+            self.assertLess(time.monotonic() - started, 10)
+
+            blocks = list(log_analyzer.process_log_file(f.name, blocks_acc, use_mmap=False))
+            self.assertEqual(mapped, blocks)
+            self.assertEqual(mapped_acc, blocks_acc)
+            self.assertEqual(mapped_acc[0], 20020)
+
+    def test_prepare_report_data__histogram_percentiles(self):
+        exact = log_analyzer.make_aggregator({})
+        hist = log_analyzer.make_aggregator({'AGGREGATION': 'histogram'})
+        for i in range(20000):
+            url = '/api/{}'.format(i % 3)
+            exact.add(url, (i * 7919 % 1000) / 100 + 0.01)
+            hist.add(url, (i * 7919 % 1000) / 100 + 0.01)
+
+        exact_rows = {x['request']: x for x in log_analyzer.prepare_report_data({'QUANTILES': [0.9, 0.95, 0.99]}, exact)}
+        rows = log_analyzer.prepare_report_data({}, hist)
+
+        for row in rows:
+            self.assertEqual(row['counter'], exact_rows[row['request']]['counter'])
+            for column in ['time_med', 'time_p90', 'time_p95', 'time_p99']:
+                expected = exact_rows[row['request']][column]
+                self.assertLessEqual(abs(row[column] - expected) / expected, 0.02)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, 'report-2017.06.30.agg')
+            log_analyzer.save_aggregate(name, hist.to_sketch({}), {})
+            loaded, meta = log_analyzer.load_aggregate(name)
+
+        self.assertEqual(meta['summary'], 'histogram')
+        self.assertEqual(log_analyzer.prepare_report_data({}, loaded), rows)
+
+    def test_save_aggregate__roundtrip(self):
+        res = log_analyzer.make_aggregator({})
+        for i in range(3000):
+            res.add('/api/{}/ü'.format(i % 7), (i * 7919 % 1000) / 100)
+
+        sketch = res.to_sketch({})
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, 'report-2017.06.30.agg')
+            log_analyzer.save_aggregate(name, sketch, {'lines': 3000})
+            loaded, meta = log_analyzer.load_aggregate(name)
+
+        self.assertEqual(meta['lines'], 3000)
+        expected = {x['request']: x for x in log_analyzer.prepare_report_data({}, sketch)}
+        for row in log_analyzer.prepare_report_data({}, loaded):
+            self.assertEqual(row, expected[row['request']])
+
+    def test_rollup__merges_saved_days(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            config = log_analyzer.load_config('./config.cfg')
+            config.update({'LOG_DIR': log_dir, 'REPORT_DIR': report_dir, 'BACKFILL_JOBS': 1,
+                           'SAVE_AGGREGATES': True})
+            for day in ['20170620', '20170628', '20170629', '20170630']:
+                with open(os.path.join(log_dir, 'nginx-access-ui.log-' + day), 'w', encoding='utf-8') as f:
+                    urls = write_log(f, 70)
+
+            log_analyzer.backfill(config)
+            report = log_analyzer.rollup(config, 7)
+
+            self.assertEqual(os.path.basename(report), 'report-2017.06.28-2017.06.30.html')
+            with open(report, encoding='utf-8') as f:
+                html = f.read()
+            for url, count in urls.items():
+                self.assertIn('"request": "{}", "counter": {},'.format(url, count * 3), html)
+
+    def test_select_median(self):
+        for n in [1, 2, 31, 32, 33, 100, 1001]:
+            values = [(i * 7919 % 97) / 10 for i in range(n)]
+
+            self.assertEqual(log_analyzer.select_median(values), median(values))
+
+    def test_select_ranks(self):
+        for n in [1, 2, 31, 32, 33, 100, 1001, 5000]:
+            values = array('d', [(i * 7919 % 97) / 10 for i in range(n)])
+            ranks = [n // 2, 0, n - 1, (n - 1) // 2, int(0.99 * n)]
+
+            self.assertEqual(log_analyzer.select_ranks(values, ranks), [sorted(values)[k] for k in ranks])
+
+    def test_prepare_report_data__packed_equals_exact(self):
+        exact = log_analyzer.make_aggregator({})
+        packed = log_analyzer.make_aggregator({'AGGREGATION': 'packed'})
+        for i in range(5000):
+            url = '/api/{}'.format(i % 7)
+            exact.add(url, (i * 7919 % 1000) / 1000)
+            packed.add(url, (i * 7919 % 1000) / 1000)
+
+        config = {'QUANTILES': [0.9, 0.99]}
+
+        self.assertEqual(log_analyzer.prepare_report_data(config, packed),
+                         log_analyzer.prepare_report_data(config, exact))
+
+    def test_prepare_report_data__sketch_close_to_exact(self):
+        exact = log_analyzer.make_aggregator({})
+        sketch = log_analyzer.make_aggregator({'AGGREGATION': 'sketch', 'SKETCH_ACCURACY': 0.02})
+        for i in range(20000):
+            url = '/api/{}'.format(i % 3)
+            exact.add(url, (i * 7919 % 1000) / 100)
+            sketch.add(url, (i * 7919 % 1000) / 100)
+
+        config = {'QUANTILES': [0.9]}
+        exact_rows = {x['request']: x for x in log_analyzer.prepare_report_data(config, exact)}
+        sketch_rows = {x['request']: x for x in log_analyzer.prepare_report_data(config, sketch)}
+
+        self.assertEqual(exact_rows.keys(), sketch_rows.keys())
+        for url, row in exact_rows.items():
+            for key in ['counter', 'time_sum', 'time_max', 'time_avg']:
+                self.assertAlmostEqual(row[key], sketch_rows[url][key], places=2)
+            self.assertAlmostEqual(row['time_med'], sketch_rows[url]['time_med'], delta=0.5)
+            self.assertAlmostEqual(row['time_p90'], sketch_rows[url]['time_p90'], delta=0.5)
+
+    def test_timeseries__per_minute(self):
+        with tempfile.NamedTemporaryFile(mode = 'w+', encoding = 'utf-8') as f:
+            for minute in range(3):
+                for second in range(0, 60, 20):
+                    f.write(LOG_LINE.replace('03:52:22', '03:5{}:{:02d}'.format(minute, second))
+                            .format('/api/{}'.format(minute), '{:.3f}'.format(minute + 1)))
+            f.flush()
+
+            single = log_analyzer.make_collectors({'TIMESERIES': True})
+            log_analyzer.logs_handler({}, f.name, None, single)
+            parallel = log_analyzer.make_collectors({'TIMESERIES': True})
+            log_analyzer.logs_handler({'WORKERS': 3, 'TIMESERIES': True}, f.name, None, parallel)
+
+        series = single['timeseries']
+        self.assertEqual(len(series.minutes), 9)
+        self.assertEqual(series.counts[3 * 60 + 51], 3)
+        report = series.report()
+        self.assertEqual(report['minutes'], ['03:50', '03:51', '03:52'])
+        self.assertEqual(report['count'], [3, 3, 3])
+        self.assertEqual(report['time_avg'], [1.0, 2.0, 3.0])
+        self.assertEqual(report['urls'][0]['url'], '/api/2')
+        self.assertEqual(report['urls'][0]['time_avg'][3], 3.0)
+        self.assertEqual(parallel['timeseries'].report(), report)
+
+    def test_build_report__timeseries_section(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            report_file = os.path.join(tmp, 'report-2017.06.30.html')
+            with open(log_file, 'w', encoding='utf-8') as f:
+                write_log(f, 100)
+
+            config = {'REPORT_SIZE': 10, 'TIMESERIES': True, 'SAMPLING': 'every', 'SAMPLING_STEP': 4, 'MMAP': False}
+            log_analyzer.build_report(config, log_file, report_file)
+            with open(report_file, encoding='utf-8') as f:
+                html = f.read()
+
+        self.assertIn('"minutes": ["03:52"], "count": [100]', html)
+        self.assertNotIn('$timeseries_json', html)
+
+    @unittest.skipUnless(log_analyzer.np is not None, 'NumPy is not installed')
+    def test_prepare_report_data__numpy_equals_python(self):
+        exact = log_analyzer.make_aggregator({})
+        parts = [log_analyzer.make_aggregator({'ENGINE': 'numpy'}) for _ in range(2)]
+        log_analyzer.NumpyAggregator.CHUNK = 1000
+        try:
+            for i in range(5000):
+                url = '/api/{}'.format(i % 7 if i < 4000 else i % 11)
+                exact.add(url, (i * 7919 % 1000) / 1000)
+                parts[i % 2].add(url, (i * 7919 % 1000) / 1000)
+        finally:
+            log_analyzer.NumpyAggregator.CHUNK = 1 << 16
+
+        config = {'QUANTILES': [0.5, 0.9, 0.99], 'REPORT_SIZE': 8}
+        rows = log_analyzer.prepare_report_data(config, parts[0].merge(parts[1]))
+
+        self.assertEqual(rows, log_analyzer.prepare_report_data(config, exact))
+
+    @unittest.skipUnless(log_analyzer.np is not None, 'NumPy is not installed')
+    def test_logs_handler__numpy_chunks_equal_lines(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            with open(log_file, 'w', encoding='utf-8', newline='') as f:
+                write_log(f, 3000)
+                f.write('garbage\n\n1.1.1.1 - [broken] "PUT /lenient/7 HTTP/1.1" 200 0.5\n')
+                f.write(LOG_LINE.format('/zero', '0.000') + LOG_LINE.format('/crlf', '2.0').replace('\n', '\r\n'))
+                write_log(f, 3000)
+                f.write(LOG_LINE.format('/last/1', '3.0').rstrip('\n'))
+            with open(log_file, 'rb') as f, gzip.open(log_file + '.gz', 'wb') as g:
+                shutil.copyfileobj(f, g)
+
+            report_config = {'QUANTILES': [0.9], 'REPORT_SIZE': 0}
+            key = lambda x: x['request']
+            for name, config in [(log_file, {}), (log_file, {'WORKERS': 2}), (log_file + '.gz', {'WORKERS': 2}),
+                                 (log_file, {'NORMALIZE_URLS': ['id']})]:
+                expected_errors, errors = log_analyzer.ParseErrors(), log_analyzer.ParseErrors()
+                expected, expected_acc = log_analyzer.logs_handler(config, name, errors=expected_errors)
+                res, acc = log_analyzer.logs_handler(dict(config, ENGINE='numpy'), name, errors=errors)
+
+                self.assertIsInstance(res, log_analyzer.NumpyAggregator)
+                self.assertEqual(acc, expected_acc)
+                self.assertEqual(errors.reasons, expected_errors.reasons)
+                self.assertEqual(sorted(log_analyzer.prepare_report_data(report_config, res), key=key),
+                                 sorted(log_analyzer.prepare_report_data(report_config, expected), key=key))
+
+        # blocks of good lines are matched at once, only the block with a bad line goes line by line
+        good = LOG_LINE.format('/a', '1.5').encode() * 10
+        blocks = [good, b'garbage\n' + good, good + LOG_LINE.format('/b', '0.000').encode()]
+        res, acc = log_analyzer.make_aggregator({'ENGINE': 'numpy'}), [0]
+        ids = log_analyzer.RawUrlIds(res.url_id)
+        chunks = list(log_analyzer.parse_chunks(blocks, acc, ids))
+
+        self.assertEqual(acc[0], 32)
+        self.assertEqual([len(times) for _, times in chunks], [10, 10, 10])
+        self.assertEqual(res.urls, ['/a', '/b'])
+        self.assertEqual(set(ids), {b'/a', b'/b'})
+
+    def test_make_aggregator__numpy_engine(self):
+        with self.assertRaises(ValueError):
+            log_analyzer.make_aggregator({'ENGINE': 'numpy', 'AGGREGATION': 'sketch'})
+        if log_analyzer.np is None:
+            with self.assertRaises(ImportError):
+                log_analyzer.make_aggregator({'ENGINE': 'numpy'})
+
+    def test_build_report__profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            report_file = os.path.join(tmp, 'report-2017.06.30.html')
+            with gzip.open(log_file, 'wt', encoding='utf-8') as f:
+                write_log(f, 1000)
+
+            config = {'REPORT_SIZE': 10, 'PROFILE': True, 'CPROFILE': True}
+            log_analyzer.build_report(config, log_file, report_file)
+            with open(os.path.join(tmp, 'report-2017.06.30.profile.json'), encoding='utf-8') as f:
+                summary = json.load(f)
+
+            self.assertTrue(os.path.isfile(os.path.join(tmp, 'report-2017.06.30.prof')))
+
+        self.assertEqual(summary['lines'], 1000)
+        self.assertEqual(set(summary['stages']), {'read', 'parse', 'aggregate', 'stats', 'sort', 'render', 'write'})
+        self.assertEqual(summary['stages']['parse']['lines'], 1000)
+        self.assertEqual(summary['stages']['read']['bytes'], summary['stages']['parse']['bytes'])
+        self.assertEqual(summary['stages']['stats']['lines'], 7)
+        self.assertLessEqual(sum(x['wall'] for x in summary['stages'].values()), summary['wall'])
+
+    def test_follow__appended_lines_and_rotation(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            config = {'REPORT_SIZE': 10, 'LOG_DIR': log_dir, 'REPORT_DIR': report_dir,
+                      'FOLLOW_INTERVAL': 0, 'FOLLOW_POLL': 0.01}
+            first = os.path.join(log_dir, 'nginx-access-ui.log-20170629')
+            second = os.path.join(log_dir, 'nginx-access-ui.log-20170630')
+            reports = []
+
+            def step():
+                step.count += 1
+                if step.count == 2:
+                    with open(os.path.join(report_dir, 'report-2017.06.29.html'), encoding='utf-8') as f:
+                        reports.append(f.read())
+                    with open(first, 'a', encoding='utf-8') as f:
+                        f.write(LOG_LINE.format('/api/new', '1.000'))
+                        f.write(LOG_LINE.format('/api/partial', '1.000')[:-20])
+                elif step.count == 3:
+                    with open(second, 'w', encoding='utf-8') as f:
+                        write_log(f, 10)
+                return step.count > 4
+            step.count = 0
+
+            with open(first, 'w', encoding='utf-8') as f:
+                write_log(f, 70)
+            log_analyzer.follow(config, step)
+
+            with open(os.path.join(report_dir, 'report-2017.06.29.html'), encoding='utf-8') as f:
+                reports.append(f.read())
+            with open(os.path.join(report_dir, 'report-2017.06.30.html'), encoding='utf-8') as f:
+                reports.append(f.read())
+
+        self.assertIn('"request": "/api/v2/banner/0", "counter": 10,', reports[0])
+        self.assertNotIn('/api/new', reports[0])
+        self.assertIn('"request": "/api/new", "counter": 1,', reports[1])
+        self.assertNotIn('/api/partial', reports[1])
+        self.assertIn('"request": "/api/v2/banner/0", "counter": 2,', reports[2])
+        self.assertIn('"time_p99"', reports[0])  # bounded histogram aggregation by default
+
+    def test_manifest__rescans_changed_directories_only(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            config = {'LOG_DIR': log_dir, 'REPORT_DIR': report_dir,
+                      'MANIFEST_FILE': os.path.join(report_dir, '.manifest.json')}
+            for name in ['nginx-access-ui.log-20170630', 'nginx-access-ui.log-20170628.gz', 'other.log']:
+                with open(os.path.join(log_dir, name), 'w') as f:
+                    f.write('abc')
+            with open(os.path.join(report_dir, 'report-2017.06.28.html'), 'w') as f:
+                f.write('abc')
+
+            log_analyzer.LogManifest.RACY_NS = -1
+            try:
+                names = [os.path.basename(x) for x in log_analyzer.get_log_files(config)]
+                manifest = log_analyzer.get_manifest(config)
+                self.assertFalse(manifest.refresh())
+
+                os.utime(log_dir, ns=(0, 0))
+                os.remove(os.path.join(log_dir, 'nginx-access-ui.log-20170630'))
+                with open(os.path.join(log_dir, 'nginx-access-ui.log-20170701'), 'w') as f:
+                    f.write('abcdef')
+                os.utime(log_dir, ns=(1, 1))
+                newest = os.path.basename(log_analyzer.get_report_name(config))
+                reloaded = log_analyzer.LogManifest(config['MANIFEST_FILE'], log_dir, report_dir)
+            finally:
+                log_analyzer.LogManifest.RACY_NS = 2 * 10 ** 9
+                log_analyzer.MANIFESTS.clear()
+
+        self.assertEqual(names, ['nginx-access-ui.log-20170628.gz', 'nginx-access-ui.log-20170630'])
+        self.assertEqual(newest, 'nginx-access-ui.log-20170701')
+        self.assertEqual(reloaded.pending(), ['nginx-access-ui.log-20170701'])
+        self.assertEqual(reloaded.data['files']['nginx-access-ui.log-20170701']['size'], 6)
+        self.assertTrue(reloaded.data['files']['nginx-access-ui.log-20170628.gz']['report'])
+
+    def test_manifest__restats_consulted_files(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            config = {'LOG_DIR': log_dir, 'REPORT_DIR': report_dir,
+                      'MANIFEST_FILE': os.path.join(report_dir, '.manifest.json')}
+            for name in ['nginx-access-ui.log-20170629', 'nginx-access-ui.log-20170630']:
+                with open(os.path.join(log_dir, name), 'w') as f:
+                    f.write('abc')
+
+            log_analyzer.LogManifest.RACY_NS = -1
+            try:
+                manifest = log_analyzer.get_manifest(config)
+                for name in ['nginx-access-ui.log-20170629', 'nginx-access-ui.log-20170630']:
+                    with open(os.path.join(log_dir, name), 'a') as f:
+                        f.write('defgh')
+                mtime = os.stat(log_dir).st_mtime_ns
+                os.utime(os.path.join(log_dir, 'nginx-access-ui.log-20170630'), ns=(5, 5))
+                os.utime(log_dir, ns=(mtime, mtime))  # appending doesn't change the directory
+
+                log_analyzer.get_report_name(config)
+                newest = dict(manifest.data['files']['nginx-access-ui.log-20170630'])
+                older = dict(manifest.data['files']['nginx-access-ui.log-20170629'])
+                pending = manifest.pending()
+                reloaded = log_analyzer.LogManifest(config['MANIFEST_FILE'], log_dir, report_dir)
+            finally:
+                log_analyzer.LogManifest.RACY_NS = 2 * 10 ** 9
+                log_analyzer.MANIFESTS.clear()
+
+        self.assertEqual((newest['size'], newest['mtime']), (8, 5))
+        self.assertEqual(older['size'], 3)
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(reloaded.data['files']['nginx-access-ui.log-20170629']['size'], 8)
+
+    def test_logs_handler__pipelined_gzip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            with gzip.open(log_file, 'wt', encoding='utf-8') as f:
+                urls = write_log(f, 3000)
+                f.write('bad line')
+
+            config = {'WORKERS': 3, 'TIMESERIES': True}
+            collectors = log_analyzer.make_collectors(config)
+            res, acc = log_analyzer.logs_handler(config, log_file, log_analyzer.make_sampler(config), collectors)
+            single, _ = log_analyzer.logs_handler({}, log_file)
+
+        self.assertEqual(acc[0], 3001)
+        self.assertEqual({k: v['counter'] for k, v in res.res.items()}, urls)
+        for url, val in res.res.items():
+            self.assertEqual(sorted(val['times']), sorted(single.res[url]['times']))
+        self.assertEqual(collectors['timeseries'].report()['count'], [3000])
+
+    def test_logs_handler__pipelined_failures(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            with gzip.open(log_file, 'wt', encoding='utf-8') as f:
+                write_log(f, 3000)
+
+            # a bad setting fails before workers are started
+            with self.assertRaises(ValueError):
+                log_analyzer.logs_handler({'WORKERS': 2, 'TIME_WINDOW': '9-18'}, log_file)
+
+            # a dead worker doesn't hang the reader
+            with mock.patch.object(log_analyzer, 'pipeline_worker', lambda *args: os._exit(3)):
+                with self.assertRaises(RuntimeError):
+                    log_analyzer.pipelined_logs_handler({}, log_file, 2, timeout=0.1)
+
+        # a worker which can't be set up still drains the queue and reports back
+        tasks, results, failed = queue.Queue(), queue.Queue(), threading.Event()
+        for item in [(b'x', 0.0), (b'y', 0.0), None]:
+            tasks.put(item)
+        log_analyzer.pipeline_worker(tasks, results, False, {'TIME_WINDOW': '9-18'}, failed)
+
+        self.assertTrue(tasks.empty())
+        self.assertTrue(failed.is_set())
+        self.assertIn('Bad time window', results.get_nowait()[4])
+
+    def test_line_batches(self):
+        batches = list(log_analyzer.line_batches([b'a\nb', b'c', b'd\ne\n', b'f']))
+
+        self.assertEqual(batches, [b'a\n', b'bcd\ne\n', b'f'])
+
+    def test_parse_errors__reasons_and_sample(self):
+        errors = log_analyzer.ParseErrors({'PARSE_ERRORS_SAMPLE': 2})
+        lines = [LOG_LINE.format('/a', '0.5').encode(), b'', b'garbage', b'"GET /b HTTP/1.1" 200 -'] + \
+            [b'garbage %d' % i for i in range(100)]
+
+        res = list(log_analyzer.parse_lines(lines, [0], errors=errors))
+
+        self.assertEqual(res, [(0.5, '/a')])
+        self.assertEqual(errors.count, 103)
+        self.assertEqual(errors.reasons, {'empty': 1, 'no_request': 101, 'no_request_time': 1})
+        self.assertEqual(errors.first, [('empty', b''), ('no_request', b'garbage')])
+        self.assertEqual(len(errors.reservoir), 2)
+        self.assertEqual(errors.seen, 101)
+
+        other = log_analyzer.ParseErrors({'PARSE_ERRORS_SAMPLE': 2})
+        list(log_analyzer.parse_lines([b'x', b'"GET /b HTTP/1.1" 200 0.5'], [0], True, errors=other))
+        errors.merge(other)
+        self.assertEqual(errors.count, 105)
+        self.assertEqual(errors.reasons['not_ui_short'], 1)
+        self.assertEqual((len(errors.first), len(errors.reservoir), errors.seen), (2, 2, 103))
+
+    def test_parse_errors__early_min_lines_abort(self):
+        config = {'MIN_LINES': 0.5, 'MIN_LINES_CHECK': 100}
+        lines = [b'garbage'] * 10000
+        acc = [0]
+
+        # aborted only when errors outnumber half of the whole input
+        errors = log_analyzer.ParseErrors(config)
+        errors.progress = lambda: acc[0] / len(lines)
+        with self.assertRaises(ValueError):
+            for _ in log_analyzer.parse_lines(lines, acc, errors=errors):
+                pass
+        self.assertEqual(acc[0], 5001)
+
+        # without progress or without the check every line is parsed
+        for errors in [log_analyzer.ParseErrors(config), log_analyzer.ParseErrors(config, abort=False)]:
+            acc = [0]
+            list(log_analyzer.parse_lines(lines[:1000], acc, errors=errors))
+            self.assertEqual((acc[0], errors.count), (1000, 1000))
+
+    def test_logs_handler__bad_prefix_is_not_aborted(self):
+        bad = 'x' * 150 + '\n'
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            with open(log_file, 'w', encoding='utf-8') as f:
+                f.write(bad * 30000)
+                write_log(f, 90000)
+            with open(log_file, 'rb') as f, gzip.open(log_file + '.gz', 'wb') as g:
+                shutil.copyfileobj(f, g)
+
+            for name, config in [(log_file, {}), (log_file, {'MMAP': False}), (log_file, {'WORKERS': 4}),
+                                 (log_file + '.gz', {}), (log_file + '.gz', {'WORKERS': 2})]:
+                errors = log_analyzer.ParseErrors(config)
+                res, acc = log_analyzer.logs_handler(config, name, errors=errors)
+                self.assertEqual((acc[0], errors.count), (120000, 30000))
+
+            # a log which can't pass is given up before its end
+            with open(log_file, 'w', encoding='utf-8') as f:
+                write_log(f, 10000)
+                f.write(bad * 110000)
+            acc = [0]
+            with self.assertRaises(ValueError):
+                list(log_analyzer.process_log_file(log_file, acc, errors=log_analyzer.ParseErrors()))
+            self.assertLess(acc[0], 120000)
+
+    def test_logs_handler__parallel_parse_errors(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as f:
+            write_log(f, 500)
+            f.write('garbage\n' * 30)
+            write_log(f, 500)
+            errors = log_analyzer.ParseErrors()
+            res, acc = log_analyzer.logs_handler({'WORKERS': 2}, f.name, errors=errors)
+
+        self.assertEqual(acc[0], 1030)
+        self.assertEqual(errors.reasons, {'no_request': 30})
+        self.assertEqual(len(errors.first) + len(errors.reservoir), 10)
+
+    def test_prepare_report_data__spilled_equals_exact(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            records = [('/api/{}'.format(i % 3000), 0.001 * (i % 3000 + 1) + 0.0001 * (i % 7)) for i in range(60000)]
+            config = {'REPORT_SIZE': 50, 'QUANTILES': [0.9], 'AGGREGATION': 'packed'}
+            spill_config = dict(config, MEMORY_BUDGET=0.1, SPILL_PARTITIONS=8, SPILL_DIR=tmp)
+
+            exact = log_analyzer.make_aggregator(config)
+            spilled = log_analyzer.make_aggregator(spill_config)
+            other = log_analyzer.make_aggregator(spill_config)
+            for i, (request_url, request_time) in enumerate(records):
+                exact.add(request_url, request_time)
+                (spilled if i % 2 else other).add(request_url, request_time)
+            spilled.merge(other)
+
+            self.assertIsInstance(spilled, log_analyzer.SpillAggregator)
+            self.assertTrue(os.listdir(tmp))
+            self.assertLessEqual(spilled.memory(), 0.1 * (1 << 20))
+            for report_size in [50, 0]:
+                config['REPORT_SIZE'] = report_size
+                expected = log_analyzer.prepare_report_data(config, exact)
+                actual = log_analyzer.prepare_report_data(config, spilled)
+                key = lambda x: x['request']
+                self.assertEqual(sorted(actual, key=key), sorted(expected, key=key))
+            self.assertEqual(spilled.to_sketch().total_requests(), 60000)
+
+            del spilled, other
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_build_report__spilled_histogram_aggregate(self):
+        with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory() as spill_dir:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            report_file = os.path.join(tmp, 'report-2017.06.30.html')
+            with open(log_file, 'w', encoding='utf-8') as f:
+                for i in range(20000):
+                    f.write(LOG_LINE.format('/api/{}'.format(i % 2000), '{:.3f}'.format(0.1 + i % 13)))
+
+            config = {'REPORT_SIZE': 10, 'AGGREGATION': 'histogram', 'MEMORY_BUDGET': 0.5,
+                      'SPILL_PARTITIONS': 4, 'SPILL_DIR': spill_dir, 'SAVE_AGGREGATES': True}
+            log_analyzer.build_report(config, log_file, report_file)
+            loaded, meta = log_analyzer.load_aggregate(log_analyzer.aggregate_file_name(report_file))
+
+        self.assertIsInstance(loaded, log_analyzer.HistogramAggregator)
+        self.assertEqual(len(loaded), 2000)
+        self.assertEqual(loaded.total_requests(), 20000)
+
+    def test_logs_handler__parallel_spilled(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as f, tempfile.TemporaryDirectory() as tmp:
+            write_log(f, 20000)
+            config = {'WORKERS': 2, 'MEMORY_BUDGET': 0.05, 'SPILL_PARTITIONS': 4, 'SPILL_DIR': tmp,
+                      'REPORT_SIZE': 10}
+            res, acc = log_analyzer.logs_handler(config, f.name)
+            exact, _ = log_analyzer.logs_handler({}, f.name)
+
+            self.assertEqual(acc[0], 20000)
+            self.assertGreaterEqual(len(os.listdir(tmp)), 2)  # workers' and maybe main process' spills
+            key = lambda x: x['request']
+            self.assertEqual(sorted(log_analyzer.prepare_report_data(config, res), key=key),
+                             sorted(log_analyzer.prepare_report_data(config, exact), key=key))
+            del res
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_line_filter__fields(self):
+        line_filter = log_analyzer.make_filter({
+            'URL_PREFIXES': ['/api/'], 'URL_EXCLUDE_REGEX': r'/banner/\d+$', 'METHODS': ['GET'],
+            'STATUS': '200-299,404', 'TIME_WINDOW': '03:00-04:00'})
+        line = LOG_LINE.format('/api/v2/group/1', '0.5').encode()
+
+        self.assertIsNone(log_analyzer.make_filter({'MIN_LINES': 0.5}))
+        self.assertFalse(line_filter.rejects(line))
+        for rejected in [line.replace(b'/api/', b'/export/'), line.replace(b'group/1', b'banner/1'),
+                         line.replace(b'"GET', b'"POST'), line.replace(b'" 200', b'" 302'),
+                         line.replace(b':03:52', b':04:00')]:
+            self.assertTrue(line_filter.rejects(rejected), rejected)
+        self.assertFalse(line_filter.rejects(line.replace(b'" 200', b'" 404')))
+        # lines whose fields can't be found are left to the parser
+        self.assertFalse(line_filter.rejects(b'garbage'))
+
+        night = log_analyzer.make_filter({'TIME_WINDOW': '23:00-04:00'})
+        self.assertFalse(night.rejects(line))
+        self.assertTrue(night.rejects(line.replace(b':03:52', b':12:52')))
+
+        with self.assertRaises(ValueError):
+            log_analyzer.make_filter({'TIME_WINDOW': '9-18'})
+
+    def test_logs_handler__filtered(self):
+        config = {'URL_PREFIXES': ['/api/v2/banner/1', '/api/v2/banner/2'], 'STATUS': '200'}
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as f:
+            urls = write_log(f, 700)
+            f.write(LOG_LINE.format('/api/v2/banner/1', '0.5').replace('" 200', '" 500'))
+            f.write('garbage\n')
+            f.flush()
+            results = []
+            for extra in [{}, {'MMAP': False}, {'WORKERS': 2}]:
+                res, acc = log_analyzer.logs_handler(dict(config, **extra), f.name)
+                results.append((acc[0], sorted(res.time_sums())))
+
+        self.assertEqual(results[0][0], urls['/api/v2/banner/1'] + urls['/api/v2/banner/2'] + 1)
+        self.assertEqual([url for url, _ in results[0][1]], ['/api/v2/banner/1', '/api/v2/banner/2'])
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_build_report__cardinality(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {'REPORT_SIZE': 10, 'REPORT_DIR': tmp, 'CARDINALITY': True, 'WORKERS': 2,
+                      'SAVE_AGGREGATES': True}
+            for day, offset in [('20170629', 0), ('20170630', 1000)]:
+                log_file = os.path.join(tmp, 'nginx-access-ui.log-' + day)
+                with open(log_file, 'w', encoding='utf-8') as f:
+                    for i in range(3000):
+                        ip = '10.1.{}.{}'.format(*divmod(offset + i % 2000, 256))
+                        f.write(LOG_LINE.format('/many', '0.5').replace('1.196.116.32', ip))
+                        f.write(LOG_LINE.format('/few', '0.1').replace('1.196.116.32', '10.2.0.%d' % (i % 5)))
+                log_analyzer.build_report(config, log_file, os.path.join(tmp, 'report-2017.06.%s.html' % day[-2:]))
+
+            with open(os.path.join(tmp, 'report-2017.06.30.html'), encoding='utf-8') as f:
+                html = f.read()
+            collectors = dict()
+            log_analyzer.load_aggregate(os.path.join(tmp, 'report-2017.06.30.agg'), collectors)
+            report = log_analyzer.rollup(config, 7)
+            with open(report, encoding='utf-8') as f:
+                rollup_html = f.read()
+
+        rows = {row['request']: row for row in json.loads(html.split('var table = ')[1].split(';')[0])}
+        self.assertEqual(rows['/few']['clients'], 5)
+        self.assertLessEqual(abs(rows['/many']['clients'] - 2000), rows['/many']['clients_err'])
+        summary = json.loads(html.split('var cardinality = ')[1].split(';')[0])
+        self.assertEqual(summary['urls'], 2)
+        self.assertLessEqual(abs(summary['clients'] - 2005), 2005 * summary['total_error_perc'] / 100)
+
+        cardinality = collectors['cardinality']
+        self.assertEqual(cardinality.report(), summary)
+        self.assertEqual(round(cardinality.top.items['/few'][2].count()), 5)
+
+        rows = {row['request']: row for row in json.loads(rollup_html.split('var table = ')[1].split(';')[0])}
+        self.assertLessEqual(abs(rows['/many']['clients'] - 3000), rows['/many']['clients_err'])
+        self.assertEqual(rows['/few']['clients'], 5)
+
+    @unittest.skipUnless(log_analyzer.indexed_gzip is not None, 'indexed_gzip is not installed')
+    def test_logs_handler__indexed_gzip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            with gzip.open(log_file, 'wt', encoding='utf-8') as f:
+                urls = write_log(f, 5000)
+
+            config = {'GZIP_INDEX': True, 'GZIP_INDEX_SPACING': 1}
+            ranges = log_analyzer.split_file(log_file, 4, config)
+            self.assertTrue(os.path.isfile(os.path.join(tmp, '.nginx-access-ui.log-20170630.gz.gzidx')))
+            self.assertEqual(log_analyzer.get_log_files({'LOG_DIR': tmp}), [log_file])
+
+            parts = [sum(1 for _ in log_analyzer.parse_lines(log_analyzer.split_lines(
+                log_analyzer.read_range_blocks(log_file, start, end, config=config)), [0])) for start, end in ranges]
+            res, acc = log_analyzer.logs_handler(dict(config, WORKERS=3), log_file)
+
+            position = dict()
+            resumed = list(log_analyzer.read_blocks(log_file, offset=ranges[1][0], position=position,
+                                                    whole_lines=True, config=config))
+
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(sum(parts), 5000)
+        self.assertEqual(acc[0], 5000)
+        self.assertEqual({k: v['counter'] for k, v in res.res.items()}, urls)
+        self.assertTrue(resumed[0].startswith(b'1.196.116.32 -  - ['))
+        self.assertEqual(sum(len(x) for x in resumed), ranges[-1][1] - ranges[1][0])
+        self.assertEqual(position['offset'], ranges[-1][1])
+
 if __name__ == '__main__':
         unittest.main()
\ No newline at end of file
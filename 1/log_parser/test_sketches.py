@@ -0,0 +1,142 @@
+"""
+    Testing the streaming sketches.
+"""
+import unittest
+import random
+import bisect
+
+import sketches
+
+
+class TestKLLSketch(unittest.TestCase):
+
+    def test_small_stream_is_exact(self):
+        sketch = sketches.KLLSketch(0.01)
+        for x in [5, 1, 4, 2, 3]:
+            sketch.update(x)
+
+        self.assertEqual(sketch.quantiles([0, 0.5, 1]), [1, 3, 5])
+
+    def test_rank_error_within_accuracy(self):
+        accuracy = 0.01
+        for seed in range(3):
+            rnd = random.Random(seed)
+            data = [rnd.random() for _ in range(100000)]
+            sketch = sketches.KLLSketch(accuracy)
+            for x in data:
+                sketch.update(x)
+
+            ordered = sorted(data)
+            for i in range(1, 100):
+                q = i / 100
+                rank = bisect.bisect_left(ordered, sketch.quantile(q)) / len(data)
+                self.assertLess(abs(rank - q), 2 * accuracy)
+            self.assertLess(sketch.size, 2000)
+
+    def test_merge(self):
+        left, right = sketches.KLLSketch(0.01), sketches.KLLSketch(0.01)
+        for x in range(50000):
+            (left if x % 2 else right).update(x)
+
+        left.merge(right)
+
+        self.assertEqual(left.count, 50000)
+        self.assertLess(abs(left.quantile(0.5) - 25000), 2 * 0.01 * 50000)
+
+
+class TestSpaceSaving(unittest.TestCase):
+
+    def stream(self):
+        rnd = random.Random(2)
+        for i in range(20000):
+            if i % 2:
+                yield '/heavy/{}'.format(i % 5), 1.0 + (i % 5)
+            else:
+                yield '/light/{}'.format(rnd.randrange(5000)), rnd.random()
+
+    def test_bounds(self):
+        counters = sketches.SpaceSaving(20)
+        exact = dict()
+        for key, weight in self.stream():
+            counters.update(key, weight)
+            exact[key] = exact.get(key, 0) + weight
+
+        top = counters.top(5)
+
+        self.assertEqual(sorted(x[0] for x in top), ['/heavy/{}'.format(i) for i in range(5)])
+        for key, value, error, _ in counters.top():
+            self.assertLessEqual(value - error, exact[key] + 1e-6)
+            self.assertGreaterEqual(value + 1e-6, exact[key])
+            self.assertLessEqual(error, counters.floor)
+        self.assertLessEqual(len(counters), 40)
+
+    def test_merge(self):
+        left, right = sketches.SpaceSaving(20), sketches.SpaceSaving(20)
+        exact = dict()
+        for i, (key, weight) in enumerate(self.stream()):
+            (left if i % 3 else right).update(key, weight)
+            exact[key] = exact.get(key, 0) + weight
+
+        left.merge(right)
+
+        for key, value, error, _ in left.top(5):
+            self.assertTrue(key.startswith('/heavy/'))
+            self.assertLessEqual(value - error, exact[key] + 1e-6)
+            self.assertGreaterEqual(value + 1e-6, exact[key])
+
+
+class TestLogHistogram(unittest.TestCase):
+
+    def test_relative_precision(self):
+        hist = sketches.LogHistogram(0.01)
+        for value in [0.001, 0.0137, 0.5, 1.0, 3.1415, 77.7, 1234.5]:
+            self.assertLessEqual(abs(hist.value(hist.index(value)) - value) / value, 0.01)
+        self.assertEqual(hist.value(hist.index(0.0)), 0.0)
+
+    def test_quantiles_and_merge(self):
+        rnd = random.Random(3)
+        data = [rnd.lognormvariate(-2, 1) for _ in range(50000)]
+        left, right = sketches.LogHistogram(0.01), sketches.LogHistogram(0.01)
+        for i, x in enumerate(data):
+            (left if i % 2 else right).update(x)
+
+        left.merge(right)
+
+        ordered = sorted(data)
+        for q in [0.5, 0.9, 0.99]:
+            exact = ordered[int(q * len(ordered))]
+            self.assertLessEqual(abs(left.quantile(q) - exact) / exact, 0.02)
+        self.assertEqual(left.count, 50000)
+        self.assertLess(len(left.counts), 1000)
+
+        with self.assertRaises(ValueError):
+            left.merge(sketches.LogHistogram(0.1))
+
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def test_count_within_error(self):
+        for n in [10, 1000, 200000]:
+            sketch = sketches.HyperLogLog(12)
+            for i in range(n):
+                sketch.add(b'10.0.%d.%d' % divmod(i, 256))
+                sketch.add(b'10.0.0.1')
+            self.assertLessEqual(abs(sketch.count() - n) / n, 4 * sketch.relative_error)
+        self.assertEqual(sketches.HyperLogLog(10).count(), 0)
+
+    def test_merge_and_registers(self):
+        left, right, both = sketches.HyperLogLog(10), sketches.HyperLogLog(10), sketches.HyperLogLog(10)
+        for i in range(30000):
+            (left if i % 3 else right).add(b'%d' % i)
+            both.add(b'%d' % i)
+
+        left.merge(right)
+
+        self.assertEqual(left.registers, both.registers)
+        self.assertEqual(sketches.HyperLogLog.from_registers(bytes(left.registers)).count(), left.count())
+        with self.assertRaises(ValueError):
+            left.merge(sketches.HyperLogLog(12))
+
+if __name__ == '__main__':
+        unittest.main()